@@ -1,22 +1,58 @@
-random.seed()
 I = importlib
 
-pool_fund = Hash()
+# Pool accounting is kept in integer base units of 10^-8 tokens. Amounts entering the contract are
+# floored to whole base units and every payout is floored, so payouts never exceed what is held.
+BASE_UNITS = 100000000
+# Frozen payout rates are integers in units of 10^-16, fine enough that rounding a rate down costs
+# a contributor less than one base unit
+RATE_UNITS = 10000000000000000
+
+STATS_SHARDS = "0123456789abcdef" # Pool ids are hex digests
+
+pool_fund = Hash() # Pool definition, written by create_pool and once more when the pool is listed
+# [status, amount_received, total_nominal_contributions], the pool's only mutable fields. Amounts are the
+# sums of actual (post-tax) tokens received and of nominal contributions, in base units.
+pool_state = Hash()
+# Frozen once by settlement: [otc_take_token, payout_rate, pool_token, unfilled_fraction, received_units],
+# both rates in units of 1 / RATE_UNITS. Share claims read nothing but this record and the contributor's position.
+pool_settlement = Hash()
 otc_deal_info = Hash() # To store details about the OTC interaction for each pool
-contributor = Hash() # Stores {"nominal_amount_contributed": X, "actual_amount_added": Y, "share_withdrawn": False}
+contributor = Hash() # contributor[account, pool_id] -> [nominal_units, actual_units], deleted once claimed or refunded
 metadata = Hash()
+# Monotonic pool sequence, the next pool gets this number. Pool n's id is sha256(contract name + "-" + str(n)),
+# so indexers can enumerate pools without an on-chain index.
+pool_count = Variable()
+# expiry_bucket[day_key, index] -> pool_id, pools grouped by the day of their exchange_deadline, deleted as
+# sweep_expired passes them. expiry_bucket[day_key] is the bucket's size, and expiry_bucket["cursor"] is
+# [day, index], the start of the next day bucket sweep_expired will visit and the next index within it.
+expiry_bucket = Hash(default_value=0)
+pool_contributors = Hash() # pool_contributors[pool_id, index] -> account, append-only in order of first contribution until prune_archived_pool
+pool_contributor_count = Hash(default_value=0)
+settlement_cursor = Hash(default_value=0) # Contributors below this pool_contributors index are settled (pushed, or checked by archive_pool)
+pledge_cursor = Hash(default_value=0) # Next pool_contributors index whose pledge collect_pledges will pull
 
-# New state variable for re-entrancy guard
-reentrancyGuardActive = Variable(default_value=False)
+# Incrementally maintained stats, so monitoring never has to scan pools or replay events. Each counter is
+# split into STATS_SHARDS shards, picked by the first character of the pool id, so pools only share a
+# counter key with the pools of their own shard. The views add the shards up.
+pool_status_count = Hash(default_value=0) # pool_status_count[status, shard] -> number of pools currently in it
+contributor_total = Hash(default_value=0) # contributor_total[shard] -> sum over closed pools of distinct contributors
+token_stats = Hash(default_value=0) # token_stats[token, "value_locked" | "take_distributed", shard], in base units
 
-# Standard XSC001 (Fungible Token) interface
-token_interface = [
-    I.Func('transfer_from', args=('amount', 'to', 'main_account')),
-    I.Func('transfer', args=('amount', 'to')),
-    importlib.Func('balance_of', args=('address',)),
-]
+# Re-entrancy locks scoped to the resource being changed, so unrelated pools never contend.
+# Releasing a lock deletes its key, so no lock outlives the transaction in storage.
+pool_lock = Hash(default_value=False)
+token_lock = Hash(default_value=False) # Held while this contract's balance of a token is being measured
 
-# Events
+# Operator-maintained token behaviour: "standard" tokens credit exactly the amount sent, so the
+# balance_of probes around transfer_from are skipped. Unregistered tokens keep the probing path.
+token_type = Hash()
+# Operator-registered name of the token Hash holding allowances as [owner, spender], read by pledge pools.
+# XSC001 does not fix where allowances live, so only registered tokens can take pledges.
+allowance_layout = Hash()
+verified_tokens = Hash(default_value=False) # Tokens that already passed the XSC001 interface check
+
+# Events. Those emitted by a single, rarely called entry point are declared where they are emitted
+# instead, since the module body runs on every call into the contract.
 PoolCreated = LogEvent(
     event="pool_created", 
     params={
@@ -26,7 +62,9 @@ PoolCreated = LogEvent(
         "hard_cap": {'type':(int, float, decimal)}, # Nominal
         "soft_cap": {'type':(int, float, decimal)}, # Nominal
         "contribution_deadline": {'type':str, 'idx':False},
-        "exchange_deadline": {'type':str, 'idx':False}
+        "exchange_deadline": {'type':str, 'idx':False},
+        "pledge_mode": {'type':bool, 'idx':False},
+        "sequence": {'type':int, 'idx':False}
     })
 
 PoolListedOTC = LogEvent(
@@ -58,6 +96,15 @@ Contribution = LogEvent(
         "total_nominal_pool_contributions": {'type':(int, float, decimal)} # Sum of nominal_amount for the pool
     })
 
+
+
+
+
+
+
+
+
+
 @construct
 def seed():
     metadata['operator'] = ctx.caller
@@ -65,70 +112,163 @@ def seed():
     metadata['description_length'] = 200
     metadata['contribution_window'] = datetime.DAYS * 5 
     metadata['exchange_window'] = datetime.DAYS * 3
-    reentrancyGuardActive.set(False)
+    pool_count.set(0)
 
 @export
 def change_metadata(key: str, value: Any):
-    assert not reentrancyGuardActive.get(), "Crowdfund contract is busy, cannot change metadata now."
     assert ctx.caller == metadata['operator'], 'Only operator can set metadata!'
     metadata[key] = value
+    MetadataChanged = LogEvent(
+        event="metadata_changed",
+        params={
+            "key":{'type':str, 'idx':True},
+            "value": {'type':str, 'idx':False} # String form of the new value
+        })
+    MetadataChanged({"key": key, "value": str(value)})
 
 @export
-def create_pool(description: str, pool_token: str, hard_cap: float, soft_cap: float):
+def set_token_type(token: str, behaviour: str, allowance_hash: str = ""):
+    assert ctx.caller == metadata['operator'], 'Only operator can set token types!'
+    assert behaviour in ("standard", "fee_on_transfer", "unknown"), \
+        'behaviour must be "standard", "fee_on_transfer" or "unknown".'
+    if allowance_hash:
+        # Only the name can be introspected; the [owner, spender] key order is what the operator vouches for
+        assert I.enforce_interface(I.import_module(token), [I.Var(allowance_hash, Hash)]), \
+            'token has no Hash named ' + allowance_hash + '.'
+    token_type[token] = None if behaviour == "unknown" else behaviour
+    allowance_layout[token] = allowance_hash or None
+    TokenTypeSet = LogEvent(
+        event="token_type_set",
+        params={
+            "token":{'type':str, 'idx':True},
+            "behaviour": {'type':str, 'idx':False},
+            "allowance_hash": {'type':str, 'idx':False} # Empty when no allowance layout is registered
+        })
+    TokenTypeSet({"token": token, "behaviour": behaviour, "allowance_hash": allowance_hash or ""})
+
+@export
+def create_pool(description: str, pool_token: str, hard_cap: float, soft_cap: float, pledge_mode: bool = False):
     assert len(description) <= metadata['description_length'], f"description too long should be <{metadata['description_length']}"
-    assert hard_cap > soft_cap, 'hard cap amount should be greater than soft cap amount'
-    assert soft_cap > decimal("0.0"), 'soft cap must be positive'
+    # Caps are checked against the base-unit totals, so they are converted once here
+    hard_cap_units = to_units(hard_cap)
+    soft_cap_units = to_units(soft_cap)
+    assert hard_cap_units > soft_cap_units, 'hard cap amount should be greater than soft cap amount'
+    assert soft_cap_units > 0, 'soft cap must be positive'
+    if pledge_mode is None: # Transactions may pass omitted arguments as None
+        pledge_mode = False
+    if pledge_mode:
+        assert allowance_layout[pool_token], 'pledge mode needs a pool token with a registered allowance layout.'
 
-    token_contract = I.import_module(pool_token)
-    assert I.enforce_interface(token_contract, token_interface), 'pool_token contract not XSC001-compliant'
+    verify_token_interface(pool_token, 'pool_token contract not XSC001-compliant')
 
-    pool_id = hashlib.sha256(str(now) + str(random.randrange(99)))
-    assert not pool_fund[pool_id], 'Generated ID not unique. Try again with slight variation or wait a moment.'
+    # The sequence never repeats, so ids stay unique however many pools are created per block
+    pool_sequence = pool_count.get()
+    pool_id = hashlib.sha256(ctx.this + "-" + str(pool_sequence))
+    pool_count.set(pool_sequence + 1)
 
-    pool_fund[pool_id] = {
+    # Status and totals live in pool_state so contributions never rewrite this definition
+    pool = {
         "description": description,
         "pool_token": pool_token,
         "contribution_deadline": now + metadata['contribution_window'],
         "exchange_deadline": now + metadata['contribution_window'] + metadata['exchange_window'],
-        "hard_cap": hard_cap, # Nominal hard cap
-        "soft_cap": soft_cap, # Nominal soft cap
-        "amount_received": decimal("0.0"), # Sum of actual (post-tax) tokens received
-        "total_nominal_contributions": decimal("0.0"), # Sum of nominal contributions
+        "hard_cap": hard_cap_units, # Nominal hard cap, in base units
+        "soft_cap": soft_cap_units, # Nominal soft cap, in base units
         "pool_creator": ctx.caller,
-        "status": "OPEN_FOR_CONTRIBUTION",
+        "pledge_mode": pledge_mode, # Contributions are only pledged and pulled by collect_pledges
         "otc_listing_id": None,
-        "otc_take_token": None,
-        "otc_actual_received_amount": decimal("0.0") # Take tokens received from OTC
+        "otc_take_token": None
     }
-
-    pool = pool_fund[pool_id]
+    pool_fund[pool_id] = pool
+    add_to_expiry_bucket(pool_id, pool["exchange_deadline"])
+    set_pool_status(pool_id, pool, "OPEN_FOR_CONTRIBUTION")
 
     PoolCreated({
         "id": pool_id, 
         "description": pool["description"],
         "pool_token": pool["pool_token"], 
-        "hard_cap": pool["hard_cap"],
-        "soft_cap": pool["soft_cap"],
+        "hard_cap": from_units(hard_cap_units),
+        "soft_cap": from_units(soft_cap_units),
         "contribution_deadline": str(pool["contribution_deadline"]),
-        "exchange_deadline": str(pool["exchange_deadline"])
+        "exchange_deadline": str(pool["exchange_deadline"]),
+        "pledge_mode": pledge_mode,
+        "sequence": pool_sequence
     })
     return pool_id
 
 @export
 def contribute(pool_id: str, amount: float): # amount is nominal
-    assert not reentrancyGuardActive.get(), "Crowdfund contract is busy, please try again."
-    reentrancyGuardActive.set(True)
+    acquire_pool_lock(pool_id)
 
     pool = pool_fund[pool_id]
     assert pool, 'pool does not exist'
+    token_contract_module = I.import_module(pool["pool_token"])
+    process_contribution(pool_id, pool, amount, token_contract_module)
+
+    release_pool_lock(pool_id)
+
+@export
+def contribute_many(contributions: list): # list of [pool_id, nominal_amount] pairs
+    assert len(contributions) > 0, 'no contributions supplied.'
+
+    # Import each pool token once per batch, no matter how many pools share it
+    token_modules = {}
+    for entry in contributions:
+        assert len(entry) == 2, 'each contribution must be a [pool_id, amount] pair.'
+        pool_id = entry[0]
+        amount = entry[1]
+
+        pool = pool_fund[pool_id]
+        assert pool, 'pool does not exist'
+        pool_token_contract_address = pool["pool_token"]
+        if pool_token_contract_address not in token_modules:
+            token_modules[pool_token_contract_address] = I.import_module(pool_token_contract_address)
+
+        acquire_pool_lock(pool_id)
+        process_contribution(pool_id, pool, amount, token_modules[pool_token_contract_address])
+        release_pool_lock(pool_id)
+
+def process_contribution(pool_id: str, pool: dict, amount: float, token_contract_module):
+    # Shared by contribute and contribute_many; caller holds the pool lock.
     assert now < pool["contribution_deadline"], 'contribution window closed.'
-    assert amount > decimal("0.0"), 'contribution amount must be positive.'
+    # Only whole base units are pulled, so the recorded position is exactly what was paid
+    scaled_amount = amount * BASE_UNITS
+    nominal_units = int(scaled_amount)
+    assert nominal_units > 0, 'contribution amount must be positive.'
+    if nominal_units != scaled_amount:
+        amount = from_units(nominal_units)
     # Check hard cap against total nominal contributions
-    assert pool["total_nominal_contributions"] + amount <= pool["hard_cap"], \
+    state = pool_state[pool_id]
+    assert state[2] + nominal_units <= pool["hard_cap"], \
         'contribution exceeds hard cap (nominal).'
 
-    pool_token_contract_address = pool["pool_token"] 
-    token_contract_module = I.import_module(pool_token_contract_address)
+    if pool.get("pledge_mode"):
+        # Nothing is transferred yet: collect_pledges pulls the pledge after the contribution deadline
+        funder = contributor[ctx.caller, pool_id]
+        pledged_units = nominal_units + (funder[0] if funder else 0)
+        assert pledge_is_covered(pool["pool_token"], token_contract_module, ctx.caller, from_units(pledged_units)), \
+            'allowance or balance does not cover the pledge.'
+        record_contribution(pool_id, pool, state, amount, nominal_units, 0)
+        return
+
+    actual_units = pull_pool_tokens(pool, token_contract_module, amount, nominal_units, ctx.caller)
+    # If a positive nominal amount was sent, but 0 actual tokens were added (e.g., 100% tax),
+    # this might be an undesirable state for the pool if not handled.
+    # For now, we allow it, but a pool creator might want to vet tokens.
+    # If actual_amount_added is 0 for a non-zero nominal contribution, this funder won't get any share later.
+    record_contribution(pool_id, pool, state, amount, nominal_units, actual_units)
+
+def pull_pool_tokens(pool: dict, token_contract_module, amount: float, units: int, main_account: str):
+    # Pulls `amount` pool tokens (`units` base units) from `main_account` and returns the base units
+    # that actually arrived. A received remainder finer than one base unit stays in the contract as dust.
+    if token_type[pool["pool_token"]] == "standard":
+        # Registered as standard: the full nominal amount arrives, no balance probing needed
+        token_contract_module.transfer_from(amount=amount, to=ctx.this, main_account=main_account)
+        return units
+
+    # The balance delta below is only meaningful if no other contribution of the same token
+    # can re-enter between the two reads
+    acquire_token_lock(pool["pool_token"])
 
     # --- Interaction Part 1: Check balance before transfer ---
     balance_before_transfer = token_contract_module.balance_of(ctx.this)
@@ -139,7 +279,7 @@ def contribute(pool_id: str, amount: float): # amount is nominal
     token_contract_module.transfer_from(
         amount=amount, # Nominal amount to transfer
         to=ctx.this, 
-        main_account=ctx.caller
+        main_account=main_account
     )
 
     # --- Interaction Part 3: Check balance after transfer to determine actual amount received ---
@@ -147,49 +287,114 @@ def contribute(pool_id: str, amount: float): # amount is nominal
     if balance_after_transfer is None:
          balance_after_transfer = decimal("0.0")
     
-    actual_amount_added_by_this_contribution = balance_after_transfer - balance_before_transfer
+    actual_amount_added = balance_after_transfer - balance_before_transfer
+    release_token_lock(pool["pool_token"])
     
     # It's possible for actual_amount_added to be <= amount (due to tax)
     # It should not be negative. It could be zero if tax is 100%.
-    assert actual_amount_added_by_this_contribution >= decimal("0.0"), \
+    assert actual_amount_added >= 0, \
         "Actual amount received cannot be negative."
-    # If a positive nominal amount was sent, but 0 actual tokens were added (e.g., 100% tax),
-    # this might be an undesirable state for the pool if not handled.
-    # For now, we allow it, but a pool creator might want to vet tokens.
-    # If actual_amount_added is 0 for a non-zero nominal contribution, this funder won't get any share later.
+    return int(actual_amount_added * BASE_UNITS) # to_units, inlined on the contribute path
 
+def pledge_is_covered(pool_token: str, token_contract_module, account: str, amount: float):
+    allowance_hash = allowance_layout[pool_token]
+    if not allowance_hash: # Unregistered since the pool was created
+        return False
+    allowances = ForeignHash(foreign_contract=pool_token, foreign_name=allowance_hash)
+    allowance = allowances[account, ctx.this] or decimal("0.0")
+    balance = token_contract_module.balance_of(account) or decimal("0.0")
+    return allowance >= amount and balance >= amount
+
+def record_contribution(pool_id: str, pool: dict, state: list, amount: float, nominal_units: int, actual_units: int):
     # --- EFFECTS (AFTER INTERACTIONS) ---
-    pool["amount_received"] += actual_amount_added_by_this_contribution # Tracks sum of actual tokens
-    pool["total_nominal_contributions"] += amount # Tracks sum of nominal amounts
-    pool_fund[pool_id] = pool
+    state[1] += actual_units # Tracks sum of actual tokens
+    state[2] += nominal_units # Tracks sum of nominal amounts
+    pool_state[pool_id] = state
 
     funder = contributor[ctx.caller, pool_id]
     if funder:
-        funder["amount_contributed"] += amount # Nominal amount
-        funder["actual_amount_added"] += actual_amount_added_by_this_contribution
+        funder = [funder[0] + nominal_units, funder[1] + actual_units]
     else:
-        funder = {
-            "amount_contributed": amount, # Nominal
-            "actual_amount_added": actual_amount_added_by_this_contribution,
-            "share_withdrawn": False
-        }
+        funder = [nominal_units, actual_units]
+        contributor_index = pool_contributor_count[pool_id]
+        pool_contributors[pool_id, contributor_index] = ctx.caller
+        pool_contributor_count[pool_id] = contributor_index + 1
     contributor[ctx.caller, pool_id] = funder
 
+    # from_units inlined for the totals: every contribution pays for them
     Contribution({
         "pool_id": pool_id,
         "contributor": ctx.caller,
         "nominal_amount": amount,
-        "actual_amount_added": actual_amount_added_by_this_contribution,
-        "total_actual_pool_tokens": pool["amount_received"],
-        "total_nominal_pool_contributions": pool["total_nominal_contributions"]
+        "actual_amount_added": amount if actual_units == nominal_units else from_units(actual_units),
+        "total_actual_pool_tokens": decimal(state[1]) / BASE_UNITS,
+        "total_nominal_pool_contributions": decimal(state[2]) / BASE_UNITS
     })
 
-    reentrancyGuardActive.set(False)
+@export
+def collect_pledges(pool_id: str, limit: int):
+    # Pulls the pledges of a pledge-mode pool from up to `limit` contributors, resuming from the
+    # pool's pledge cursor. Pledges no longer covered by allowance and balance are dropped.
+    # Returns the number of contributors left to visit; the pool can be listed once it is 0.
+    acquire_pool_lock(pool_id)
+
+    pool = pool_fund[pool_id]
+    assert pool, 'pool does not exist'
+    assert pool.get("pledge_mode"), 'pool does not take pledges.'
+    assert ctx.caller == pool['pool_creator'] or ctx.caller == metadata['operator'], \
+        'Only pool creator or operator can collect pledges.'
+    assert limit > 0, 'limit must be positive.'
+    assert now > pool["contribution_deadline"], 'Cannot collect pledges before contribution deadline.'
+    assert now < pool["exchange_deadline"], 'Exchange window has passed for OTC listing.'
+    state = pool_state[pool_id]
+    assert state[2] >= pool["soft_cap"], \
+        'Soft cap not met (nominal), pledges are not collected.'
+
+    token_contract_module = I.import_module(pool["pool_token"])
+    PledgeCollected = LogEvent(
+        event="pledge_collected",
+        params={
+            "pool_id":{'type':str, 'idx':True},
+            "contributor": {'type':str, 'idx':True},
+            "nominal_amount": {'type':(int, float, decimal)},
+            "actual_amount_added": {'type':(int, float, decimal)}
+        })
+    ContributionWithdrawn = contribution_withdrawn_event()
+    cursor = pledge_cursor[pool_id]
+    contributors_in_pool = pool_contributor_count[pool_id]
+    page_end = min(cursor + limit, contributors_in_pool)
+    # Past the contribution deadline nobody can withdraw until the pool fails, so the page is stable
+    pledge_cursor[pool_id] = page_end
+
+    for index in range(cursor, page_end):
+        account = pool_contributors[pool_id, index]
+        funder = contributor[account, pool_id]
+        if not funder or funder[0] <= 0:
+            continue
+        nominal_amount = from_units(funder[0])
+        if not pledge_is_covered(pool["pool_token"], token_contract_module, account, nominal_amount):
+            contributor[account, pool_id] = None
+            state[2] -= funder[0]
+            ContributionWithdrawn({"pool_id": pool_id, "contributor": account, "nominal_amount": nominal_amount, "refunded_amount": 0})
+            continue
+
+        actual_units = pull_pool_tokens(pool, token_contract_module, nominal_amount, funder[0], account)
+        contributor[account, pool_id] = [funder[0], actual_units]
+        state[1] += actual_units
+        PledgeCollected({
+            "pool_id": pool_id,
+            "contributor": account,
+            "nominal_amount": nominal_amount,
+            "actual_amount_added": nominal_amount if actual_units == funder[0] else from_units(actual_units)
+        })
+
+    pool_state[pool_id] = state
+    release_pool_lock(pool_id)
+    return contributors_in_pool - page_end
 
 @export
 def list_pooled_funds_on_otc(pool_id: str, otc_take_token: str, otc_total_take_amount: float):
-    assert not reentrancyGuardActive.get(), "Crowdfund contract is busy, please try again."
-    reentrancyGuardActive.set(True)
+    acquire_pool_lock(pool_id)
 
     pool = pool_fund[pool_id]
     assert pool, 'pool does not exist'
@@ -197,35 +402,41 @@ def list_pooled_funds_on_otc(pool_id: str, otc_take_token: str, otc_total_take_a
     assert now > pool["contribution_deadline"], 'Cannot list on OTC before contribution deadline.'
     assert now < pool["exchange_deadline"], 'Exchange window has passed for OTC listing.'
     # Soft cap check is against total nominal contributions
-    assert pool["total_nominal_contributions"] >= pool["soft_cap"], \
+    state = pool_state[pool_id]
+    assert state[2] >= pool["soft_cap"], \
         'Soft cap not met (nominal), cannot proceed to OTC.'
+    if pool.get("pledge_mode"):
+        assert pledge_cursor[pool_id] == pool_contributor_count[pool_id], \
+            'Pledges must be collected with collect_pledges() before listing.'
     # Ensure there are actual tokens to list
-    assert pool["amount_received"] > decimal("0.0"), \
+    listed_units = state[1]
+    amount_to_list_on_otc = from_units(listed_units)
+    assert listed_units > 0, \
         'No actual pool tokens available to list (possibly due to 100% tax on all contributions).'
         
     assert pool["otc_listing_id"] is None, 'OTC deal already initiated for this pool.'
     assert otc_total_take_amount > decimal("0.0"), "OTC take amount must be positive."
 
-    take_token_contract = I.import_module(otc_take_token)
-    assert I.enforce_interface(take_token_contract, token_interface), 'otc_take_token contract not XSC001-compliant'
+    verify_token_interface(otc_take_token, 'otc_take_token contract not XSC001-compliant')
 
     otc_contract = I.import_module(metadata['otc_contract'])
     pool_token_contract = I.import_module(pool["pool_token"])
     
     # Approve OTC contract to spend the *actual* amount of pool_tokens the contract holds for this pool
-    # The `pool["amount_received"]` now correctly reflects the actual (post-tax) sum.
-    amount_to_list_on_otc = pool['amount_received']
+    # The pool's amount_received now correctly reflects the actual (post-tax) sum.
     pool_token_contract.approve(amount=amount_to_list_on_otc, to=metadata['otc_contract'])
     
     otc_fee_foreign = ForeignVariable(foreign_contract=metadata['otc_contract'], foreign_name='fee')
     current_otc_fee_percent = otc_fee_foreign.get()
     
-    denominator = decimal('1.0') + current_otc_fee_percent / decimal('100.0')
-    assert denominator != decimal('0.0'), "Cannot calculate offer amount with current fee yielding a zero divisor."
+    # The offer plus the OTC maker fee must fit in the listed amount: listed * 100 / (100 + fee), floored
+    denominator = 100 * BASE_UNITS + to_units(current_otc_fee_percent)
+    assert denominator != 0, "Cannot calculate offer amount with current fee yielding a zero divisor."
     
     # Calculate net offer amount using the actual tokens available
-    net_offer_amount_for_otc = amount_to_list_on_otc / denominator
-    assert net_offer_amount_for_otc > decimal("0.0"), "Calculated net offer amount for OTC is not positive."
+    net_offer_units = listed_units * 100 * BASE_UNITS // denominator
+    assert net_offer_units > 0, "Calculated net offer amount for OTC is not positive."
+    net_offer_amount_for_otc = from_units(net_offer_units)
 
     listing_id = otc_contract.list_offer(
         offer_token=pool["pool_token"],
@@ -237,8 +448,8 @@ def list_pooled_funds_on_otc(pool_id: str, otc_take_token: str, otc_total_take_a
 
     pool["otc_listing_id"] = listing_id
     pool["otc_take_token"] = otc_take_token
-    pool["status"] = "OTC_LISTED"
     pool_fund[pool_id] = pool
+    set_pool_status(pool_id, pool, "OTC_LISTED")
     
     otc_deal_info[pool_id] = {
         "listing_id": listing_id,
@@ -256,7 +467,7 @@ def list_pooled_funds_on_otc(pool_id: str, otc_take_token: str, otc_total_take_a
         "otc_total_take_amount": otc_total_take_amount
     })
     
-    reentrancyGuardActive.set(False)
+    release_pool_lock(pool_id)
     return listing_id
 
 @export
@@ -264,56 +475,460 @@ def cancel_otc_listing_for_pool(pool_id: str):
     # This function's internal logic largely remains the same,
     # as it primarily interacts with the OTC contract based on listing_id.
     # The key is that the OTC listing was created with the correct (actual) amount.
-    assert not reentrancyGuardActive.get(), "Crowdfund contract is busy, please try again."
-    reentrancyGuardActive.set(True)
+    acquire_pool_lock(pool_id)
 
     pool = pool_fund[pool_id]
     assert pool, "Pool does not exist."
     assert ctx.caller == pool['pool_creator'] or ctx.caller == metadata['operator'], \
         "Only pool creator or operator can cancel the OTC listing."
-    assert pool['otc_listing_id'], "No OTC listing ID found for this pool to cancel."
-    assert pool['status'] == "OTC_LISTED" or \
-           (pool['status'] == "OTC_FAILED" and now > pool['exchange_deadline']), \
+    otc_listing_id = pool["otc_listing_id"]
+    current_status = pool_state[pool_id][0]
+    assert otc_listing_id, "No OTC listing ID found for this pool to cancel."
+    assert current_status == "OTC_LISTED" or \
+           (current_status == "OTC_FAILED" and now > pool['exchange_deadline']), \
            "Pool not in a state suitable for OTC cancellation via this function, or OTC listing might not be active."
 
     otc_listings_foreign = ForeignHash(foreign_contract=metadata['otc_contract'], foreign_name='otc_listing')
-    otc_offer_details = otc_listings_foreign[pool["otc_listing_id"]]
+    otc_offer_details = otc_listings_foreign[otc_listing_id]
     assert otc_offer_details, "OTC listing details not found on the exchange contract."
     assert otc_offer_details["status"] == "OPEN", \
         f"OTC offer is not OPEN (current status: {otc_offer_details['status']}). Cannot cancel via crowdfund if already finalized on OTC."
 
     otc_contract = I.import_module(metadata['otc_contract'])
-    otc_contract.cancel_offer(listing_id=pool['otc_listing_id'])
+    otc_contract.cancel_offer(listing_id=otc_listing_id)
 
-    pool['status'] = "OTC_FAILED"
-    pool_fund[pool_id] = pool
+    set_pool_status(pool_id, pool, "OTC_FAILED")
 
     deal_info = otc_deal_info[pool_id]
     if deal_info:
         deal_info["status"] = "CANCELLED"
         otc_deal_info[pool_id] = deal_info
 
-    CancelledListing({"otc_listing_id": pool['otc_listing_id'], "pool_id": pool_id})
-    reentrancyGuardActive.set(False)
+    CancelledListing({"otc_listing_id": otc_listing_id, "pool_id": pool_id})
+    release_pool_lock(pool_id)
+
+@export
+def amend_otc_listing_for_pool(pool_id: str, new_take_amount: float):
+    # Reprices the unfilled part of the pool's OTC listing in place, without cancelling and re-listing
+    acquire_pool_lock(pool_id)
+
+    pool = pool_fund[pool_id]
+    assert pool, 'pool does not exist'
+    assert ctx.caller == pool["pool_creator"], 'Only pool creator can amend the OTC listing.'
+    assert pool_state[pool_id][0] == "OTC_LISTED", 'Pool has no active OTC listing to amend.'
+    assert now < pool["exchange_deadline"], 'Exchange window has passed for OTC listing.'
+    assert new_take_amount > decimal("0.0"), "OTC take amount must be positive."
+
+    otc_listing_id = pool["otc_listing_id"]
+    otc_contract = I.import_module(metadata['otc_contract'])
+    otc_contract.amend_offer(listing_id=otc_listing_id, new_take_amount=new_take_amount)
+
+    deal_info = otc_deal_info[pool_id]
+    if deal_info:
+        # target_take_amount stays the listing total, including what was already filled
+        otc_listings_foreign = ForeignHash(foreign_contract=metadata['otc_contract'], foreign_name='otc_listing')
+        deal_info["target_take_amount"] = otc_listings_foreign[otc_listing_id]["take_amount"]
+        deal_info["remaining_take_amount"] = new_take_amount
+        otc_deal_info[pool_id] = deal_info
+
+    ListingAmended = LogEvent(
+        event="listing_amended",
+        params={
+            "otc_listing_id":{'type':str, 'idx':True},
+            "pool_id": {'type':str, 'idx':True},
+            "otc_remaining_take_amount": {'type':(int, float, decimal)}
+        })
+    ListingAmended({"otc_listing_id": otc_listing_id, "pool_id": pool_id, "otc_remaining_take_amount": new_take_amount})
+
+    release_pool_lock(pool_id)
 
 @export
 def withdraw_contribution(pool_id: str):
-    assert not reentrancyGuardActive.get(), "Crowdfund contract is busy, please try again."
-    reentrancyGuardActive.set(True)
+    acquire_pool_lock(pool_id)
+
+    pool = pool_fund[pool_id]
+    assert pool, 'pool does not exist'
+    amount_to_refund_to_user = claim_refund(pool_id, pool, None, ctx.caller)
+
+    # --- INTERACTION ---
+    if amount_to_refund_to_user > 0:
+        pool_token_contract_module = I.import_module(pool["pool_token"])
+        pool_token_contract_module.transfer(
+            amount=from_units(amount_to_refund_to_user),
+            to=ctx.caller
+        )
+
+    release_pool_lock(pool_id)
+
+@export
+def withdraw_share(pool_id: str):
+    acquire_pool_lock(pool_id)
+
+    share = claim_share(pool_id, None, ctx.caller)
+
+    if share[1] > 0:
+        token_contract_module = I.import_module(share[0])
+        token_contract_module.transfer(
+            amount=from_units(share[1]),
+            to=ctx.caller
+        )
+    if share[3] > 0: # Unfilled part of a partially filled listing
+        pool_token_contract_module = I.import_module(share[2])
+        pool_token_contract_module.transfer(
+            amount=from_units(share[3]),
+            to=ctx.caller
+        )
+    
+    release_pool_lock(pool_id)
+
+@export
+def claim_all(pool_ids: list):
+    # Claims the share (executed OTC deal) or the refund (everything else) for each pool,
+    # then pays out with a single transfer per distinct take/pool token.
+    assert len(pool_ids) > 0, 'no pools supplied.'
+
+    otc_listings_foreign = ForeignHash(foreign_contract=metadata['otc_contract'], foreign_name='otc_listing')
+    payouts = {} # token contract -> total base units owed to the caller
+    locked_pool_ids = [] # Pools stay locked until the netted transfers below are done
+
+    for pool_id in pool_ids:
+        state = pool_state[pool_id]
+        assert state, 'pool does not exist'
+        current_status = state[0]
+        if pool_id not in locked_pool_ids:
+            acquire_pool_lock(pool_id)
+            locked_pool_ids.append(pool_id)
+
+        # OTC_EXECUTED is final, so the exchange only needs to be consulted for unresolved listings
+        otc_offer_details = None
+        if current_status != "OTC_EXECUTED":
+            otc_listing_id = pool_fund[pool_id]["otc_listing_id"]
+            if otc_listing_id:
+                otc_offer_details = otc_listings_foreign[otc_listing_id]
+
+        if current_status == "OTC_EXECUTED" or \
+           (otc_offer_details and otc_offer_details["status"] == "EXECUTED") or \
+           listing_has_fills(otc_offer_details):
+            share = claim_share(pool_id, otc_offer_details, ctx.caller)
+            add_payout(payouts, share[0], share[1])
+            add_payout(payouts, share[2], share[3])
+        else:
+            pool = pool_fund[pool_id]
+            add_payout(payouts, pool["pool_token"], claim_refund(pool_id, pool, otc_offer_details, ctx.caller))
+
+    # --- INTERACTIONS: one transfer per token ---
+    for payout_token, payout_amount in payouts.items():
+        token_contract_module = I.import_module(payout_token)
+        token_contract_module.transfer(
+            amount=from_units(payout_amount),
+            to=ctx.caller
+        )
+
+    for pool_id in locked_pool_ids:
+        release_pool_lock(pool_id)
+
+@export
+def sweep_expired(limit: int):
+    # Keeper entry point: walks the expiry buckets of days that have fully ended, closing each pool
+    # still waiting on its exchange window. Visits at most `limit` bucket entries or empty days and
+    # resumes from a stored cursor. Returns the number of pools closed.
+    assert limit > 0, 'limit must be positive.'
+
+    cursor = expiry_bucket["cursor"]
+    if not cursor:
+        return 0
+    day = cursor[0]
+    index = cursor[1]
+    steps = 0
+    pools_closed = 0
+    while steps < limit and day + datetime.DAYS <= now:
+        day_key = expiry_day_key(day)
+        if index < expiry_bucket[day_key]:
+            pool_id = expiry_bucket[day_key, index]
+            if pool_id and close_expired_pool(pool_id):
+                pools_closed += 1
+            expiry_bucket[day_key, index] = None # The sweep never needs an entry twice
+            index += 1
+        else:
+            expiry_bucket[day_key] = None
+            day = day + datetime.DAYS
+            index = 0
+        steps += 1
+
+    expiry_bucket["cursor"] = [day, index]
+    return pools_closed
+
+@export
+def settle_pool(pool_id: str):
+    # One-time settlement of an executed pool. Anyone may call it; withdraw_share, claim_all
+    # and push_shares settle the pool themselves if nobody has done so yet.
+    acquire_pool_lock(pool_id)
+
+    state = pool_state[pool_id]
+    assert state, 'pool does not exist'
+    assert state[0] != "OTC_EXECUTED", 'pool already settled.'
+    settlement = resolve_share_payout(pool_id, None)
+
+    release_pool_lock(pool_id)
+    return from_rate_units(settlement[1])
+
+@export
+def push_shares(pool_id: str, limit: int):
+    # Pays the take-token share of an executed pool to up to `limit` contributors,
+    # resuming from the pool's settlement cursor. Returns the number of contributors left to visit.
+    acquire_pool_lock(pool_id)
+
+    pool = pool_fund[pool_id]
+    assert pool, 'pool does not exist'
+    assert ctx.caller == pool['pool_creator'] or ctx.caller == metadata['operator'], \
+        'Only pool creator or operator can push settlement.'
+    assert limit > 0, 'limit must be positive.'
+
+    settlement = resolve_share_payout(pool_id, None)
+
+    token_contract_module = I.import_module(settlement[0])
+    pool_token_contract_module = I.import_module(pool["pool_token"])
+    remaining = push_settlement_page(pool_id, limit, token_contract_module, pool_token_contract_module, settlement)
+
+    release_pool_lock(pool_id)
+    return remaining
+
+@export
+def push_refunds(pool_id: str, limit: int):
+    # Refunds the contributions of a failed pool to up to `limit` contributors,
+    # resuming from the pool's settlement cursor. Returns the number of contributors left to visit.
+    acquire_pool_lock(pool_id)
 
     pool = pool_fund[pool_id]
-    funder_record = contributor[ctx.caller, pool_id] # Renamed for clarity
+    assert pool, 'pool does not exist'
+    assert ctx.caller == pool['pool_creator'] or ctx.caller == metadata['operator'], \
+        'Only pool creator or operator can push settlement.'
+    assert limit > 0, 'limit must be positive.'
+
+    resolve_refund_window(pool_id, pool, None)
+    assert pool_state[pool_id][0] in ["OTC_FAILED", "REFUNDING"], \
+        'Refunds can only be pushed once the pool has failed.'
+
+    token_contract_module = I.import_module(pool["pool_token"])
+    remaining = push_settlement_page(pool_id, limit, token_contract_module, token_contract_module, None)
+
+    release_pool_lock(pool_id)
+    return remaining
 
+@export
+def archive_pool(pool_id: str, limit: int):
+    # Deletes a finished pool once every contributor has claimed or been refunded, together with
+    # its OTC listing. The final numbers survive only in the pool_archived event. Claims keep no
+    # count, so up to `limit` contributors are checked per call, moving the settlement cursor
+    # past them. Returns the number of contributors left to check; the pool is archived once it is 0.
+    acquire_pool_lock(pool_id)
+
+    pool = pool_fund[pool_id]
     assert pool, 'pool does not exist'
-    assert funder_record and funder_record["amount_contributed"] > decimal("0.0"), \
+    assert ctx.caller == pool['pool_creator'] or ctx.caller == metadata['operator'], \
+        'Only pool creator or operator can archive the pool.'
+    assert limit > 0, 'limit must be positive.'
+    state = pool_state[pool_id]
+    current_status = state[0]
+    assert current_status in ["OTC_EXECUTED", "OTC_FAILED", "REFUNDING"], \
+        'Only executed or failed pools can be archived.'
+
+    cursor = settlement_cursor[pool_id]
+    contributors_in_pool = pool_contributor_count[pool_id]
+    page_end = min(cursor + limit, contributors_in_pool)
+    for index in range(cursor, page_end):
+        funder = contributor[pool_contributors[pool_id, index], pool_id]
+        assert not funder or funder[0] <= 0, \
+            'Every contributor must have claimed or been refunded before archiving.'
+    if page_end < contributors_in_pool:
+        settlement_cursor[pool_id] = page_end
+        release_pool_lock(pool_id)
+        return contributors_in_pool - page_end
+
+    otc_listing_id = pool["otc_listing_id"]
+    if otc_listing_id:
+        otc_listings_foreign = ForeignHash(foreign_contract=metadata['otc_contract'], foreign_name='otc_listing')
+        otc_offer_details = otc_listings_foreign[otc_listing_id]
+        if otc_offer_details:
+            # The pool is the maker, so its listing can only be archived from here
+            assert otc_offer_details["status"] != "OPEN", 'OTC listing is still open.'
+            otc_contract = I.import_module(metadata['otc_contract'])
+            otc_contract.archive_listing(listing_id=otc_listing_id)
+
+    received_pool_units = state[1]
+    settlement = pool_settlement[pool_id] or [None, 0, None, 0, 0]
+    if settlement[3] > 0:
+        # The unsold part of a partially filled listing was handed back with the shares
+        token_stats[pool["pool_token"], "value_locked", pool_id[0]] -= received_pool_units * settlement[3] // RATE_UNITS
+
+    PoolArchived = LogEvent(
+        event="pool_archived",
+        params={
+            "pool_id":{'type':str, 'idx':True},
+            "status": {'type':str, 'idx':False},
+            "pool_token": {'type':str, 'idx':False},
+            "total_nominal_contributions": {'type':(int, float, decimal)},
+            "amount_received": {'type':(int, float, decimal)},
+            "contributor_count": {'type':int},
+            "otc_listing_id": {'type':str, 'idx':False},
+            "otc_take_token": {'type':str, 'idx':False},
+            "otc_actual_received_amount": {'type':(int, float, decimal)},
+            "payout_rate": {'type':(int, float, decimal)},
+            "unfilled_fraction": {'type':(int, float, decimal)}
+        })
+    PoolArchived({
+        "pool_id": pool_id,
+        "status": current_status,
+        "pool_token": pool["pool_token"],
+        "total_nominal_contributions": from_units(state[2]),
+        "amount_received": from_units(received_pool_units),
+        "contributor_count": contributors_in_pool,
+        "otc_listing_id": str(otc_listing_id),
+        "otc_take_token": str(pool["otc_take_token"]),
+        "otc_actual_received_amount": from_units(settlement[4]),
+        "payout_rate": from_rate_units(settlement[1]),
+        "unfilled_fraction": from_rate_units(settlement[3])
+    })
+
+    # Counted and announced like any other transition, then deleted with the rest of the pool
+    set_pool_status(pool_id, pool, "ARCHIVED")
+    pool_fund[pool_id] = None
+    pool_state[pool_id] = None
+    pool_settlement[pool_id] = None
+    otc_deal_info[pool_id] = None
+    settlement_cursor[pool_id] = None
+    pledge_cursor[pool_id] = None
+    # The contributor index and any zeroed placeholders are left to prune_archived_pool
+
+    release_pool_lock(pool_id)
+    return 0
+
+@export
+def prune_archived_pool(pool_id: str, limit: int):
+    # Deletes up to `limit` entries of an archived pool's contributor index, last first, together with
+    # the zeroed position a withdrawal before the deadline may have left. Anyone may call it, since an
+    # archived pool holds nothing of value. Returns the number of entries left to prune.
+    assert limit > 0, 'limit must be positive.'
+    assert pool_fund[pool_id] is None, 'Only archived pools can be pruned.'
+    contributors_in_pool = pool_contributor_count[pool_id]
+    assert contributors_in_pool > 0, 'Nothing left to prune for this pool.'
+
+    page_start = max(contributors_in_pool - limit, 0)
+    for index in range(contributors_in_pool - 1, page_start - 1, -1):
+        account = pool_contributors[pool_id, index]
+        if contributor[account, pool_id] is not None:
+            contributor[account, pool_id] = None
+        pool_contributors[pool_id, index] = None
+    pool_contributor_count[pool_id] = page_start if page_start > 0 else None
+    return page_start
+
+def push_settlement_page(pool_id: str, limit: int, token_contract_module, pool_token_contract_module, settlement: list):
+    # Walks pool_contributors from the stored cursor, skipping contributors who already
+    # claimed or were refunded. Pays shares when the `settlement` record is given (plus the pool tokens
+    # of an unfilled remainder), or refunds when it is None. The pool must already be resolved by the caller.
+    cursor = settlement_cursor[pool_id]
+    contributors_in_pool = pool_contributor_count[pool_id]
+    page_end = min(cursor + limit, contributors_in_pool)
+
+    payouts = []
+    unfilled_payouts = [] # Pool tokens returned alongside shares of a partially filled listing
+    refunded_actual = 0
+    refunded_nominal = 0
+    for index in range(cursor, page_end):
+        account = pool_contributors[pool_id, index]
+        funder_record = contributor[account, pool_id]
+        if not funder_record:
+            continue # Already claimed or refunded
+        if funder_record[0] <= 0:
+            contributor[account, pool_id] = None # Drop the leftover of a withdrawal made before the deadline
+            continue
+        if settlement is not None:
+            share = release_share(pool_id, account, funder_record, settlement)
+            payout_amount = share[1]
+            if share[3] > 0:
+                unfilled_payouts.append([account, share[3]])
+        else:
+            refunded_nominal += funder_record[0]
+            # Refunds are only pushed for failed pools, which are past their contribution deadline
+            payout_amount = release_refund(pool_id, account, funder_record, False)
+            refunded_actual += payout_amount
+        if payout_amount > 0:
+            payouts.append([account, payout_amount])
+
+    # --- EFFECTS before INTERACTIONS ---
+    settlement_cursor[pool_id] = page_end
+    if settlement is None:
+        state = pool_state[pool_id]
+        state[1] -= refunded_actual
+        state[2] -= refunded_nominal
+        pool_state[pool_id] = state
+
+    for payout in payouts:
+        token_contract_module.transfer(
+            amount=from_units(payout[1]),
+            to=payout[0]
+        )
+    for payout in unfilled_payouts:
+        pool_token_contract_module.transfer(
+            amount=from_units(payout[1]),
+            to=payout[0]
+        )
+
+    return contributors_in_pool - page_end
+
+def claim_refund(pool_id: str, pool: dict, otc_offer_details: dict, account: str):
+    # Checks and effects of a contribution refund for `account`. Returns the pool_token base units
+    # owed; the caller holds the pool lock and performs the transfer.
+    funder_record = contributor[account, pool_id] # Renamed for clarity
+
+    assert funder_record and funder_record[0] > 0, \
         'no contribution to withdraw or already withdrawn (nominal check).'
-    # Check if there's actual amount to withdraw for this funder
-    assert funder_record["actual_amount_added"] >= decimal("0.0"), \
-        'funder has no actual amount recorded to withdraw.'
-        
+
+    resolve_refund_window(pool_id, pool, otc_offer_details)
+
+    nominal_amount_being_withdrawn = funder_record[0]
+    pool_is_open = now < pool["contribution_deadline"]
+    amount_to_refund_to_user = release_refund(pool_id, account, funder_record, pool_is_open)
+    state = pool_state[pool_id]
+    state[1] -= amount_to_refund_to_user # Decrease actual sum
+    state[2] -= nominal_amount_being_withdrawn # Decrease nominal sum
+    pool_state[pool_id] = state
+
+    # Only a withdrawal from an open pool needs an event. Once a pool has failed, its status change
+    # already tells an indexer that every remaining position is refunded as recorded.
+    if pool_is_open:
+        ContributionWithdrawn = contribution_withdrawn_event()
+        ContributionWithdrawn({
+            "pool_id": pool_id,
+            "contributor": account,
+            "nominal_amount": from_units(nominal_amount_being_withdrawn),
+            "refunded_amount": from_units(amount_to_refund_to_user)
+        })
+
+    return amount_to_refund_to_user
+
+def contribution_withdrawn_event():
+    # Shared by withdrawals before the contribution deadline and dropped pledges (refunded_amount 0)
+    ContributionWithdrawn = LogEvent(
+        event="contribution_withdrawn",
+        params={
+            "pool_id":{'type':str, 'idx':True},
+            "contributor": {'type':str, 'idx':True},
+            "nominal_amount": {'type':(int, float, decimal)}, # Taken out of the pool's nominal total
+            "refunded_amount": {'type':(int, float, decimal)} # Actual pool tokens returned, taken out of the actual total
+        })
+    return ContributionWithdrawn
+
+def resolve_refund_window(pool_id: str, pool: dict, otc_offer_details: dict):
+    # Asserts that contributions of the pool may be refunded right now and moves the pool
+    # (and its OTC deal info) to the matching failure status.
+    state = pool_state[pool_id]
+    current_status = state[0]
+    otc_listing_id = pool["otc_listing_id"]
+
     can_withdraw = False
     otc_listing_failed_or_expired = False
-    new_pool_status_for_effect = pool["status"] 
+    new_pool_status_for_effect = current_status 
     auto_cancelled_otc_in_this_tx = False
 
     if now < pool["contribution_deadline"]:
@@ -324,24 +939,27 @@ def withdraw_contribution(pool_id: str):
         
         # Check if soft cap (nominal) was met if we are past contribution deadline
         # and no OTC listing was attempted or relevant.
-        if not pool["otc_listing_id"] and pool["total_nominal_contributions"] < pool["soft_cap"]:
+        if not otc_listing_id and state[2] < pool["soft_cap"]:
              otc_listing_failed_or_expired = True # Treat as a form of failure allowing withdrawal
              if new_pool_status_for_effect != "REFUNDING": # A more specific status might be "REFUNDING_SOFT_CAP_FAIL"
                  new_pool_status_for_effect = "REFUNDING" # Or "OTC_FAILED" if preferred generic term
         
-        elif pool["otc_listing_id"]:
+        elif otc_listing_id:
             otc_contract_address = metadata['otc_contract']
-            otc_contract = I.import_module(otc_contract_address)
-            otc_listings_foreign = ForeignHash(foreign_contract=otc_contract_address, foreign_name='otc_listing')
-            otc_offer_details = otc_listings_foreign[pool["otc_listing_id"]]
+            if otc_offer_details is None:
+                otc_listings_foreign = ForeignHash(foreign_contract=otc_contract_address, foreign_name='otc_listing')
+                otc_offer_details = otc_listings_foreign[otc_listing_id]
 
             if otc_offer_details:
+                assert otc_offer_details["status"] == "EXECUTED" or not listing_has_fills(otc_offer_details), \
+                    "OTC deal was partially filled. Use withdraw_share() instead."
                 if otc_offer_details["status"] == "CANCELLED":
                     otc_listing_failed_or_expired = True
                     if new_pool_status_for_effect != "OTC_FAILED":
                         new_pool_status_for_effect = "OTC_FAILED"
                 elif otc_offer_details["status"] == "OPEN" and now > pool["exchange_deadline"]:
-                    otc_contract.cancel_offer(listing_id=pool["otc_listing_id"])
+                    otc_contract = I.import_module(otc_contract_address)
+                    otc_contract.cancel_offer(listing_id=otc_listing_id)
                     auto_cancelled_otc_in_this_tx = True
                     otc_listing_failed_or_expired = True
                     new_pool_status_for_effect = "OTC_FAILED" 
@@ -353,121 +971,342 @@ def withdraw_contribution(pool_id: str):
                     if new_pool_status_for_effect != "OTC_FAILED":
                          new_pool_status_for_effect = "OTC_FAILED"
         
-        elif not pool["otc_listing_id"] and now > pool["exchange_deadline"]: # Creator never listed, and all windows passed
+        elif not otc_listing_id and now > pool["exchange_deadline"]: # Creator never listed, and all windows passed
             otc_listing_failed_or_expired = True
             if new_pool_status_for_effect not in ["OTC_FAILED", "REFUNDING"]:
                  new_pool_status_for_effect = "OTC_FAILED" # Or REFUNDING
 
     if otc_listing_failed_or_expired:
         can_withdraw = True
-        if pool["status"] not in ["OTC_FAILED", "REFUNDING"] and \
-           new_pool_status_for_effect != pool["status"]:
+        if current_status not in ["OTC_FAILED", "REFUNDING"] and \
+           new_pool_status_for_effect != current_status:
             pass # new_pool_status_for_effect is already set
-        elif pool["status"] not in ["OTC_FAILED", "REFUNDING"]: # If status wasn't changed by specific logic above
+        elif current_status not in ["OTC_FAILED", "REFUNDING"]: # If status wasn't changed by specific logic above
             new_pool_status_for_effect = "OTC_FAILED" # Default to OTC_FAILED
 
     assert can_withdraw, 'Withdrawal not allowed at this stage.'
 
-    # Amount to refund is the actual amount this funder's contribution added to the pool
-    amount_to_refund_to_user = funder_record["actual_amount_added"]
-    nominal_amount_being_withdrawn = funder_record["amount_contributed"]
-
-    # If amount_to_refund_to_user is 0 (e.g., 100% tax and they were the only one, or their part was 0),
-    # then no tokens are transferred, but state is cleaned up.
-    if amount_to_refund_to_user < decimal("0.0"): amount_to_refund_to_user = decimal("0.0") # Safety
-
     # --- EFFECTS ---
-    pool["amount_received"] -= amount_to_refund_to_user # Decrease actual sum
-    pool["total_nominal_contributions"] -= nominal_amount_being_withdrawn # Decrease nominal sum
+    if current_status != new_pool_status_for_effect: 
+        set_pool_status(pool_id, pool, new_pool_status_for_effect)
     
-    if pool["status"] != new_pool_status_for_effect: 
-        pool["status"] = new_pool_status_for_effect
-    pool_fund[pool_id] = pool
-    
-    if new_pool_status_for_effect == "OTC_FAILED" and pool["otc_listing_id"]:
+    if new_pool_status_for_effect == "OTC_FAILED" and otc_listing_id:
         deal_info = otc_deal_info[pool_id]
         if deal_info and deal_info.get("status") not in ["FAILED_OR_EXPIRED", "CANCELLED", "EXECUTED"]:
             if auto_cancelled_otc_in_this_tx: deal_info["status"] = "CANCELLED"
             else: deal_info["status"] = "FAILED_OR_EXPIRED" # Or check foreign for more precision
             otc_deal_info[pool_id] = deal_info
-            
-    funder_record["actual_amount_added"] = decimal("0.0") 
-    funder_record["amount_contributed"] = decimal("0.0") # Zero out nominal contribution as well
-    contributor[ctx.caller, pool_id] = funder_record
-    
-    # --- INTERACTION ---
-    if amount_to_refund_to_user > decimal("0.0"):
-        pool_token_contract_module = I.import_module(pool["pool_token"])
-        pool_token_contract_module.transfer(
-            amount=amount_to_refund_to_user,
-            to=ctx.caller
-        )
 
-    reentrancyGuardActive.set(False)
+def release_refund(pool_id: str, account: str, funder_record: list, keep_placeholder: bool):
+    # Closes `account`'s position and returns the refund in base units. The caller takes the
+    # position out of the pool totals, and passes keep_placeholder while the pool is still open.
+    # Amount to refund is the actual amount this funder's contribution added to the pool
+    amount_to_refund_to_user = funder_record[1]
 
-@export
-def withdraw_share(pool_id: str):
-    assert not reentrancyGuardActive.get(), "Crowdfund contract is busy, please try again."
-    reentrancyGuardActive.set(True)
+    # If amount_to_refund_to_user is 0 (e.g., 100% tax and they were the only one, or their part was 0),
+    # then no tokens are transferred, but state is cleaned up.
+    assert amount_to_refund_to_user >= 0, 'funder has no actual amount recorded to withdraw.'
 
-    pool = pool_fund[pool_id]
-    funder = contributor[ctx.caller, pool_id]
+    if keep_placeholder:
+        # The account stays in pool_contributors and may contribute again, so a zeroed
+        # position is kept to stop it from being indexed twice
+        contributor[account, pool_id] = [0, 0]
+    else:
+        contributor[account, pool_id] = None
 
-    assert pool, 'pool does not exist'
-    assert funder and funder["amount_contributed"] > decimal("0.0"), \
-        'no original nominal contribution to claim a share for.'
-    assert not funder["share_withdrawn"], 'share already withdrawn.'
-    assert pool["otc_listing_id"], "OTC deal was not initiated for this pool."
+    return amount_to_refund_to_user
+
+def claim_share(pool_id: str, otc_offer_details: dict, account: str):
+    # Checks and effects of a take-token share claim for `account`. Returns what is owed as
+    # [otc_take_token, take units, pool_token, pool units]; the caller holds the pool lock and
+    # performs the transfers.
+    funder = contributor[account, pool_id]
+
+    # Claimed positions are deleted, so a second claim fails here as well
+    assert funder and funder[0] > 0, \
+        'no original nominal contribution to claim a share for (or share already withdrawn).'
+
+    settlement = pool_settlement[pool_id]
+    if settlement is None:
+        settlement = resolve_share_payout(pool_id, otc_offer_details)
+    return release_share(pool_id, account, funder, settlement)
+
+def resolve_share_payout(pool_id: str, otc_offer_details: dict):
+    # Returns the pool's settlement record. The first call settles the pool: it asserts that the
+    # OTC deal was executed (fully, or partially and then closed) and freezes the payout rate and the
+    # unfilled fraction of the offer, so later claims never need to consult the OTC contract again.
+    settlement = pool_settlement[pool_id]
+    if settlement is not None:
+        return settlement
+
+    pool = pool_fund[pool_id]
+    otc_listing_id = pool["otc_listing_id"]
+    assert otc_listing_id, "OTC deal was not initiated for this pool."
     
     # Check total_nominal_contributions for share calculation
-    total_nominal_contributions_for_pool = pool["total_nominal_contributions"]
-    assert total_nominal_contributions_for_pool > decimal("0.0"), \
+    state = pool_state[pool_id]
+    total_nominal_units = state[2]
+    assert total_nominal_units > 0, \
         'Total nominal contributions for the pool is zero, cannot calculate share.'
 
     otc_listings_foreign = ForeignHash(foreign_contract=metadata['otc_contract'], foreign_name='otc_listing')
-    otc_offer_details = otc_listings_foreign[pool["otc_listing_id"]]
+    if otc_offer_details is None:
+        otc_offer_details = otc_listings_foreign[otc_listing_id]
     assert otc_offer_details, "OTC listing details not found on the exchange contract."
-    assert otc_offer_details["status"] == "EXECUTED", 'OTC deal not successfully executed on the exchange contract.'
 
-    if pool["status"] != "OTC_EXECUTED":
-        pool["status"] = "OTC_EXECUTED"
-        pool["otc_actual_received_amount"] = otc_offer_details["take_amount"] 
-        pool_fund[pool_id] = pool 
-        
-        deal_info = otc_deal_info[pool_id]
-        if deal_info: 
-            deal_info["status"] = "EXECUTED"
-            deal_info["actual_received_amount"] = pool["otc_actual_received_amount"]
-            otc_deal_info[pool_id] = deal_info
-    
-    actual_received_take_tokens_by_pool = pool["otc_actual_received_amount"]
-    
-    # Share calculation based on nominal contribution relative to total nominal contributions
-    numerator = funder["amount_contributed"] * actual_received_take_tokens_by_pool
-    amount_of_take_token_to_withdraw = numerator / total_nominal_contributions_for_pool
-    
-    assert amount_of_take_token_to_withdraw >= decimal("0.0"), "Calculated share is negative." # Can be 0 if funder's nominal was tiny or total take was tiny
+    if otc_offer_details["status"] == "OPEN" and listing_has_fills(otc_offer_details) and \
+       now > pool["exchange_deadline"]:
+        # Partially filled and the exchange window closed: take the unfilled remainder back
+        otc_contract = I.import_module(metadata['otc_contract'])
+        otc_contract.cancel_offer(listing_id=otc_listing_id)
+        otc_offer_details = otc_listings_foreign[otc_listing_id]
 
-    funder["share_withdrawn"] = True 
-    contributor[ctx.caller, pool_id] = funder
+    fully_filled = otc_offer_details["status"] == "EXECUTED"
+    assert fully_filled or (otc_offer_details["status"] == "CANCELLED" and listing_has_fills(otc_offer_details)), \
+        'OTC deal not successfully executed on the exchange contract.'
 
-    if amount_of_take_token_to_withdraw > decimal("0.0"):
-        token_contract_module = I.import_module(pool["otc_take_token"])
-        token_contract_module.transfer(
-            amount=amount_of_take_token_to_withdraw,
-            to=ctx.caller
-        )
+    received_units = to_units(otc_offer_details["take_amount_received"])
+    # Part of the offer that came back unsold from a partially filled listing
+    unfilled_offer_units = 0
+    if not fully_filled:
+        unfilled_offer_units = to_units(otc_offer_details["offer_amount"] - otc_offer_details["offer_amount_filled"])
+    settlement = [
+        pool["otc_take_token"],
+        received_units * RATE_UNITS // total_nominal_units, # Payout rate, per nominal unit contributed
+        pool["pool_token"],
+        unfilled_offer_units * RATE_UNITS // to_units(otc_offer_details["offer_amount"]), # Unfilled fraction, per actual unit added
+        received_units
+    ]
+
+    set_pool_status(pool_id, pool, "OTC_EXECUTED")
+    pool_settlement[pool_id] = settlement
+    # The take tokens are owed to the contributors from here on, and the sold part of the pool leaves
+    # the value locked. The unsold part is returned with the shares and leaves it when the pool is archived.
+    token_stats[settlement[0], "take_distributed", pool_id[0]] += received_units
+    received_pool_units = state[1]
+    token_stats[pool["pool_token"], "value_locked", pool_id[0]] -= received_pool_units - received_pool_units * settlement[3] // RATE_UNITS
+
+    actual_received_take_tokens_by_pool = from_units(received_units)
+    PoolSettled = LogEvent(
+        event="pool_settled",
+        params={
+            "pool_id":{'type':str, 'idx':True},
+            "otc_actual_received_amount": {'type':(int, float, decimal)},
+            "payout_rate": {'type':(int, float, decimal)},
+            "unfilled_fraction": {'type':(int, float, decimal)}
+        })
+    PoolSettled({
+        "pool_id": pool_id,
+        "otc_actual_received_amount": actual_received_take_tokens_by_pool,
+        "payout_rate": from_rate_units(settlement[1]),
+        "unfilled_fraction": from_rate_units(settlement[3])
+    })
     
-    reentrancyGuardActive.set(False)
+    deal_info = otc_deal_info[pool_id]
+    if deal_info: 
+        deal_info["status"] = "EXECUTED" if fully_filled else "PARTIALLY_EXECUTED"
+        deal_info["actual_received_amount"] = actual_received_take_tokens_by_pool
+        otc_deal_info[pool_id] = deal_info
+
+    return settlement
+
+def release_share(pool_id: str, account: str, funder: list, settlement: list):
+    # Deletes `account`'s position and returns what it is owed at the rates frozen in `settlement`,
+    # as [otc_take_token, take units, pool_token, pool units]. Unsold pool tokens are returned like a
+    # refund, in proportion to the actual amount added. Both are floored, so the shares can never
+    # add up to more than the pool received.
+    contributor[account, pool_id] = None
+    return [
+        settlement[0],
+        funder[0] * settlement[1] // RATE_UNITS,
+        settlement[2],
+        funder[1] * settlement[3] // RATE_UNITS
+    ]
+
+def listing_has_fills(otc_offer_details: dict):
+    # True once any part of an OTC listing was taken, so the pool owes shares rather than refunds
+    return bool(otc_offer_details) and otc_offer_details["take_amount_filled"] > decimal("0.0")
+
+def add_payout(payouts: dict, token: str, amount: int):
+    if amount > 0:
+        payouts[token] = payouts.get(token, 0) + amount
+
+def to_units(amount: float):
+    # Floors a token amount to whole base units
+    return int(amount * BASE_UNITS)
+
+def from_units(units: int):
+    return decimal(units) / BASE_UNITS
+
+def from_rate_units(rate: int):
+    return decimal(rate) / RATE_UNITS
+
+def expiry_day(deadline):
+    return datetime.datetime(year=deadline.year, month=deadline.month, day=deadline.day)
+
+def expiry_day_key(day):
+    # Hash keys may not contain ':', so the bucket key is built from the date parts only
+    return str(day.year) + "-" + str(day.month) + "-" + str(day.day)
+
+def add_to_expiry_bucket(pool_id: str, exchange_deadline):
+    day = expiry_day(exchange_deadline)
+    day_key = expiry_day_key(day)
+    bucket_index = expiry_bucket[day_key]
+    expiry_bucket[day_key, bucket_index] = pool_id
+    expiry_bucket[day_key] = bucket_index + 1
+
+    # The sweep only ever passes days that have fully ended, so a new deadline can only land before
+    # the cursor when nothing has been swept yet (e.g. after the windows were shortened)
+    cursor = expiry_bucket["cursor"]
+    if not cursor or day < cursor[0]:
+        expiry_bucket["cursor"] = [day, 0]
+
+def close_expired_pool(pool_id: str):
+    # Moves a pool whose exchange window has closed into its final state, cancelling a still-open
+    # OTC listing. Returns True if the pool still needed closing.
+    state = pool_state[pool_id]
+    if not state or state[0] not in ["OPEN_FOR_CONTRIBUTION", "OTC_LISTED"]:
+        return False
+    acquire_pool_lock(pool_id)
+
+    pool = pool_fund[pool_id]
+    otc_offer_details = None
+    if pool["otc_listing_id"]:
+        otc_listings_foreign = ForeignHash(foreign_contract=metadata['otc_contract'], foreign_name='otc_listing')
+        otc_offer_details = otc_listings_foreign[pool["otc_listing_id"]]
+
+    if otc_offer_details and (otc_offer_details["status"] == "EXECUTED" or listing_has_fills(otc_offer_details)):
+        resolve_share_payout(pool_id, otc_offer_details)
+    else:
+        resolve_refund_window(pool_id, pool, otc_offer_details)
+
+    release_pool_lock(pool_id)
+    return True
+
+def set_pool_status(pool_id: str, pool: dict, new_status: str):
+    # Every status change goes through here so pool_status_count stays exact. The other stats are
+    # also only updated on transitions, once per pool, never on a contributor's own transaction.
+    state = pool_state[pool_id] or [None, 0, 0]
+    current_status = state[0]
+    if current_status == new_status:
+        return
+    shard = pool_id[0]
+    if current_status:
+        pool_status_count[current_status, shard] -= 1
+    pool_status_count[new_status, shard] += 1
+    if current_status == "OPEN_FOR_CONTRIBUTION":
+        # Contributors can only join an open pool
+        contributor_total[shard] += pool_contributor_count[pool_id]
+    # Nothing moves while a pool is listed, so state[1] is the listed amount on both transitions
+    if new_status == "OTC_LISTED":
+        token_stats[pool["pool_token"], "value_locked", shard] += state[1]
+    elif current_status == "OTC_LISTED" and new_status == "OTC_FAILED":
+        token_stats[pool["pool_token"], "value_locked", shard] -= state[1]
+    state[0] = new_status
+    pool_state[pool_id] = state
+    PoolStatusChanged = LogEvent(
+        event="pool_status_changed",
+        params={
+            "pool_id":{'type':str, 'idx':True},
+            "old_status": {'type':str, 'idx':False}, # "None" when the pool is created
+            "new_status": {'type':str, 'idx':True}
+        })
+    PoolStatusChanged({"pool_id": pool_id, "old_status": str(current_status), "new_status": new_status})
+
+def verify_token_interface(token: str, error_message: str):
+    # Submitted contracts cannot change, so a token that passed introspection once always will
+    if verified_tokens[token]:
+        return
+    # Standard XSC001 (Fungible Token) interface. Built here rather than at module level, since the
+    # module body runs on every call and only a token's first use needs it.
+    token_interface = [
+        I.Func('transfer_from', args=('amount', 'to', 'main_account')),
+        I.Func('transfer', args=('amount', 'to')),
+        importlib.Func('balance_of', args=('address',)),
+    ]
+    assert I.enforce_interface(I.import_module(token), token_interface), error_message
+    verified_tokens[token] = True
+
+def acquire_pool_lock(pool_id: str):
+    assert not pool_lock[pool_id], "Pool is busy, please try again."
+    pool_lock[pool_id] = True
+
+def release_pool_lock(pool_id: str):
+    pool_lock[pool_id] = None
+
+def acquire_token_lock(token: str):
+    assert not token_lock[token], "Token is busy, please try again."
+    token_lock[token] = True
+
+def release_token_lock(token: str):
+    token_lock[token] = None
 
 # --- Helper/View functions ---
 @export
 def get_pool_info(pool_id: str):
-    return pool_fund[pool_id]
+    # Reassembles the full pool record from its definition and per-field state
+    pool = pool_fund[pool_id]
+    if not pool:
+        return None
+    pool["hard_cap"] = from_units(pool["hard_cap"])
+    pool["soft_cap"] = from_units(pool["soft_cap"])
+    state = pool_state[pool_id]
+    pool["amount_received"] = from_units(state[1])
+    pool["total_nominal_contributions"] = from_units(state[2])
+    pool["status"] = state[0]
+    settlement = pool_settlement[pool_id] or [None, 0, None, 0, 0]
+    pool["otc_actual_received_amount"] = from_units(settlement[4])
+    pool["payout_rate"] = from_rate_units(settlement[1])
+    pool["unfilled_fraction"] = from_rate_units(settlement[3])
+    pool["contributor_count"] = pool_contributor_count[pool_id]
+    pool["settlement_cursor"] = settlement_cursor[pool_id]
+    return pool
+
+@export
+def get_stats(token: str = ""):
+    pools_by_status = {}
+    for status in ["OPEN_FOR_CONTRIBUTION", "OTC_LISTED", "OTC_EXECUTED", "OTC_FAILED", "REFUNDING", "ARCHIVED"]:
+        pools_by_status[status] = sum([pool_status_count[status, shard] for shard in STATS_SHARDS])
+    stats = {
+        "pool_count": pool_count.get(),
+        "pools_by_status": pools_by_status,
+        "contributor_count": sum([contributor_total[shard] for shard in STATS_SHARDS])
+    }
+    if token:
+        # value_locked: pool tokens of listed pools, not yet sold or handed back; take_distributed: take amounts of settled pools
+        stats["value_locked"] = from_units(sum([token_stats[token, "value_locked", shard] for shard in STATS_SHARDS]))
+        stats["take_distributed"] = from_units(sum([token_stats[token, "take_distributed", shard] for shard in STATS_SHARDS]))
+    return stats
 
 @export
 def get_contribution_info(pool_id: str, account: str):
-    return contributor[account, pool_id]
+    # Expands the compact position; None once it has been claimed or refunded
+    funder = contributor[account, pool_id]
+    if not funder or funder[0] <= 0:
+        return None # Missing, or the zeroed placeholder of a withdrawal made before the deadline
+    return {
+        "amount_contributed": from_units(funder[0]), # Nominal
+        "actual_amount_added": from_units(funder[1]),
+        "share_withdrawn": False # Claimed positions are deleted
+    }
+
+@export
+def get_pool_contributors(pool_id: str, start: int, limit: int):
+    # Page of accounts from the append-only contributor index, in order of first contribution
+    assert start >= 0, 'start must not be negative.'
+    assert limit > 0, 'limit must be positive.'
+    page_end = min(start + limit, pool_contributor_count[pool_id])
+    return [pool_contributors[pool_id, index] for index in range(start, page_end)]
+
+@export
+def get_token_info(token: str):
+    # Registered behaviour, allowance layout (the token Hash read as [owner, spender], or None) and
+    # whether the token already passed the XSC001 interface check
+    return {
+        "behaviour": token_type[token] or "unknown",
+        "allowance_hash": allowance_layout[token],
+        "verified": verified_tokens[token]
+    }
 
 @export
 def get_otc_deal_info_for_pool(pool_id: str):
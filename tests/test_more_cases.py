@@ -1,3 +1,4 @@
+import hashlib
 import unittest
 from contracting.stdlib.bridge.decimal import ContractingDecimal as decimal
 from contracting.stdlib.bridge.time import Datetime, Timedelta 
@@ -19,7 +20,7 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
         self.otc_contract_name = "con_otc"
         self.pool_token_name = "con_pool_token"
         self.take_token_name = "con_otc_take_token"
-        self.malicious_token_name = "con_malicious_reentrant_token" # For completeness if needed
+        self.malicious_token_name = "con_malicious_reentrant_token"
         self.taxable_pool_token_name = "con_taxable_pool_token"
 
         current_dir = Path(__file__).resolve().parent.parent
@@ -32,7 +33,7 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
             self.client.submit(f.read(), name=self.pool_token_name, signer=self.operator)
         with open(current_dir / "con_otc_take_token.py") as f:
             self.client.submit(f.read(), name=self.take_token_name, signer=self.operator)
-        # Malicious token not strictly needed for these new tests but good to have in setup
+        # Malicious token, for the re-entrancy tests
         with open(current_dir / "con_malicious_reentrant_token.py") as f:
             self.client.submit(f.read(), name=self.malicious_token_name, signer=self.operator)
         with open(current_dir / "con_taxable_pool_token.py") as f:
@@ -43,6 +44,7 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
         self.con_pool_token = self.client.get_contract(self.pool_token_name)
         self.con_otc_take_token = self.client.get_contract(self.take_token_name)
         self.con_taxable_pool_token = self.client.get_contract(self.taxable_pool_token_name)
+        self.con_malicious_token = self.client.get_contract(self.malicious_token_name)
 
         # Token Distribution
         self.con_pool_token.transfer(amount=decimal('1000'), to=self.alice, signer=self.operator)
@@ -100,7 +102,7 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
             hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
             environment={"now": pool_creation_time}
         )
-        pool_info = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         expected_deadline = pool_creation_time + new_contrib_window
         self.assertEqual(pool_info['contribution_deadline'], expected_deadline)
 
@@ -211,7 +213,7 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
             environment={"now": time_for_listing}
         )
         self.assertIsNotNone(otc_listing_id)
-        pool_info = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info['status'], "OTC_LISTED")
 
         # Attempt to list again when already listed
@@ -244,8 +246,8 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
         # otc_fee_percent = decimal('1.0')
         # fee_rate = decimal('1.0') / decimal('100.0') = decimal('0.01')
         # expected_offer_amount = decimal('100') / (decimal('1.0') + decimal('0.01'))
-        # expected_offer_amount = decimal('100') / decimal('1.01')
-        self.assertEqual(otc_offer_on_otc_contract['offer_amount'], decimal('100') / decimal('1.01'))
+        # expected_offer_amount = decimal('100') / decimal('1.01'), floored to 8 decimal places
+        self.assertEqual(otc_offer_on_otc_contract['offer_amount'], decimal('99.00990099'))
 
 
     def test_cancel_otc_listing_permissions_and_states_by_operator(self):
@@ -271,7 +273,7 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
             pool_id=pool_id, signer=self.operator, environment={"now": time_for_cancelling}
         )
         
-        pool_info = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info['status'], "OTC_FAILED")
         otc_offer_on_otc = self.con_otc.otc_listing[otc_listing_id]
         self.assertEqual(otc_offer_on_otc['status'], "CANCELLED")
@@ -291,7 +293,7 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
         contribution_amount = decimal('25')
         self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=contribution_amount, signer=self.bob, environment={"now": contrib_time})
         
-        pool_info = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info['amount_received'], contribution_amount) # Soft cap met
 
         # Time passes beyond contribution AND exchange deadlines. Alice (creator) does nothing.
@@ -307,13 +309,12 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
         bob_final_balance = self.con_pool_token.balance_of(address=self.bob)
         self.assertEqual(bob_final_balance, bob_initial_balance + contribution_amount)
         
-        pool_info_after_withdraw = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info_after_withdraw = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info_after_withdraw['amount_received'], decimal('0'))
         # The status should reflect failure
         self.assertEqual(pool_info_after_withdraw['status'], "OTC_FAILED") # or "REFUNDING"
         
-        bob_contrib_info = self.con_crowdfund_otc.contributor[self.bob, pool_id]
-        self.assertEqual(bob_contrib_info['amount_contributed'], decimal('0'))
+        self.assertIsNone(self.con_crowdfund_otc.get_contribution_info(pool_id=pool_id, account=self.bob))
 
 
     def test_withdraw_contribution_soft_cap_not_met_after_deadlines(self):
@@ -328,7 +329,7 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
         contribution_amount = decimal('25') # Less than soft cap
         self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=contribution_amount, signer=self.bob, environment={"now": contrib_time})
         
-        pool_info = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertTrue(pool_info['amount_received'] < pool_info['soft_cap'])
 
         time_after_all_deadlines = self._get_future_time(self.base_time, days=9)
@@ -341,7 +342,7 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
         bob_final_balance = self.con_pool_token.balance_of(address=self.bob)
         self.assertEqual(bob_final_balance, bob_initial_balance + contribution_amount)
         
-        pool_info_after_withdraw = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info_after_withdraw = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info_after_withdraw['amount_received'], decimal('0'))
         self.assertEqual(pool_info_after_withdraw['status'], "REFUNDING") # Or "REFUNDING"
 
@@ -489,7 +490,7 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
     #         "Crowdfund contract balance mismatch after contribution."
     #     )
         
-    #     pool_info = self.con_crowdfund_otc.pool_fund[pool_id]
+    #     pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
     #     self.assertEqual(pool_info['amount_received'], contribution_amount_p)
 
     #     # Alice lists the pool on OTC
@@ -577,113 +578,161 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
         
     #     print(f"Test confirmed: {expected_trapped_tokens} pool_tokens are trapped in the crowdfund contract for pool_id {pool_id}.")
 
-     # --- This test case was used to demonstrate that there was the vulnerability of reentrancy ---
-    # def test_reentrancy_withdraw_share_double_payment(self):
-    #     print("\n--- Test: Re-entrancy in Withdraw Share (Double Payment) ---")
-        
-    #     malicious_token_contract_name = self.malicious_token_name 
-    #     mt_address = malicious_token_contract_name 
-        
-    #     attacker_owner = self.operator 
+    def _executed_pool_with_malicious_take_token(self):
+        # The malicious token contract contributes to a pool whose OTC deal pays out in malicious tokens,
+        # so its own transfer runs while the crowdfund contract pays it a share
+        con_mt = self.con_malicious_token
+        mt_address = self.malicious_token_name
 
-    #     con_mt = self.client.get_contract(malicious_token_contract_name)
+        pool_creation_time = self._get_future_time(self.base_time, hours=1)
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="Re-entrancy Withdraw Share Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('1000'), soft_cap=decimal('100'), signer=self.alice,
+            environment={"now": pool_creation_time}
+        )
 
-    #     pool_creation_time = self._get_future_time(self.base_time, hours=1)
-    #     pool_id = self.con_crowdfund_otc.create_pool(
-    #         description="Re-entrancy Withdraw Share Pool",
-    #         pool_token=self.pool_token_name, 
-    #         hard_cap=decimal('1000'),
-    #         soft_cap=decimal('100'), 
-    #         signer=self.alice, 
-    #         environment={"now": pool_creation_time} # This sets 'now' for create_pool
-    #     )
+        self.con_pool_token.transfer(amount=decimal('100'), to=mt_address, signer=self.operator)
+        con_mt.execute_token_approve(token_contract_name=self.pool_token_name, spender=self.crowdfund_contract_name,
+                                     amount=decimal('100'), signer=self.operator)
+        contrib_time = self._get_future_time(pool_creation_time, minutes=10)
+        con_mt.execute_contribute(crowdfund_contract_name=self.crowdfund_contract_name, pool_id=pool_id,
+                                  amount=decimal('100'), signer=self.operator, environment={"now": contrib_time})
 
-    #     contribution_amount_mt = decimal('100') 
+        time_for_listing = self._get_future_time(contrib_time, days=6)
+        self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=pool_id, otc_take_token=mt_address, otc_total_take_amount=decimal('200'),
+            signer=self.alice, environment={"now": time_for_listing}
+        )
 
-    #     self.con_pool_token.transfer(amount=contribution_amount_mt, to=mt_address, signer=self.operator)
-    #     self.assertEqual(self.con_pool_token.balance_of(address=mt_address), contribution_amount_mt)
-        
-    #     con_mt.execute_token_approve(
-    #         token_contract_name=self.pool_token_name,
-    #         spender=self.crowdfund_contract_name,
-    #         amount=contribution_amount_mt,
-    #         signer=attacker_owner 
-    #     )
-        
-    #     # Define the time for the contribution
-    #     contrib_time = self._get_future_time(pool_creation_time, minutes=10) # Well within 5 days
-
-    #     # MODIFICATION: Pass the environment to the execute_contribute call
-    #     con_mt.execute_contribute(
-    #         crowdfund_contract_name=self.crowdfund_contract_name,
-    #         pool_id=pool_id,
-    #         amount=contribution_amount_mt,
-    #         signer=attacker_owner,
-    #         environment={"now": contrib_time} # Set 'now' for this transaction
-    #     )
-    #     self.assertEqual(self.con_crowdfund_otc.contributor[mt_address, pool_id]['amount_contributed'], contribution_amount_mt)
-    #     self.assertEqual(self.con_crowdfund_otc.pool_fund[pool_id]['amount_received'], contribution_amount_mt)
+        con_mt.mint(amount=decimal('1000'), to=self.charlie, signer=self.operator)
+        con_mt.approve(amount=decimal('1000'), to=self.otc_contract_name, signer=self.charlie)
+        otc_listing_id = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)['otc_listing_id']
+        time_for_taking_offer = self._get_future_time(time_for_listing, minutes=30)
+        self.con_otc.take_offer(listing_id=otc_listing_id, signer=self.charlie, environment={"now": time_for_taking_offer})
+        self.assertEqual(con_mt.balance_of(address=self.crowdfund_contract_name), decimal('200'))
+
+        # From here on, a transfer to the malicious token contract calls withdraw_share again
+        con_mt.configure_re_entrancy_for_withdraw(crowdfund_name=self.crowdfund_contract_name, pool_id=pool_id,
+                                                  signer=self.operator)
+        return pool_id, self._get_future_time(time_for_taking_offer, minutes=5)
+
+    def test_reentrant_withdraw_share_is_rejected_by_pool_lock(self):
+        print("\n--- Test: Re-entrancy in Withdraw Share Rejected ---")
+        pool_id, time_for_withdraw = self._executed_pool_with_malicious_take_token()
+
+        with self.assertRaisesRegex(AssertionError, "Pool is busy"):
+            self.con_malicious_token.execute_withdraw_share(
+                crowdfund_contract_name=self.crowdfund_contract_name, pool_id=pool_id,
+                signer=self.operator, environment={"now": time_for_withdraw}
+            )
 
-    #     charlie_mt_balance = decimal('1000')
-    #     con_mt.mint(amount=charlie_mt_balance, to=self.charlie, signer=attacker_owner)
-    #     con_mt.approve(amount=charlie_mt_balance, to=self.otc_contract_name, signer=self.charlie)
+        # Nothing was paid and the position is still there to be claimed once
+        self.assertEqual(self.con_malicious_token.balance_of(address=self.malicious_token_name), decimal('0'))
+        self.assertEqual(self.con_malicious_token.balance_of(address=self.crowdfund_contract_name), decimal('200'))
+        self.assertEqual(self.client.get_var(self.crowdfund_contract_name, 'contributor', [self.malicious_token_name, pool_id]),
+                         [100 * 10**8, 100 * 10**8])
+
+    def test_reentrant_claim_from_claim_all_is_rejected_by_pool_lock(self):
+        print("\n--- Test: Re-entrancy in Claim All Rejected ---")
+        pool_id, time_for_withdraw = self._executed_pool_with_malicious_take_token()
+
+        # claim_all keeps the pool locked until its netted transfers are done
+        with self.assertRaisesRegex(AssertionError, "Pool is busy"):
+            self.con_malicious_token.execute_claim_all(
+                crowdfund_contract_name=self.crowdfund_contract_name, pool_ids=[pool_id],
+                signer=self.operator, environment={"now": time_for_withdraw}
+            )
 
-    #     otc_total_take_amount_mt = decimal('200') 
-        
-    #     time_for_listing = self._get_future_time(contrib_time, days=6) # contrib_time + 6 days
-    #                                                                    # = pool_creation_time + 10 mins + 6 days
-    #                                                                    # This is > pool_creation_time + 5 days (contrib deadline)
-    #                                                                    # which is correct for listing.
-
-    #     self.con_crowdfund_otc.list_pooled_funds_on_otc(
-    #         pool_id=pool_id,
-    #         otc_take_token=malicious_token_contract_name, 
-    #         otc_total_take_amount=otc_total_take_amount_mt,
-    #         signer=self.alice, 
-    #         environment={"now": time_for_listing} # Set 'now' for listing
-    #     )
-        
-    #     otc_listing_id = self.con_crowdfund_otc.pool_fund[pool_id]['otc_listing_id']
-    #     time_for_taking_offer = self._get_future_time(time_for_listing, minutes=30)
-        
-    #     self.con_otc.take_offer(
-    #         listing_id=otc_listing_id,
-    #         signer=self.charlie,
-    #         environment={"now": time_for_taking_offer} # Set 'now' for taking offer
-    #     )
-        
-    #     self.assertEqual(con_mt.balance_of(address=self.crowdfund_contract_name), otc_total_take_amount_mt)
-        
-    #     con_mt.configure_re_entrancy_for_withdraw(
-    #         crowdfund_name=self.crowdfund_contract_name,
-    #         pool_id=pool_id,
-    #         signer=attacker_owner
-    #     )
-        
-    #     con_mt.mint(amount=decimal('500'), to=self.crowdfund_contract_name, signer=attacker_owner)
-        
-    #     mt_balance_before_exploit_adjusted = con_mt.balance_of(address=mt_address)
-
-    #     time_for_withdraw = self._get_future_time(time_for_taking_offer, minutes=5)
-    #     con_mt.execute_withdraw_share(
-    #         crowdfund_contract_name=self.crowdfund_contract_name,
-    #         pool_id=pool_id,
-    #         signer=attacker_owner,
-    #         environment={"now": time_for_withdraw} # Set 'now' for withdraw
-    #     )
-    #     mt_balance_after_exploit_adjusted = con_mt.balance_of(address=mt_address)
+        self.assertEqual(self.con_malicious_token.balance_of(address=self.malicious_token_name), decimal('0'))
+        self.assertEqual(self.con_malicious_token.balance_of(address=self.crowdfund_contract_name), decimal('200'))
+        self.assertIsNotNone(self.client.get_var(self.crowdfund_contract_name, 'contributor', [self.malicious_token_name, pool_id]))
 
-    #     expected_single_share = otc_total_take_amount_mt 
-        
-    #     self.assertEqual(
-    #         mt_balance_after_exploit_adjusted,
-    #         mt_balance_before_exploit_adjusted + (expected_single_share * 2),
-    #         "MT contract should have received its share twice."
-    #     )
+    def test_reentrant_contribute_into_other_pool_is_rejected_by_token_lock(self):
+        print("\n--- Test: Re-entrant Contribute Rejected by Token Lock ---")
+        con_mt = self.con_malicious_token
+        con_mt.mint(amount=decimal('100'), to=self.bob, signer=self.operator)
+        con_mt.approve(amount=decimal('100'), to=self.crowdfund_contract_name, signer=self.bob)
 
-    #     self.assertEqual(con_mt.balance_of(address=self.crowdfund_contract_name), decimal('300'))
-        
-    #     self.assertTrue(self.con_crowdfund_otc.contributor[mt_address, pool_id]['share_withdrawn'])
+        pool_ids = [
+            self.con_crowdfund_otc.create_pool(
+                description="Malicious Token Pool", pool_token=self.malicious_token_name,
+                hard_cap=decimal('200'), soft_cap=decimal('10'), signer=self.alice,
+                environment={"now": self.base_time}
+            )
+            for _ in range(2)
+        ]
+        # The other pool's lock is free, but the token's balance is already being measured
+        con_mt.configure_re_entrancy(crowdfund_name=self.crowdfund_contract_name, pool_id=pool_ids[1],
+                                     amount=decimal('10'), signer=self.operator)
+
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        with self.assertRaisesRegex(AssertionError, "Token is busy"):
+            self.con_crowdfund_otc.contribute(pool_id=pool_ids[0], amount=decimal('50'), signer=self.bob,
+                                              environment={"now": contrib_time})
+
+        for pool_id in pool_ids:
+            self.assertEqual(self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)['amount_received'], decimal('0'))
+        self.assertIsNone(self.client.get_var(self.crowdfund_contract_name, 'token_lock', [self.malicious_token_name]))
+
+    def _list_pool_tokens_for_malicious_tokens(self, count: int):
+        # Alice offers pool tokens for malicious tokens, which Charlie holds and has approved
+        self.con_pool_token.approve(amount=decimal('1000'), to=self.otc_contract_name, signer=self.alice)
+        listing_ids = [
+            self.con_otc.list_offer(offer_token=self.pool_token_name, offer_amount=decimal('10'),
+                                    take_token=self.malicious_token_name, take_amount=decimal('20'), signer=self.alice)
+            for _ in range(count)
+        ]
+        self.con_malicious_token.mint(amount=decimal('1000'), to=self.charlie, signer=self.operator)
+        self.con_malicious_token.approve(amount=decimal('1000'), to=self.otc_contract_name, signer=self.charlie)
+        return listing_ids
+
+    def test_reentrant_take_offer_is_rejected_by_listing_lock(self):
+        print("\n--- Test: Re-entrant Take Offer Rejected by Listing Lock ---")
+        listing_id = self._list_pool_tokens_for_malicious_tokens(1)[0]
+        # Paying the take token calls take_offer on the same listing again
+        self.con_malicious_token.configure_re_entrancy_for_otc(otc_name=self.otc_contract_name, function="take_offer",
+                                                               listing_id=listing_id, signer=self.operator)
+
+        with self.assertRaisesRegex(AssertionError, "Listing is busy"):
+            self.con_otc.take_offer(listing_id=listing_id, signer=self.charlie)
+
+        listing = self.con_otc.otc_listing[listing_id]
+        self.assertEqual(listing["status"], "OPEN")
+        self.assertEqual(listing["take_amount_filled"], decimal('0'))
+        self.assertEqual(self.con_malicious_token.balance_of(address=self.charlie), decimal('1000'))
+        self.assertIsNone(self.client.get_var(self.otc_contract_name, 'listing_lock', [listing_id]))
+
+    def test_reentrant_take_offer_on_other_listing_is_rejected_by_token_lock(self):
+        print("\n--- Test: Re-entrant Take Offer Rejected by Token Lock ---")
+        listing_ids = self._list_pool_tokens_for_malicious_tokens(2)
+        # The other listing's lock is free, but the take token's balance is already being measured
+        self.con_malicious_token.configure_re_entrancy_for_otc(otc_name=self.otc_contract_name, function="take_offer",
+                                                               listing_id=listing_ids[1], signer=self.operator)
+
+        with self.assertRaisesRegex(AssertionError, "Token is busy"):
+            self.con_otc.take_offer(listing_id=listing_ids[0], signer=self.charlie)
+
+        for listing_id in listing_ids:
+            self.assertEqual(self.con_otc.otc_listing[listing_id]["status"], "OPEN")
+        self.assertIsNone(self.client.get_var(self.otc_contract_name, 'token_lock', [self.malicious_token_name]))
+
+    def test_reentrant_cancel_offer_is_rejected_by_listing_lock(self):
+        print("\n--- Test: Re-entrant Cancel Offer Rejected by Listing Lock ---")
+        # Bob escrows malicious tokens in a listing, so cancelling refunds them through the token's transfer
+        self.con_malicious_token.mint(amount=decimal('100'), to=self.bob, signer=self.operator)
+        self.con_malicious_token.approve(amount=decimal('100'), to=self.otc_contract_name, signer=self.bob)
+        listing_id = self.con_otc.list_offer(offer_token=self.malicious_token_name, offer_amount=decimal('50'),
+                                             take_token=self.take_token_name, take_amount=decimal('10'), signer=self.bob)
+        bob_balance_after_listing = self.con_malicious_token.balance_of(address=self.bob)
+        self.con_malicious_token.configure_re_entrancy_for_otc(otc_name=self.otc_contract_name, function="cancel_offer",
+                                                               listing_id=listing_id, signer=self.operator)
+
+        with self.assertRaisesRegex(AssertionError, "Listing is busy"):
+            self.con_otc.cancel_offer(listing_id=listing_id, signer=self.bob)
+
+        self.assertEqual(self.con_otc.otc_listing[listing_id]["status"], "OPEN")
+        self.assertEqual(self.con_malicious_token.balance_of(address=self.bob), bob_balance_after_listing)
+        self.assertIsNone(self.client.get_var(self.otc_contract_name, 'listing_lock', [listing_id]))
 
     def test_vulnerability_funds_trapped_if_otc_offer_expires_open_and_unresponsive_creator(self):
         print("\n--- Test: FIX VERIFICATION - Funds Trapped if OTC Offer Expires Open (Creator Unresponsive) ---")
@@ -766,17 +815,16 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
                          "OTC balance incorrect after successful withdraw and auto-cancellation")
 
         # Verify pool status in CF contract is OTC_FAILED
-        pool_info_after_withdraw = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info_after_withdraw = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info_after_withdraw['status'], "OTC_FAILED", "Pool status not OTC_FAILED after withdraw")
         
         # Verify OTC offer status on OTC contract is CANCELLED due to auto-cancellation
         otc_offer_details_on_otc_after_withdraw = self.con_otc.otc_listing[otc_listing_id]
         self.assertEqual(otc_offer_details_on_otc_after_withdraw['status'], "CANCELLED", "OTC offer status not CANCELLED after auto-cancellation")
 
-        # Verify Bob's contribution info in CF contract shows 0 amount contributed
-        bob_contrib_info_after_withdraw = self.con_crowdfund_otc.contributor[self.bob, pool_id]
-        self.assertIsNotNone(bob_contrib_info_after_withdraw, "Bob's contribution info missing")
-        self.assertEqual(bob_contrib_info_after_withdraw['amount_contributed'], decimal('0'), "Bob's recorded contribution not zeroed out")
+        # Verify Bob's contribution record in CF contract was deleted on refund
+        bob_contrib_info_after_withdraw = self.con_crowdfund_otc.get_contribution_info(pool_id=pool_id, account=self.bob)
+        self.assertIsNone(bob_contrib_info_after_withdraw, "Bob's contribution record not deleted")
 
         print(f"Fix Confirmed: Bob successfully withdrew his {contribution_amount} {self.pool_token_name} after OTC offer expired open, due to auto-cancellation.")
 
@@ -818,7 +866,7 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
         )
         
         bob_actual_added = bob_nominal_contrib * (decimal('1.0') - tax_rate)
-        pool_info_after_bob = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info_after_bob = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info_after_bob['total_nominal_contributions'], bob_nominal_contrib)
         self.assertEqual(pool_info_after_bob['amount_received'], bob_actual_added)
         self.assertEqual(taxable_token_contract.balance_of(address=self.crowdfund_contract_name), 
@@ -843,7 +891,7 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
         total_nominal_contributions = bob_nominal_contrib + charlie_nominal_contrib
         total_actual_received = bob_actual_added + charlie_actual_added
 
-        pool_info_after_charlie = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info_after_charlie = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info_after_charlie['total_nominal_contributions'], total_nominal_contributions)
         self.assertEqual(pool_info_after_charlie['amount_received'], total_actual_received)
         self.assertEqual(taxable_token_contract.balance_of(address=self.crowdfund_contract_name), 
@@ -1007,7 +1055,7 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
                          
         self.assertEqual(self.con_otc_take_token.balance_of(address=self.crowdfund_contract_name), decimal('0'))
         
-        pool_info_final = self.con_crowdfund_otc.pool_fund[pool_id]
+        pool_info_final = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
         self.assertEqual(pool_info_final['status'], "OTC_EXECUTED")
         self.assertEqual(pool_info_final['otc_actual_received_amount'], otc_take_amount_target)
 
@@ -1015,6 +1063,950 @@ class TestCrowdfundContractMoreCases(unittest.TestCase):
         print(f"Taxable token test: CF logic for contribution, listing, and share withdrawal works. Bob received {bob_expected_share}, Charlie received {charlie_expected_share}.")
         print("Note: This test's success for 'take_offer' implies con_otc.py can handle the taxable offer_token or the specific amounts allowed it.")
 
+    def test_contribute_many_across_pools(self):
+        print("\n--- Test: Contribute Many Across Pools ---")
+        pool_id_1 = self.con_crowdfund_otc.create_pool(
+            description="Batch Pool 1", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        pool_id_2 = self.con_crowdfund_otc.create_pool(
+            description="Batch Pool 2", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self._get_future_time(self.base_time, seconds=1)}
+        )
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        bob_initial_balance = self.con_pool_token.balance_of(address=self.bob)
+
+        self.con_crowdfund_otc.contribute_many(
+            contributions=[[pool_id_1, decimal('20')], [pool_id_2, decimal('30')], [pool_id_1, decimal('5')]],
+            signer=self.bob, environment={"now": contrib_time}
+        )
+
+        self.assertEqual(self.con_pool_token.balance_of(address=self.bob), bob_initial_balance - decimal('55'))
+        self.assertEqual(self.con_crowdfund_otc.get_pool_info(pool_id=pool_id_1)['amount_received'], decimal('25'))
+        self.assertEqual(self.con_crowdfund_otc.get_pool_info(pool_id=pool_id_2)['amount_received'], decimal('30'))
+        self.assertEqual(self.con_crowdfund_otc.get_contribution_info(pool_id=pool_id_1, account=self.bob)['amount_contributed'], decimal('25'))
+        self.assertEqual(self.con_crowdfund_otc.get_contribution_info(pool_id=pool_id_2, account=self.bob)['amount_contributed'], decimal('30'))
+
+        # One failing pair reverts the whole batch
+        with self.assertRaisesRegex(AssertionError, "contribution exceeds hard cap"):
+            self.con_crowdfund_otc.contribute_many(
+                contributions=[[pool_id_2, decimal('10')], [pool_id_1, decimal('80')]],
+                signer=self.bob, environment={"now": contrib_time}
+            )
+        self.assertEqual(self.con_crowdfund_otc.get_pool_info(pool_id=pool_id_2)['amount_received'], decimal('30'))
+
+        with self.assertRaisesRegex(AssertionError, "no contributions supplied"):
+            self.con_crowdfund_otc.contribute_many(contributions=[], signer=self.bob, environment={"now": contrib_time})
+
+    def test_claim_all_mixed_share_and_refund_pools(self):
+        print("\n--- Test: Claim All Across Executed and Failed Pools ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('0.0'), signer=self.operator)
+
+        executed_pool_1 = self.con_crowdfund_otc.create_pool(
+            description="Claim All Exec 1", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        executed_pool_2 = self.con_crowdfund_otc.create_pool(
+            description="Claim All Exec 2", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self._get_future_time(self.base_time, seconds=1)}
+        )
+        failed_pool = self.con_crowdfund_otc.create_pool(
+            description="Claim All Soft Cap Fail", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('50'), signer=self.alice,
+            environment={"now": self._get_future_time(self.base_time, seconds=2)}
+        )
+
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        self.con_crowdfund_otc.contribute_many(
+            contributions=[[executed_pool_1, decimal('20')], [executed_pool_2, decimal('10')], [failed_pool, decimal('15')]],
+            signer=self.bob, environment={"now": contrib_time}
+        )
+        self.con_crowdfund_otc.contribute(pool_id=executed_pool_1, amount=decimal('20'), signer=self.charlie, environment={"now": contrib_time})
+
+        time_for_listing = self._get_future_time(self.base_time, days=6)
+        listing_1 = self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=executed_pool_1, otc_take_token=self.take_token_name,
+            otc_total_take_amount=decimal('200'), signer=self.alice,
+            environment={"now": time_for_listing}
+        )
+        listing_2 = self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=executed_pool_2, otc_take_token=self.take_token_name,
+            otc_total_take_amount=decimal('30'), signer=self.alice,
+            environment={"now": time_for_listing}
+        )
+        self.con_otc.take_offer(listing_id=listing_1, signer=self.dave, environment={"now": time_for_listing})
+        self.con_otc.take_offer(listing_id=listing_2, signer=self.dave, environment={"now": time_for_listing})
+
+        time_after_all_deadlines = self._get_future_time(self.base_time, days=9)
+        bob_take_before = self.con_otc_take_token.balance_of(address=self.bob)
+        bob_pool_before = self.con_pool_token.balance_of(address=self.bob)
+
+        self.con_crowdfund_otc.claim_all(
+            pool_ids=[executed_pool_1, executed_pool_2, failed_pool],
+            signer=self.bob, environment={"now": time_after_all_deadlines}
+        )
+
+        # 20/40 * 200 + 10/10 * 30 take tokens, and the 15 pool tokens back
+        self.assertEqual(self.con_otc_take_token.balance_of(address=self.bob), bob_take_before + decimal('130'))
+        self.assertEqual(self.con_pool_token.balance_of(address=self.bob), bob_pool_before + decimal('15'))
+        self.assertIsNone(self.con_crowdfund_otc.get_contribution_info(pool_id=executed_pool_1, account=self.bob))
+        self.assertEqual(self.con_crowdfund_otc.get_pool_info(pool_id=failed_pool)['status'], "REFUNDING")
+
+        with self.assertRaisesRegex(AssertionError, "share already withdrawn"):
+            self.con_crowdfund_otc.claim_all(
+                pool_ids=[executed_pool_1], signer=self.bob, environment={"now": time_after_all_deadlines}
+            )
+
+    def test_push_shares_and_refunds_paginated(self):
+        print("\n--- Test: Paginated Push Settlement of Shares and Refunds ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('0.0'), signer=self.operator)
+
+        executed_pool = self.con_crowdfund_otc.create_pool(
+            description="Push Shares", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        failed_pool = self.con_crowdfund_otc.create_pool(
+            description="Push Refunds", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('90'), signer=self.alice,
+            environment={"now": self._get_future_time(self.base_time, seconds=1)}
+        )
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        for account, amount in [(self.alice, decimal('10')), (self.bob, decimal('20')), (self.charlie, decimal('30'))]:
+            self.con_crowdfund_otc.contribute_many(
+                contributions=[[executed_pool, amount], [failed_pool, amount]],
+                signer=account, environment={"now": contrib_time}
+            )
+
+        time_for_listing = self._get_future_time(self.base_time, days=6)
+        listing_id = self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=executed_pool, otc_take_token=self.take_token_name,
+            otc_total_take_amount=decimal('600'), signer=self.alice,
+            environment={"now": time_for_listing}
+        )
+        self.con_otc.take_offer(listing_id=listing_id, signer=self.dave, environment={"now": time_for_listing})
+
+        # Bob pulls his own share first; the push must skip him
+        self.con_crowdfund_otc.withdraw_share(pool_id=executed_pool, signer=self.bob, environment={"now": time_for_listing})
+        charlie_take_before = self.con_otc_take_token.balance_of(address=self.charlie)
+
+        with self.assertRaisesRegex(AssertionError, "Only pool creator or operator can push settlement"):
+            self.con_crowdfund_otc.push_shares(pool_id=executed_pool, limit=2, signer=self.bob, environment={"now": time_for_listing})
+
+        remaining = self.con_crowdfund_otc.push_shares(pool_id=executed_pool, limit=2, signer=self.alice, environment={"now": time_for_listing})
+        self.assertEqual(remaining, 1)
+        remaining = self.con_crowdfund_otc.push_shares(pool_id=executed_pool, limit=2, signer=self.operator, environment={"now": time_for_listing})
+        self.assertEqual(remaining, 0)
+
+        self.assertEqual(self.con_otc_take_token.balance_of(address=self.charlie), charlie_take_before + decimal('300'))
+        self.assertEqual(self.con_otc_take_token.balance_of(address=self.crowdfund_contract_name), decimal('0'))
+        self.assertIsNone(self.con_crowdfund_otc.get_contribution_info(pool_id=executed_pool, account=self.alice))
+
+        # The failed pool is refunded once both windows have passed
+        with self.assertRaisesRegex(AssertionError, "Refunds can only be pushed once the pool has failed"):
+            self.con_crowdfund_otc.push_refunds(pool_id=failed_pool, limit=3, signer=self.alice, environment={"now": contrib_time})
+
+        time_after_all_deadlines = self._get_future_time(self.base_time, days=9)
+        bob_pool_before = self.con_pool_token.balance_of(address=self.bob)
+        remaining = self.con_crowdfund_otc.push_refunds(pool_id=failed_pool, limit=3, signer=self.alice, environment={"now": time_after_all_deadlines})
+        self.assertEqual(remaining, 0)
+        self.assertEqual(self.con_pool_token.balance_of(address=self.bob), bob_pool_before + decimal('20'))
+
+        failed_pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=failed_pool)
+        self.assertEqual(failed_pool_info['status'], "REFUNDING")
+        self.assertEqual(failed_pool_info['amount_received'], decimal('0'))
+        self.assertEqual(failed_pool_info['settlement_cursor'], 3)
+
+    def test_pool_contributor_index_pagination(self):
+        print("\n--- Test: Pool Contributor Index Pagination ---")
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="Contributor Index", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        self.assertEqual(self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)['contributor_count'], 0)
+        self.assertEqual(self.con_crowdfund_otc.get_pool_contributors(pool_id=pool_id, start=0, limit=10), [])
+
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('5'), signer=self.bob, environment={"now": contrib_time})
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('5'), signer=self.charlie, environment={"now": contrib_time})
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('5'), signer=self.bob, environment={"now": contrib_time}) # repeat, not re-indexed
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('5'), signer=self.alice, environment={"now": contrib_time})
+
+        self.assertEqual(self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)['contributor_count'], 3)
+        self.assertEqual(self.con_crowdfund_otc.get_pool_contributors(pool_id=pool_id, start=0, limit=2), [self.bob, self.charlie])
+        self.assertEqual(self.con_crowdfund_otc.get_pool_contributors(pool_id=pool_id, start=2, limit=2), [self.alice])
+        self.assertEqual(self.con_crowdfund_otc.get_pool_contributors(pool_id=pool_id, start=5, limit=2), [])
+
+    def test_settle_pool_freezes_payout_rate(self):
+        print("\n--- Test: Settle Pool Freezes Payout Rate ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('0.0'), signer=self.operator)
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="Settle Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('30'), signer=self.bob, environment={"now": contrib_time})
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('10'), signer=self.charlie, environment={"now": contrib_time})
+
+        time_for_listing = self._get_future_time(self.base_time, days=6)
+        listing_id = self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=pool_id, otc_take_token=self.take_token_name,
+            otc_total_take_amount=decimal('100'), signer=self.alice,
+            environment={"now": time_for_listing}
+        )
+
+        with self.assertRaisesRegex(AssertionError, "OTC deal not successfully executed"):
+            self.con_crowdfund_otc.settle_pool(pool_id=pool_id, signer=self.dave, environment={"now": time_for_listing})
+
+        self.con_otc.take_offer(listing_id=listing_id, signer=self.dave, environment={"now": time_for_listing})
+        payout_rate = self.con_crowdfund_otc.settle_pool(pool_id=pool_id, signer=self.dave, environment={"now": time_for_listing})
+        self.assertEqual(payout_rate, decimal('2.5'))
+
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
+        self.assertEqual(pool_info['status'], "OTC_EXECUTED")
+        self.assertEqual(pool_info['payout_rate'], decimal('2.5'))
+        self.assertEqual(pool_info['otc_actual_received_amount'], decimal('100'))
+        # Claims only need this one record: take token, payout rate, pool token, unfilled fraction, received units
+        self.assertEqual(self.con_crowdfund_otc.pool_settlement[pool_id],
+                         [self.take_token_name, 25 * 10**15, self.pool_token_name, 0, 100 * 10**8])
+
+        with self.assertRaisesRegex(AssertionError, "pool already settled"):
+            self.con_crowdfund_otc.settle_pool(pool_id=pool_id, signer=self.dave, environment={"now": time_for_listing})
+
+        bob_take_before = self.con_otc_take_token.balance_of(address=self.bob)
+        self.con_crowdfund_otc.withdraw_share(pool_id=pool_id, signer=self.bob, environment={"now": time_for_listing})
+        self.assertEqual(self.con_otc_take_token.balance_of(address=self.bob), bob_take_before + decimal('75'))
+        # Released locks leave no keys behind
+        self.assertIsNone(self.client.get_var(self.crowdfund_contract_name, 'pool_lock', [pool_id]))
+        self.assertIsNone(self.client.get_var(self.otc_contract_name, 'listing_lock', [listing_id]))
+
+    def test_pool_definition_is_not_rewritten_by_contributions(self):
+        print("\n--- Test: Pool Definition Split From Mutable State ---")
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="d" * 200, pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        definition_before = self.con_crowdfund_otc.pool_fund[pool_id]
+        self.assertNotIn('amount_received', definition_before)
+        self.assertNotIn('status', definition_before)
+        self.assertNotIn('total_nominal_contributions', definition_before)
+
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('15'), signer=self.bob, environment={"now": contrib_time})
+
+        self.assertEqual(self.con_crowdfund_otc.pool_fund[pool_id], definition_before)
+        # Raw state is kept in base units of 10^-8
+        self.assertEqual(definition_before['hard_cap'], 100 * 10**8)
+        self.assertEqual(self.con_crowdfund_otc.pool_state[pool_id], ["OPEN_FOR_CONTRIBUTION", 15 * 10**8, 15 * 10**8])
+
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
+        self.assertEqual(pool_info['hard_cap'], decimal('100'))
+        self.assertEqual(pool_info['soft_cap'], decimal('10'))
+        self.assertEqual(pool_info['amount_received'], decimal('15'))
+        self.assertEqual(pool_info['total_nominal_contributions'], decimal('15'))
+        self.assertIsNone(pool_info['otc_listing_id'])
+        self.assertEqual(pool_info['payout_rate'], decimal('0'))
+
+    def test_standard_token_registry_skips_balance_probing(self):
+        print("\n--- Test: Standard Token Registry ---")
+        with self.assertRaisesRegex(AssertionError, "Only operator can set token types"):
+            self.con_crowdfund_otc.set_token_type(token=self.pool_token_name, behaviour="standard", signer=self.alice)
+        with self.assertRaisesRegex(AssertionError, "behaviour must be"):
+            self.con_crowdfund_otc.set_token_type(token=self.pool_token_name, behaviour="rebasing", signer=self.operator)
+
+        self.assertEqual(self.con_crowdfund_otc.get_token_info(token=self.pool_token_name)["behaviour"], "unknown")
+        self.con_crowdfund_otc.set_token_type(token=self.pool_token_name, behaviour="standard", signer=self.operator)
+        self.con_otc.set_token_type(token=self.pool_token_name, behaviour="standard", signer=self.operator)
+        self.assertEqual(self.con_crowdfund_otc.get_token_info(token=self.pool_token_name)["behaviour"], "standard")
+        self.assertEqual(self.con_otc.view_token_type(token=self.pool_token_name), "standard")
+
+        pool_creation_time = self._get_future_time(self.base_time, hours=1)
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="Standard token pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('1000'), soft_cap=decimal('100'), signer=self.alice,
+            environment={"now": pool_creation_time}
+        )
+        self.con_crowdfund_otc.contribute(
+            pool_id=pool_id, amount=decimal('200'), signer=self.bob,
+            environment={"now": self._get_future_time(pool_creation_time, hours=1)}
+        )
+        bob_info = self.con_crowdfund_otc.get_contribution_info(pool_id=pool_id, account=self.bob)
+        self.assertEqual(bob_info['actual_amount_added'], decimal('200'))
+        self.assertEqual(self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)['amount_received'], decimal('200'))
+
+        # Listing on OTC with a standard offer token records the requested amount directly
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
+        listing_id = self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=pool_id, otc_take_token=self.take_token_name, otc_total_take_amount=decimal('400'),
+            signer=self.alice, environment={"now": self._get_future_time(pool_info['contribution_deadline'], hours=1)}
+        )
+        offer = self.con_otc.otc_listing[listing_id]
+        fee_percent = self.con_otc.fee.get()
+        self.assertAlmostEqual(offer['offer_amount'], decimal('200') / (decimal('1') + fee_percent / decimal('100')), places=6)
+
+        # Resetting to unknown restores the probing path
+        self.con_crowdfund_otc.set_token_type(token=self.pool_token_name, behaviour="unknown", signer=self.operator)
+        self.assertEqual(self.con_crowdfund_otc.get_token_info(token=self.pool_token_name)["behaviour"], "unknown")
+
+    def test_token_interface_verification_is_cached(self):
+        print("\n--- Test: Token Interface Verification Cache ---")
+        self.assertFalse(self.con_crowdfund_otc.get_token_info(token=self.pool_token_name)["verified"])
+        for hours in (1, 2):
+            self.con_crowdfund_otc.create_pool(
+                description=f"Pool {hours}", pool_token=self.pool_token_name,
+                hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+                environment={"now": self._get_future_time(self.base_time, hours=hours)}
+            )
+        self.assertTrue(self.con_crowdfund_otc.get_token_info(token=self.pool_token_name)["verified"])
+        # Nothing is stored in con_otc's verified_tokens yet, so read the raw key
+        self.assertIsNone(self.client.get_var(self.otc_contract_name, 'verified_tokens', [self.pool_token_name]))
+
+    def test_pool_ids_are_sequential_within_one_block(self):
+        print("\n--- Test: Sequential Pool Ids ---")
+        same_block_time = self._get_future_time(self.base_time, hours=1)
+        pool_ids = [
+            self.con_crowdfund_otc.create_pool(
+                description="Factory pool", pool_token=self.pool_token_name,
+                hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+                environment={"now": same_block_time}
+            )
+            for _ in range(5)
+        ]
+        self.assertEqual(len(set(pool_ids)), 5)
+        self.assertEqual(self.con_crowdfund_otc.get_stats()['pool_count'], 5)
+        # Indexers can derive every id from the sequence alone
+        self.assertEqual(pool_ids, [
+            hashlib.sha256(f"{self.crowdfund_contract_name}-{sequence}".encode()).hexdigest() for sequence in range(5)
+        ])
+
+    def test_otc_listing_sequence_index(self):
+        print("\n--- Test: OTC Listing Sequence Index ---")
+        self.con_pool_token.approve(amount=decimal('100'), to=self.otc_contract_name, signer=self.alice)
+        listing_ids = [
+            self.con_otc.list_offer(
+                offer_token=self.pool_token_name, offer_amount=decimal('10'),
+                take_token=self.take_token_name, take_amount=decimal('20'), signer=self.alice,
+                environment={"now": self.base_time}
+            )
+            for _ in range(3)
+        ]
+        self.assertEqual(len(set(listing_ids)), 3)
+        self.assertEqual(self.con_otc.view_listing_count(), 3)
+        self.assertEqual(self.con_otc.view_listing_ids(start=0, limit=10), listing_ids)
+        self.assertEqual(self.con_otc.view_listing_ids(start=1, limit=10), listing_ids[1:])
+        self.assertEqual(self.con_otc.view_listing_ids(start=3, limit=10), [])
+
+    def test_open_offer_book_is_price_ordered(self):
+        print("\n--- Test: Open Offer Book Ordering ---")
+        self.con_pool_token.approve(amount=decimal('100'), to=self.otc_contract_name, signer=self.alice)
+        listed = {}
+        for take_amount in ('30', '10', '20', '10', '10.001', '10'):
+            listed.setdefault(take_amount, []).append(self.con_otc.list_offer(
+                offer_token=self.pool_token_name, offer_amount=decimal('10'),
+                take_token=self.take_token_name, take_amount=decimal(take_amount), signer=self.alice
+            ))
+
+        def book_ids():
+            return [offer['id'] for offer in self.con_otc.get_open_offers(
+                offer_token=self.pool_token_name, take_token=self.take_token_name, start=0, limit=10
+            )]
+
+        # Cheapest tick first; 1.0001 shares the tick of 1, and a tick keeps listing order
+        self.assertEqual(
+            book_ids(),
+            listed['10'][:2] + listed['10.001'] + listed['10'][2:] + listed['20'] + listed['30']
+        )
+        page = self.con_otc.get_open_offers(
+            offer_token=self.pool_token_name, take_token=self.take_token_name, start=3, limit=2
+        )
+        self.assertEqual([offer['id'] for offer in page], [listed['10'][2], listed['20'][0]])
+
+        # Taking and cancelling remove listings from the ends and the middle of a tick
+        self.con_otc.take_offer(listing_id=listed['10'][0], signer=self.charlie)
+        self.con_otc.cancel_offer(listing_id=listed['10.001'][0], signer=self.alice)
+        self.con_otc.cancel_offer(listing_id=listed['30'][0], signer=self.alice)
+        self.assertEqual(book_ids(), [listed['10'][1], listed['10'][2], listed['20'][0]])
+        self.assertIsNone(self.con_otc.book_links[listed['30'][0]])
+
+        self.con_otc.cancel_offer(listing_id=listed['10'][2], signer=self.alice)
+        self.con_otc.cancel_offer(listing_id=listed['10'][1], signer=self.alice)
+        self.assertEqual(book_ids(), [listed['20'][0]])
+        self.con_otc.cancel_offer(listing_id=listed['20'][0], signer=self.alice)
+        self.assertEqual(book_ids(), [])
+        self.assertEqual(
+            self.con_otc.get_open_offers(offer_token=self.take_token_name, take_token=self.pool_token_name, start=0, limit=10),
+            []
+        )
+
+    def test_partial_fills_settle_pool_against_filled_amount(self):
+        print("\n--- Test: Partial Fills Settle Pool Against Filled Amount ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('0.0'), signer=self.operator)
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="Partial Fill Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('30'), signer=self.bob, environment={"now": contrib_time})
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('10'), signer=self.charlie, environment={"now": contrib_time})
+
+        time_for_listing = self._get_future_time(self.base_time, days=6)
+        listing_id = self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=pool_id, otc_take_token=self.take_token_name,
+            otc_total_take_amount=decimal('100'), signer=self.alice,
+            environment={"now": time_for_listing}
+        )
+
+        with self.assertRaisesRegex(AssertionError, "Fill amount exceeds the remaining take amount"):
+            self.con_otc.take_offer(listing_id=listing_id, fill_amount=decimal('101'), signer=self.dave, environment={"now": time_for_listing})
+
+        # Dave buys a quarter of the listing: 25 take tokens for 10 pool tokens
+        dave_pool_before = self.con_pool_token.balance_of(address=self.dave)
+        self.con_otc.take_offer(listing_id=listing_id, fill_amount=decimal('25'), signer=self.dave, environment={"now": time_for_listing})
+        self.assertEqual(self.con_pool_token.balance_of(address=self.dave), dave_pool_before + decimal('10'))
+        offer = self.con_otc.otc_listing[listing_id]
+        self.assertEqual(offer['status'], "OPEN")
+        self.assertEqual(offer['take_amount_filled'], decimal('25'))
+        self.assertEqual(offer['offer_amount_filled'], decimal('10'))
+
+        # Still inside the exchange window, the remainder is open and nothing can be claimed yet
+        with self.assertRaisesRegex(AssertionError, "OTC deal not successfully executed"):
+            self.con_crowdfund_otc.withdraw_share(pool_id=pool_id, signer=self.bob, environment={"now": time_for_listing})
+        with self.assertRaisesRegex(AssertionError, "partially filled"):
+            self.con_crowdfund_otc.withdraw_contribution(pool_id=pool_id, signer=self.bob, environment={"now": time_for_listing})
+
+        # After the exchange window the first claim cancels the unfilled 30 pool tokens back
+        after_exchange = self._get_future_time(self.base_time, days=9)
+        bob_take_before = self.con_otc_take_token.balance_of(address=self.bob)
+        bob_pool_before = self.con_pool_token.balance_of(address=self.bob)
+        self.con_crowdfund_otc.withdraw_share(pool_id=pool_id, signer=self.bob, environment={"now": after_exchange})
+        self.assertEqual(self.con_otc.otc_listing[listing_id]['status'], "CANCELLED")
+        self.assertEqual(self.con_otc_take_token.balance_of(address=self.bob), bob_take_before + decimal('18.75'))
+        self.assertEqual(self.con_pool_token.balance_of(address=self.bob), bob_pool_before + decimal('22.5'))
+
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
+        self.assertEqual(pool_info['status'], "OTC_EXECUTED")
+        self.assertEqual(pool_info['otc_actual_received_amount'], decimal('25'))
+        self.assertEqual(pool_info['unfilled_fraction'], decimal('0.75'))
+
+        charlie_pool_before = self.con_pool_token.balance_of(address=self.charlie)
+        self.con_crowdfund_otc.withdraw_share(pool_id=pool_id, signer=self.charlie, environment={"now": after_exchange})
+        self.assertEqual(self.con_pool_token.balance_of(address=self.charlie), charlie_pool_before + decimal('7.5'))
+        self.assertEqual(self.con_pool_token.balance_of(address=self.crowdfund_contract_name), decimal('0'))
+
+    def test_take_offers_sweeps_listings_within_budget(self):
+        print("\n--- Test: Sweep Take Offers ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('0.0'), signer=self.operator)
+        self.con_pool_token.approve(amount=decimal('100'), to=self.otc_contract_name, signer=self.alice)
+        self.con_pool_token.approve(amount=decimal('100'), to=self.otc_contract_name, signer=self.bob)
+        first = self.con_otc.list_offer(offer_token=self.pool_token_name, offer_amount=decimal('10'),
+                                        take_token=self.take_token_name, take_amount=decimal('20'), signer=self.alice)
+        second = self.con_otc.list_offer(offer_token=self.pool_token_name, offer_amount=decimal('10'),
+                                         take_token=self.take_token_name, take_amount=decimal('20'), signer=self.bob)
+        third = self.con_otc.list_offer(offer_token=self.pool_token_name, offer_amount=decimal('10'),
+                                        take_token=self.take_token_name, take_amount=decimal('40'), signer=self.alice)
+        self.con_otc.cancel_offer(listing_id=second, signer=self.bob)
+
+        alice_take_before = self.con_otc_take_token.balance_of(address=self.alice)
+        dave_pool_before = self.con_pool_token.balance_of(address=self.dave)
+        dave_take_before = self.con_otc_take_token.balance_of(address=self.dave)
+
+        # The cancelled listing is skipped, the third is half filled by the remaining budget
+        filled = self.con_otc.take_offers(listing_ids=[first, second, third], max_total_take=decimal('40'), signer=self.dave)
+        self.assertEqual(filled, decimal('40'))
+        self.assertEqual(self.con_otc_take_token.balance_of(address=self.dave), dave_take_before - decimal('40'))
+        self.assertEqual(self.con_pool_token.balance_of(address=self.dave), dave_pool_before + decimal('15'))
+        self.assertEqual(self.con_otc_take_token.balance_of(address=self.alice), alice_take_before + decimal('40'))
+        self.assertEqual(self.con_otc.otc_listing[first]['status'], "EXECUTED")
+        self.assertEqual(self.con_otc.otc_listing[third]['status'], "OPEN")
+        self.assertEqual(self.con_otc.otc_listing[third]['take_amount_filled'], decimal('20'))
+
+        with self.assertRaisesRegex(AssertionError, "No listing could be filled"):
+            self.con_otc.take_offers(listing_ids=[first, second], max_total_take=decimal('10'), signer=self.dave)
+
+    def test_list_offers_and_cancel_offers_batch(self):
+        print("\n--- Test: Batch List and Cancel Offers ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('1.0'), signer=self.operator)
+        self.con_pool_token.approve(amount=decimal('100'), to=self.otc_contract_name, signer=self.alice)
+        alice_pool_before = self.con_pool_token.balance_of(address=self.alice)
+
+        listing_ids = self.con_otc.list_offers(offers=[
+            [self.pool_token_name, decimal('10'), self.take_token_name, decimal('20')],
+            [self.pool_token_name, decimal('30'), self.take_token_name, decimal('90')],
+        ], signer=self.alice)
+        self.assertEqual(len(listing_ids), 2)
+        self.assertEqual(self.con_pool_token.balance_of(address=self.alice), alice_pool_before - decimal('40.4'))
+        self.assertEqual(self.con_otc.otc_listing[listing_ids[1]]['offer_amount'], decimal('30'))
+
+        with self.assertRaisesRegex(AssertionError, "Only maker can cancel offer"):
+            self.con_otc.cancel_offers(listing_ids=listing_ids, signer=self.bob)
+
+        self.con_otc.cancel_offers(listing_ids=listing_ids, signer=self.alice)
+        self.assertEqual(self.con_pool_token.balance_of(address=self.alice), alice_pool_before)
+        for listing_id in listing_ids:
+            self.assertEqual(self.con_otc.otc_listing[listing_id]['status'], "CANCELLED")
+        self.assertEqual(
+            self.con_otc.get_open_offers(offer_token=self.pool_token_name, take_token=self.take_token_name, start=0, limit=10),
+            []
+        )
+
+    def test_amend_otc_listing_for_pool_reprices_in_place(self):
+        print("\n--- Test: Amend OTC Listing For Pool ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('0.0'), signer=self.operator)
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="Amend Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        self.con_crowdfund_otc.contribute(
+            pool_id=pool_id, amount=decimal('40'), signer=self.bob,
+            environment={"now": self._get_future_time(self.base_time, days=1)}
+        )
+        time_for_listing = self._get_future_time(self.base_time, days=6)
+        listing_id = self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=pool_id, otc_take_token=self.take_token_name,
+            otc_total_take_amount=decimal('100'), signer=self.alice,
+            environment={"now": time_for_listing}
+        )
+        self.con_otc.take_offer(listing_id=listing_id, fill_amount=decimal('25'), signer=self.dave, environment={"now": time_for_listing})
+
+        with self.assertRaisesRegex(AssertionError, "Only pool creator can amend"):
+            self.con_crowdfund_otc.amend_otc_listing_for_pool(
+                pool_id=pool_id, new_take_amount=decimal('150'), signer=self.bob, environment={"now": time_for_listing}
+            )
+        with self.assertRaisesRegex(AssertionError, "Only maker can amend offer"):
+            self.con_otc.amend_offer(listing_id=listing_id, new_take_amount=decimal('150'), signer=self.alice)
+
+        # The 30 unfilled pool tokens are repriced from 75 to 150 take tokens
+        self.con_crowdfund_otc.amend_otc_listing_for_pool(
+            pool_id=pool_id, new_take_amount=decimal('150'), signer=self.alice, environment={"now": time_for_listing}
+        )
+        offer = self.con_otc.otc_listing[listing_id]
+        self.assertEqual(offer['take_amount'], decimal('175'))
+        self.assertEqual(offer['offer_amount'], decimal('40'))
+        deal_info = self.con_crowdfund_otc.get_otc_deal_info_for_pool(pool_id=pool_id)
+        self.assertEqual(deal_info['target_take_amount'], decimal('175'))
+        self.assertEqual(deal_info['remaining_take_amount'], decimal('150'))
+
+        self.con_otc.take_offer(listing_id=listing_id, signer=self.dave, environment={"now": time_for_listing})
+        bob_take_before = self.con_otc_take_token.balance_of(address=self.bob)
+        self.con_crowdfund_otc.withdraw_share(pool_id=pool_id, signer=self.bob, environment={"now": time_for_listing})
+        self.assertEqual(self.con_otc_take_token.balance_of(address=self.bob), bob_take_before + decimal('175'))
+
+        with self.assertRaisesRegex(AssertionError, "Pool has no active OTC listing to amend"):
+            self.con_crowdfund_otc.amend_otc_listing_for_pool(
+                pool_id=pool_id, new_take_amount=decimal('10'), signer=self.alice, environment={"now": time_for_listing}
+            )
+
+    def test_fee_token_registry_and_withdraw_all(self):
+        print("\n--- Test: Fee Token Registry and Withdraw All ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('1.0'), signer=self.operator)
+        self.con_pool_token.approve(amount=decimal('100'), to=self.otc_contract_name, signer=self.alice)
+        listing_id = self.con_otc.list_offer(offer_token=self.pool_token_name, offer_amount=decimal('10'),
+                                             take_token=self.take_token_name, take_amount=decimal('20'), signer=self.alice)
+        self.assertEqual(self.con_otc.get_fee_tokens(start=0, limit=10), [])
+
+        self.con_otc.take_offer(listing_id=listing_id, signer=self.dave)
+        self.assertEqual(self.con_otc.get_fee_tokens(start=0, limit=10), [
+            [self.pool_token_name, decimal('0.1')],
+            [self.take_token_name, decimal('0.2')],
+        ])
+
+        with self.assertRaisesRegex(AssertionError, "Only owner can call this method"):
+            self.con_otc.withdraw_all(limit=10, signer=self.alice)
+
+        # Swept tokens leave the set, from its end
+        owner_take_before = self.con_otc_take_token.balance_of(address=self.operator)
+        self.assertEqual(self.con_otc.withdraw_all(limit=1, signer=self.operator), 1)
+        self.assertEqual(self.con_otc.view_earned_fees(token=self.take_token_name), decimal('0'))
+        self.assertEqual(self.con_otc.view_earned_fees(token=self.pool_token_name), decimal('0.1'))
+        self.assertEqual(self.con_otc.get_fee_tokens(start=0, limit=10), [[self.pool_token_name, decimal('0.1')]])
+        self.assertEqual(self.con_otc_take_token.balance_of(address=self.operator), owner_take_before + decimal('0.2'))
+
+        # A hand-picked withdrawal swaps the last token into the freed index
+        listing_id = self.con_otc.list_offer(offer_token=self.pool_token_name, offer_amount=decimal('10'),
+                                             take_token=self.take_token_name, take_amount=decimal('20'), signer=self.alice)
+        self.con_otc.take_offer(listing_id=listing_id, signer=self.dave)
+        self.con_otc.withdraw(token_list=[self.pool_token_name], signer=self.operator)
+        self.assertEqual(self.con_otc.get_fee_tokens(start=0, limit=10), [[self.take_token_name, decimal('0.2')]])
+        self.assertEqual(self.con_otc.withdraw_all(limit=10, signer=self.operator), 0)
+        self.assertEqual(self.con_otc.get_fee_tokens(start=0, limit=10), [])
+
+    def test_stats_are_maintained_incrementally(self):
+        print("\n--- Test: Incremental Stats ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('0.0'), signer=self.operator)
+        listed_pool = self.con_crowdfund_otc.create_pool(
+            description="Listed Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        idle_pool = self.con_crowdfund_otc.create_pool(
+            description="Idle Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        self.con_crowdfund_otc.contribute(pool_id=listed_pool, amount=decimal('30'), signer=self.bob, environment={"now": contrib_time})
+        self.con_crowdfund_otc.contribute(pool_id=listed_pool, amount=decimal('10'), signer=self.charlie, environment={"now": contrib_time})
+        self.con_crowdfund_otc.contribute(pool_id=idle_pool, amount=decimal('5'), signer=self.bob, environment={"now": contrib_time})
+
+        # Contributions do not touch the stats: pools are counted on their own transitions
+        stats = self.con_crowdfund_otc.get_stats(token=self.pool_token_name)
+        self.assertEqual(stats['pool_count'], 2)
+        self.assertEqual(stats['pools_by_status']['OPEN_FOR_CONTRIBUTION'], 2)
+        self.assertEqual(stats['contributor_count'], 0)
+        self.assertEqual(stats['value_locked'], decimal('0'))
+        self.assertNotIn('value_locked', self.con_crowdfund_otc.get_stats())
+
+        time_for_listing = self._get_future_time(self.base_time, days=6)
+        listing_id = self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=listed_pool, otc_take_token=self.take_token_name,
+            otc_total_take_amount=decimal('100'), signer=self.alice,
+            environment={"now": time_for_listing}
+        )
+        stats = self.con_crowdfund_otc.get_stats(token=self.pool_token_name)
+        self.assertEqual(stats['pools_by_status']['OTC_LISTED'], 1)
+        self.assertEqual(stats['contributor_count'], 2)
+        self.assertEqual(stats['value_locked'], decimal('40'))
+
+        self.con_otc.take_offer(listing_id=listing_id, signer=self.dave, environment={"now": time_for_listing})
+        self.con_crowdfund_otc.withdraw_share(pool_id=listed_pool, signer=self.bob, environment={"now": time_for_listing})
+        self.con_crowdfund_otc.withdraw_contribution(pool_id=idle_pool, signer=self.bob, environment={"now": time_for_listing})
+
+        stats = self.con_crowdfund_otc.get_stats(token=self.pool_token_name)
+        self.assertEqual(stats['pools_by_status']['OTC_EXECUTED'], 1)
+        self.assertEqual(stats['pools_by_status']['OTC_LISTED'], 0)
+        self.assertEqual(stats['pools_by_status']['REFUNDING'], 1)
+        self.assertEqual(stats['pools_by_status']['OPEN_FOR_CONTRIBUTION'], 0)
+        self.assertEqual(stats['contributor_count'], 3)
+        self.assertEqual(stats['value_locked'], decimal('0'))
+        # The whole take amount is counted when the pool is settled, not share by share
+        self.assertEqual(self.con_crowdfund_otc.get_stats(token=self.take_token_name)['take_distributed'], decimal('100'))
+        # Each pool only writes the counters of its own shard
+        self.assertEqual(self.con_crowdfund_otc.pool_status_count['OTC_EXECUTED', listed_pool[0]], 1)
+        self.assertEqual(self.con_crowdfund_otc.contributor_total[listed_pool[0]], 2 + (1 if idle_pool[0] == listed_pool[0] else 0))
+
+    def test_stats_release_listed_value_when_listing_fails(self):
+        print("\n--- Test: Stats On Failed Listing ---")
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="Failing Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('20'), signer=self.bob, environment={"now": contrib_time})
+        time_for_listing = self._get_future_time(self.base_time, days=6)
+        self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=pool_id, otc_take_token=self.take_token_name,
+            otc_total_take_amount=decimal('100'), signer=self.alice,
+            environment={"now": time_for_listing}
+        )
+        self.assertEqual(self.con_crowdfund_otc.get_stats(token=self.pool_token_name)['value_locked'], decimal('20'))
+
+        self.con_crowdfund_otc.cancel_otc_listing_for_pool(pool_id=pool_id, signer=self.alice, environment={"now": time_for_listing})
+        stats = self.con_crowdfund_otc.get_stats(token=self.pool_token_name)
+        self.assertEqual(stats['value_locked'], decimal('0'))
+        self.assertEqual(stats['pools_by_status']['OTC_FAILED'], 1)
+        # Refunds of a failed pool leave the stats alone
+        self.con_crowdfund_otc.withdraw_contribution(pool_id=pool_id, signer=self.bob, environment={"now": time_for_listing})
+        self.assertEqual(self.con_crowdfund_otc.get_stats(token=self.pool_token_name), stats)
+
+    def test_sweep_expired_closes_stale_pools_in_bulk(self):
+        print("\n--- Test: Sweep Expired Pools ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('0.0'), signer=self.operator)
+        listed_pool = self.con_crowdfund_otc.create_pool(
+            description="Stale Listed Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        unlisted_pool = self.con_crowdfund_otc.create_pool(
+            description="Soft Cap Missed Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('50'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        self.con_crowdfund_otc.contribute(pool_id=listed_pool, amount=decimal('30'), signer=self.bob, environment={"now": contrib_time})
+        self.con_crowdfund_otc.contribute(pool_id=unlisted_pool, amount=decimal('5'), signer=self.bob, environment={"now": contrib_time})
+        listing_id = self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=listed_pool, otc_take_token=self.take_token_name,
+            otc_total_take_amount=decimal('100'), signer=self.alice,
+            environment={"now": self._get_future_time(self.base_time, days=6)}
+        )
+
+        # Deadlines fall on day 8; the bucket is only swept once that day has fully ended
+        self.assertEqual(self.con_crowdfund_otc.sweep_expired(limit=10, signer=self.dave,
+                                                             environment={"now": self._get_future_time(self.base_time, days=8, hours=12)}), 0)
+
+        after_bucket = self._get_future_time(self.base_time, days=9, hours=1)
+        self.assertEqual(self.con_crowdfund_otc.sweep_expired(limit=1, signer=self.dave, environment={"now": after_bucket}), 1)
+        self.assertEqual(self.con_crowdfund_otc.sweep_expired(limit=20, signer=self.dave, environment={"now": after_bucket}), 1)
+
+        self.assertEqual(self.con_otc.otc_listing[listing_id]['status'], "CANCELLED")
+        self.assertEqual(self.con_crowdfund_otc.get_pool_info(pool_id=listed_pool)['status'], "OTC_FAILED")
+        self.assertEqual(self.con_crowdfund_otc.get_pool_info(pool_id=unlisted_pool)['status'], "REFUNDING")
+        # The swept bucket is deleted
+        deadline = self.con_crowdfund_otc.get_pool_info(pool_id=listed_pool)['exchange_deadline']
+        day_key = f"{deadline.year}-{deadline.month}-{deadline.day}"
+        self.assertIsNone(self.client.get_var(self.crowdfund_contract_name, 'expiry_bucket', [day_key]))
+        self.assertIsNone(self.client.get_var(self.crowdfund_contract_name, 'expiry_bucket', [day_key, 0]))
+
+        # Nothing left to do, and withdrawals now take the cheap path
+        self.assertEqual(self.con_crowdfund_otc.sweep_expired(limit=20, signer=self.dave, environment={"now": after_bucket}), 0)
+        bob_pool_before = self.con_pool_token.balance_of(address=self.bob)
+        self.con_crowdfund_otc.withdraw_contribution(pool_id=listed_pool, signer=self.bob, environment={"now": after_bucket})
+        self.assertEqual(self.con_pool_token.balance_of(address=self.bob), bob_pool_before + decimal('30'))
+
+    def test_contributor_records_are_deleted_on_full_exit(self):
+        print("\n--- Test: Contributor Records Deleted On Full Exit ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('0.0'), signer=self.operator)
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="Compact Records Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('20'), signer=self.bob, environment={"now": contrib_time})
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('30'), signer=self.charlie, environment={"now": contrib_time})
+
+        # A withdrawal inside the contribution window keeps a zeroed placeholder until the deadline
+        self.con_crowdfund_otc.withdraw_contribution(pool_id=pool_id, signer=self.bob, environment={"now": contrib_time})
+        self.assertEqual(self.con_crowdfund_otc.contributor[self.bob, pool_id], [0, 0])
+        self.assertIsNone(self.con_crowdfund_otc.get_contribution_info(pool_id=pool_id, account=self.bob))
+
+        # Contributing again revives the same entry instead of indexing bob twice
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('10'), signer=self.bob, environment={"now": contrib_time})
+        self.assertEqual(self.con_crowdfund_otc.contributor[self.bob, pool_id], [10 * 10**8, 10 * 10**8])
+        self.assertEqual(self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)['contributor_count'], 2)
+
+        listing_id = self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=pool_id, otc_take_token=self.take_token_name,
+            otc_total_take_amount=decimal('80'), signer=self.alice,
+            environment={"now": self._get_future_time(self.base_time, days=6)}
+        )
+        take_time = self._get_future_time(self.base_time, days=7)
+        self.con_otc.take_offer(listing_id=listing_id, signer=self.dave, environment={"now": take_time})
+
+        self.con_crowdfund_otc.withdraw_share(pool_id=pool_id, signer=self.bob, environment={"now": take_time})
+        self.assertIsNone(self.client.get_var(self.crowdfund_contract_name, 'contributor', [self.bob, pool_id]))
+        self.con_crowdfund_otc.withdraw_share(pool_id=pool_id, signer=self.charlie, environment={"now": take_time})
+        self.assertIsNone(self.client.get_var(self.crowdfund_contract_name, 'contributor', [self.charlie, pool_id]))
+
+    def test_archive_pool_deletes_finished_pool_and_listing(self):
+        print("\n--- Test: Archive Finished Pool ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('0.0'), signer=self.operator)
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="Archive Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('40'), signer=self.bob, environment={"now": contrib_time})
+        # Withdrawing before the deadline leaves a zeroed position behind
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('10'), signer=self.charlie, environment={"now": contrib_time})
+        self.con_crowdfund_otc.withdraw_contribution(pool_id=pool_id, signer=self.charlie, environment={"now": contrib_time})
+        time_for_listing = self._get_future_time(self.base_time, days=6)
+        listing_id = self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=pool_id, otc_take_token=self.take_token_name,
+            otc_total_take_amount=decimal('80'), signer=self.alice,
+            environment={"now": time_for_listing}
+        )
+        self.con_otc.take_offer(listing_id=listing_id, signer=self.dave, environment={"now": time_for_listing})
+        self.con_crowdfund_otc.settle_pool(pool_id=pool_id, signer=self.dave, environment={"now": time_for_listing})
+
+        with self.assertRaisesRegex(AssertionError, "Only archived pools can be pruned"):
+            self.con_crowdfund_otc.prune_archived_pool(pool_id=pool_id, limit=10, signer=self.bob, environment={"now": time_for_listing})
+        with self.assertRaisesRegex(AssertionError, "Every contributor must have claimed"):
+            self.con_crowdfund_otc.archive_pool(pool_id=pool_id, limit=10, signer=self.alice, environment={"now": time_for_listing})
+        # The crowdfund contract is the maker, so nobody else can archive its listing
+        with self.assertRaisesRegex(AssertionError, "Only maker can archive offer"):
+            self.con_otc.archive_listing(listing_id=listing_id, signer=self.alice, environment={"now": time_for_listing})
+
+        self.con_crowdfund_otc.withdraw_share(pool_id=pool_id, signer=self.bob, environment={"now": time_for_listing})
+        with self.assertRaisesRegex(AssertionError, "Only pool creator or operator can archive"):
+            self.con_crowdfund_otc.archive_pool(pool_id=pool_id, limit=10, signer=self.bob, environment={"now": time_for_listing})
+        # Contributors are checked a page at a time, and the pool goes once all of them are
+        self.assertEqual(self.con_crowdfund_otc.archive_pool(pool_id=pool_id, limit=1, signer=self.alice, environment={"now": time_for_listing}), 1)
+        self.assertEqual(self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)['settlement_cursor'], 1)
+        self.assertEqual(self.con_crowdfund_otc.archive_pool(pool_id=pool_id, limit=1, signer=self.alice, environment={"now": time_for_listing}), 0)
+
+        self.assertIsNone(self.con_crowdfund_otc.get_pool_info(pool_id=pool_id))
+        self.assertIsNone(self.con_crowdfund_otc.get_otc_deal_info_for_pool(pool_id=pool_id))
+        self.assertIsNone(self.client.get_var(self.otc_contract_name, 'otc_listing', [listing_id]))
+        stats = self.con_crowdfund_otc.get_stats()
+        self.assertEqual(stats['pools_by_status']['ARCHIVED'], 1)
+        self.assertEqual(stats['pools_by_status']['OTC_EXECUTED'], 0)
+        with self.assertRaisesRegex(AssertionError, "pool does not exist"):
+            self.con_crowdfund_otc.archive_pool(pool_id=pool_id, limit=10, signer=self.alice, environment={"now": time_for_listing})
+
+        # The contributor index is pruned in pages by anyone, last entry first
+        self.assertEqual(self.client.get_var(self.crowdfund_contract_name, 'pool_contributor_count', [pool_id]), 2)
+        self.assertEqual(self.con_crowdfund_otc.prune_archived_pool(pool_id=pool_id, limit=1, signer=self.dave, environment={"now": time_for_listing}), 1)
+        self.assertIsNone(self.client.get_var(self.crowdfund_contract_name, 'contributor', [self.charlie, pool_id]))
+        self.assertEqual(self.con_crowdfund_otc.prune_archived_pool(pool_id=pool_id, limit=10, signer=self.dave, environment={"now": time_for_listing}), 0)
+        self.assertIsNone(self.client.get_var(self.crowdfund_contract_name, 'pool_contributor_count', [pool_id]))
+        self.assertEqual(self.con_crowdfund_otc.get_pool_contributors(pool_id=pool_id, start=0, limit=10), [])
+        with self.assertRaisesRegex(AssertionError, "Nothing left to prune"):
+            self.con_crowdfund_otc.prune_archived_pool(pool_id=pool_id, limit=10, signer=self.dave, environment={"now": time_for_listing})
+
+    def test_pool_math_floors_to_base_units(self):
+        print("\n--- Test: Pool Math Floors To Base Units ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('0.0'), signer=self.operator)
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="Base Unit Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        # Anything finer than 10^-8 is not pulled from the contributor
+        bob_pool_before = self.con_pool_token.balance_of(address=self.bob)
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('10.000000009'), signer=self.bob, environment={"now": contrib_time})
+        self.assertEqual(self.con_pool_token.balance_of(address=self.bob), bob_pool_before - decimal('10'))
+        self.assertEqual(self.con_crowdfund_otc.get_contribution_info(pool_id=pool_id, account=self.bob)['amount_contributed'], decimal('10'))
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('10'), signer=self.charlie, environment={"now": contrib_time})
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('10'), signer=self.alice, environment={"now": contrib_time})
+
+        time_for_listing = self._get_future_time(self.base_time, days=6)
+        listing_id = self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=pool_id, otc_take_token=self.take_token_name,
+            otc_total_take_amount=decimal('100'), signer=self.alice,
+            environment={"now": time_for_listing}
+        )
+        self.con_otc.take_offer(listing_id=listing_id, signer=self.dave, environment={"now": time_for_listing})
+
+        # Each third of 100 is floored, and the last base unit stays in the contract
+        take_before = self.con_otc_take_token.balance_of(address=self.crowdfund_contract_name)
+        for account in [self.bob, self.charlie, self.alice]:
+            self.con_crowdfund_otc.withdraw_share(pool_id=pool_id, signer=account, environment={"now": time_for_listing})
+        self.assertEqual(self.con_otc_take_token.balance_of(address=self.crowdfund_contract_name),
+                         take_before - decimal('99.99999999'))
+        # Stats count the take amount the pool received, including the base unit left behind
+        self.assertEqual(self.con_crowdfund_otc.get_stats(token=self.take_token_name)['take_distributed'], decimal('100'))
+
+    def test_pledge_mode_pulls_pledges_before_listing(self):
+        print("\n--- Test: Pledge Mode ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('0.0'), signer=self.operator)
+        # Pledges are checked against the token's allowances, so their layout must be registered first
+        with self.assertRaisesRegex(AssertionError, "registered allowance layout"):
+            self.con_crowdfund_otc.create_pool(
+                description="Pledge Pool", pool_token=self.pool_token_name,
+                hard_cap=decimal('100'), soft_cap=decimal('10'), pledge_mode=True, signer=self.alice,
+                environment={"now": self.base_time}
+            )
+        with self.assertRaisesRegex(AssertionError, "token has no Hash named allowances"):
+            self.con_crowdfund_otc.set_token_type(token=self.pool_token_name, behaviour="unknown", allowance_hash="allowances", signer=self.operator)
+        self.con_crowdfund_otc.set_token_type(token=self.pool_token_name, behaviour="unknown", allowance_hash="balances", signer=self.operator)
+        self.assertEqual(self.con_crowdfund_otc.get_token_info(token=self.pool_token_name)["allowance_hash"], "balances")
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="Pledge Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('10'), pledge_mode=True, signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        bob_before = self.con_pool_token.balance_of(address=self.bob)
+        charlie_before = self.con_pool_token.balance_of(address=self.charlie)
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('30'), signer=self.bob, environment={"now": contrib_time})
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('20'), signer=self.charlie, environment={"now": contrib_time})
+        with self.assertRaisesRegex(AssertionError, "allowance or balance does not cover the pledge"):
+            self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('10'), signer=self.dave, environment={"now": contrib_time})
+
+        # Pledging moves no tokens
+        self.assertEqual(self.con_pool_token.balance_of(address=self.bob), bob_before)
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
+        self.assertEqual(pool_info['total_nominal_contributions'], decimal('50'))
+        self.assertEqual(pool_info['amount_received'], decimal('0'))
+
+        # Charlie no longer covers the pledge when it is collected, so it is dropped
+        self.con_pool_token.approve(amount=decimal('1'), to=self.crowdfund_contract_name, signer=self.charlie)
+        time_for_listing = self._get_future_time(self.base_time, days=6)
+        with self.assertRaisesRegex(AssertionError, "Pledges must be collected"):
+            self.con_crowdfund_otc.list_pooled_funds_on_otc(
+                pool_id=pool_id, otc_take_token=self.take_token_name,
+                otc_total_take_amount=decimal('60'), signer=self.alice,
+                environment={"now": time_for_listing}
+            )
+        self.assertEqual(self.con_crowdfund_otc.collect_pledges(pool_id=pool_id, limit=1, signer=self.alice, environment={"now": time_for_listing}), 1)
+        self.assertEqual(self.con_crowdfund_otc.collect_pledges(pool_id=pool_id, limit=10, signer=self.alice, environment={"now": time_for_listing}), 0)
+
+        self.assertEqual(self.con_pool_token.balance_of(address=self.bob), bob_before - decimal('30'))
+        self.assertEqual(self.con_pool_token.balance_of(address=self.charlie), charlie_before)
+        self.assertIsNone(self.con_crowdfund_otc.get_contribution_info(pool_id=pool_id, account=self.charlie))
+        pool_info = self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)
+        self.assertEqual(pool_info['total_nominal_contributions'], decimal('30'))
+        self.assertEqual(pool_info['amount_received'], decimal('30'))
+
+        listing_id = self.con_crowdfund_otc.list_pooled_funds_on_otc(
+            pool_id=pool_id, otc_take_token=self.take_token_name,
+            otc_total_take_amount=decimal('60'), signer=self.alice,
+            environment={"now": time_for_listing}
+        )
+        self.assertEqual(self.con_otc.otc_listing[listing_id]['offer_amount'], decimal('30'))
+
+    def test_failed_pledge_pool_refunds_without_transfers(self):
+        print("\n--- Test: Failed Pledge Pool ---")
+        self.con_crowdfund_otc.set_token_type(token=self.pool_token_name, behaviour="unknown", allowance_hash="balances", signer=self.operator)
+        pool_id = self.con_crowdfund_otc.create_pool(
+            description="Failed Pledge Pool", pool_token=self.pool_token_name,
+            hard_cap=decimal('100'), soft_cap=decimal('50'), pledge_mode=True, signer=self.alice,
+            environment={"now": self.base_time}
+        )
+        contrib_time = self._get_future_time(self.base_time, days=1)
+        self.con_crowdfund_otc.contribute(pool_id=pool_id, amount=decimal('20'), signer=self.bob, environment={"now": contrib_time})
+
+        after_deadline = self._get_future_time(self.base_time, days=6)
+        with self.assertRaisesRegex(AssertionError, "Soft cap not met"):
+            self.con_crowdfund_otc.collect_pledges(pool_id=pool_id, limit=10, signer=self.alice, environment={"now": after_deadline})
+
+        bob_before = self.con_pool_token.balance_of(address=self.bob)
+        self.con_crowdfund_otc.withdraw_contribution(pool_id=pool_id, signer=self.bob, environment={"now": after_deadline})
+        self.assertEqual(self.con_pool_token.balance_of(address=self.bob), bob_before)
+        self.assertEqual(self.con_crowdfund_otc.get_pool_info(pool_id=pool_id)['status'], "REFUNDING")
+        self.assertIsNone(self.client.get_var(self.crowdfund_contract_name, 'contributor', [self.bob, pool_id]))
+
+    def test_offer_without_escrow_pulls_from_maker_allowance(self):
+        print("\n--- Test: Offer Without Escrow ---")
+        self.con_otc.adjust_fee(trading_fee=decimal('0.0'), signer=self.operator)
+        with self.assertRaisesRegex(AssertionError, "need a standard offer token"):
+            self.con_otc.list_offer(offer_token=self.pool_token_name, offer_amount=decimal('40'),
+                                    take_token=self.take_token_name, take_amount=decimal('80'), escrow=False, signer=self.alice)
+        self.con_otc.set_token_type(token=self.pool_token_name, behaviour="standard", signer=self.operator)
+        with self.assertRaisesRegex(AssertionError, "need a registered allowance layout"):
+            self.con_otc.list_offer(offer_token=self.pool_token_name, offer_amount=decimal('40'),
+                                    take_token=self.take_token_name, take_amount=decimal('80'), escrow=False, signer=self.alice)
+        with self.assertRaisesRegex(AssertionError, "Token has no Hash named allowances"):
+            self.con_otc.set_token_type(token=self.pool_token_name, behaviour="standard", allowance_hash="allowances", signer=self.operator)
+        self.con_otc.set_token_type(token=self.pool_token_name, behaviour="standard", allowance_hash="balances", signer=self.operator)
+        self.assertEqual(self.con_otc.view_allowance_layout(token=self.pool_token_name), "balances")
+        self.con_pool_token.approve(amount=decimal('50'), to=self.otc_contract_name, signer=self.alice)
+        alice_pool_before = self.con_pool_token.balance_of(address=self.alice)
+        alice_take_before = self.con_otc_take_token.balance_of(address=self.alice)
+
+        listing_id = self.con_otc.list_offer(offer_token=self.pool_token_name, offer_amount=decimal('40'),
+                                             take_token=self.take_token_name, take_amount=decimal('80'), escrow=False, signer=self.alice)
+        # The maker keeps the tokens until a fill
+        self.assertEqual(self.con_pool_token.balance_of(address=self.alice), alice_pool_before)
+        self.assertFalse(self.con_otc.otc_listing[listing_id]['escrow'])
+
+        dave_pool_before = self.con_pool_token.balance_of(address=self.dave)
+        self.con_otc.take_offer(listing_id=listing_id, fill_amount=decimal('40'), signer=self.dave)
+        self.assertEqual(self.con_pool_token.balance_of(address=self.dave), dave_pool_before + decimal('20'))
+        self.assertEqual(self.con_pool_token.balance_of(address=self.alice), alice_pool_before - decimal('20'))
+        self.assertEqual(self.con_otc_take_token.balance_of(address=self.alice), alice_take_before + decimal('40'))
+
+        # Once the maker lowers the allowance the listing is stale: it cannot be taken, and anyone may clear it
+        self.con_pool_token.approve(amount=decimal('1'), to=self.otc_contract_name, signer=self.alice)
+        with self.assertRaisesRegex(AssertionError, "no longer covers the offer"):
+            self.con_otc.take_offer(listing_id=listing_id, signer=self.dave)
+        self.con_otc.cancel_offer(listing_id=listing_id, signer=self.bob)
+        self.assertEqual(self.con_otc.otc_listing[listing_id]['status'], "CANCELLED")
+        self.assertEqual(self.con_pool_token.balance_of(address=self.alice), alice_pool_before - decimal('20'))
+
 if __name__ == '__main__':
     # This allows running the tests from the command line
     # You might need to adjust Python's path if contracting module is not found